@@ -1,11 +1,15 @@
 #!/usr/bin/env python
 
 import argparse
+import json
 import logging
 import sys
 
+from gcloud_storage_emulator import timing
+from gcloud_storage_emulator.bench import ROUTING_DISPATCHES, STARTUP_OBJECTS, WORKLOADS, run_benchmark
 from gcloud_storage_emulator.handlers.buckets import create_bucket
-from gcloud_storage_emulator.server import create_server
+from gcloud_storage_emulator.metadata import BACKENDS, JSON_BACKEND
+from gcloud_storage_emulator.server import DEFAULT_WORKERS, create_server
 from gcloud_storage_emulator.storage import Storage
 
 # One after gcloud-task-emulator one
@@ -13,14 +17,27 @@ DEFAULT_PORT = 9023
 DEFAULT_HOST = "localhost"
 
 
-def run_server(host, port, memory=False, default_bucket=None):
-    server = create_server(host, port, memory, default_bucket)
+def run_server(host, port, memory=False, default_bucket=None, workers=DEFAULT_WORKERS, dedup=False, processes=1,
+               metadata_backend=JSON_BACKEND, debug_endpoints=False,
+               slow_request_threshold=timing.DEFAULT_SLOW_REQUEST_THRESHOLD):
+    server = create_server(
+        host,
+        port,
+        memory,
+        default_bucket,
+        workers=workers,
+        dedup=dedup,
+        processes=processes,
+        metadata_backend=metadata_backend,
+        debug_endpoints=debug_endpoints,
+        slow_request_threshold=slow_request_threshold,
+    )
     return server.run()
 
 
-def wipe(keep_buckets=False):
+def wipe(keep_buckets=False, metadata_backend=JSON_BACKEND):
     print("Wiping...")
-    server = create_server(None, None, False)
+    server = create_server(None, None, False, metadata_backend=metadata_backend)
     server.wipe(keep_buckets=keep_buckets)
     print("Done.")
     return 0
@@ -43,9 +60,60 @@ def prepare_args_parser():
     start.add_argument("-q", "--quiet", action="store_true", default=False, help="only outputs critical level logging")
     start.add_argument("-M", "--no-store-on-disk", action="store_true", default=False, help="use in-memory storage")
     start.add_argument("-D", "--data-dir", help="directory to use as the storage root")
+    start.add_argument(
+        "--workers", type=int, default=DEFAULT_WORKERS, help="number of requests to serve concurrently"
+    )
+    start.add_argument(
+        "--dedup", action="store_true", default=False, help="store identical object contents only once on disk"
+    )
+    start.add_argument(
+        "--processes", type=int, default=1, help="number of processes serving requests, sharing the on-disk storage"
+    )
+    start.add_argument(
+        "--metadata", choices=BACKENDS, default=JSON_BACKEND, help="where to keep the metadata of the on-disk storage"
+    )
+    start.add_argument(
+        "--debug-endpoints", action="store_true", default=False,
+        help="serve the /_debug/profile and /_debug/heap profiling endpoints"
+    )
+    start.add_argument(
+        "--slow-request-threshold", type=float, default=timing.DEFAULT_SLOW_REQUEST_THRESHOLD,
+        help="seconds after which a request is logged as slow, with the time spent in each stage"
+    )
+    start.add_argument("--slow-log", help="file to write the slow requests to, instead of the main log")
+
+    bench = subparsers.add_parser("bench", help="measure the throughput of the emulator, reported as JSON")
+    bench.add_argument("-M", "--no-store-on-disk", action="store_true", default=False, help="use in-memory storage")
+    bench.add_argument(
+        "--workers", type=int, default=DEFAULT_WORKERS, help="number of requests the server serves concurrently"
+    )
+    bench.add_argument("--processes", type=int, default=1, help="number of processes serving requests")
+    bench.add_argument("--dedup", action="store_true", default=False, help="store identical contents only once")
+    bench.add_argument("--metadata", choices=BACKENDS, default=JSON_BACKEND, help="where to keep the metadata")
+    bench.add_argument(
+        "--workloads", default=",".join(WORKLOADS), help="comma separated workloads to run, among: {}".format(
+            ", ".join(WORKLOADS)
+        )
+    )
+    bench.add_argument("--concurrency", type=int, default=8, help="number of concurrent clients")
+    bench.add_argument("--requests", type=int, default=200, help="number of operations per workload")
+    bench.add_argument("--small-size", type=int, default=1024, help="size in bytes of the small objects")
+    bench.add_argument("--large-size", type=int, default=4 * 1024 * 1024, help="size in bytes of the large objects")
+    bench.add_argument(
+        "--routing-dispatches", type=int, default=ROUTING_DISPATCHES,
+        help="number of requests dispatched by the routing workload for each route group"
+    )
+    bench.add_argument(
+        "--startup-objects", type=int, default=STARTUP_OBJECTS,
+        help="number of objects of the storage opened by the startup workload"
+    )
+    bench.add_argument("-o", "--output", help="file to write the results to, instead of the standard output")
 
     wipe = subparsers.add_parser("wipe", help="Wipe the local data")
     wipe.add_argument("--keep-buckets", help="If provided the data will be wiped but the existing buckets are kept")
+    wipe.add_argument(
+        "--metadata", choices=BACKENDS, default=JSON_BACKEND, help="where the metadata of the storage is kept"
+    )
 
     create_bucket = subparsers.add_parser("create_bucket", help="create bucket")
     create_bucket.add_argument(
@@ -66,11 +134,37 @@ def main():
     if args.subcommand == "wipe":
         answer = input("This operation will IRREVERSIBLY DELETE all your data. Do you wish to proceed? [y/N] ").lower()
         if answer in ("y", "ye", "yes"):
-            sys.exit(wipe(keep_buckets=args.keep_buckets))
+            sys.exit(wipe(keep_buckets=args.keep_buckets, metadata_backend=args.metadata))
         else:
             print("wipe command cancelled")
             sys.exit(1)
 
+    if args.subcommand == "bench":
+        try:
+            results = run_benchmark(
+                workloads=[workload for workload in args.workloads.split(",") if workload],
+                in_memory=args.no_store_on_disk,
+                workers=args.workers,
+                processes=args.processes,
+                dedup=args.dedup,
+                metadata_backend=args.metadata,
+                concurrency=args.concurrency,
+                requests=args.requests,
+                small_size=args.small_size,
+                large_size=args.large_size,
+                routing_dispatches=args.routing_dispatches,
+                startup_objects=args.startup_objects,
+            )
+        except ValueError as e:
+            parser.error(str(e))
+        output = json.dumps(results, indent=2)
+        if args.output:
+            with open(args.output, "w") as file:
+                file.write(output + "\n")
+        else:
+            print(output)
+        sys.exit(0)
+
     if args.subcommand == "create_bucket":
         storage = Storage()
         create_bucket(args.name, storage)
@@ -83,7 +177,24 @@ def main():
         root.setLevel(logging.CRITICAL)
     else:
         root.setLevel(logging.DEBUG)
-    sys.exit(run_server(args.host, args.port, args.no_store_on_disk, args.default_bucket))
+    if args.slow_log:
+        slow_log_handler = logging.FileHandler(args.slow_log)
+        slow_log_handler.setFormatter(logging.Formatter("%(asctime)s %(message)s"))
+        timing.slow_logger.addHandler(slow_log_handler)
+        timing.slow_logger.setLevel(logging.WARNING)
+        timing.slow_logger.propagate = False
+    sys.exit(run_server(
+        args.host,
+        args.port,
+        args.no_store_on_disk,
+        args.default_bucket,
+        args.workers,
+        dedup=args.dedup,
+        processes=args.processes,
+        metadata_backend=args.metadata,
+        debug_endpoints=args.debug_endpoints,
+        slow_request_threshold=args.slow_request_threshold,
+    ))
 
 
 if __name__ == "__main__":
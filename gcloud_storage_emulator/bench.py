@@ -0,0 +1,552 @@
+import email.message
+import http.client
+import json
+import math
+import os
+import shutil
+import socket
+import struct
+import tempfile
+import threading
+import time
+import types
+import uuid
+from urllib.parse import quote, urlparse
+
+from gcloud_storage_emulator import compression, debug, metrics, settings
+from gcloud_storage_emulator.metadata import JSON_BACKEND
+from gcloud_storage_emulator.server import DEFAULT_WORKERS, HANDLERS, Router, create_server
+from gcloud_storage_emulator.storage import Storage
+
+# Workloads run by default, in this order: the objects some of them read are created by
+# their own preparation step, not by the workloads before them
+WORKLOADS = (
+    "upload_small",
+    "upload_large",
+    "resumable_upload",
+    "download",
+    "list",
+    "copy",
+    "delete",
+    "routing",
+    "startup",
+)
+
+BENCH_BUCKET = "bench"
+
+# Objects read by the download, list and copy workloads, spread over prefixes
+SEED_OBJECTS = 1000
+SEED_PREFIXES = 10
+
+# Resumable uploads are sent in chunks, which must be multiples of 256KiB
+RESUMABLE_CHUNK_SIZE = 256 * 1024
+
+# Percentiles of the latencies reported for each workload
+PERCENTILES = (50, 95, 99)
+
+# Requests dispatched by the routing workload for each route group
+ROUTING_DISPATCHES = 10000
+
+# Route group, method and path of the requests dispatched by the routing workload
+ROUTING_PATHS = (
+    ("bucket_list", "GET", "{}/b".format(settings.API_ENDPOINT)),
+    ("object_list", "GET", "{}/b/{}/o".format(settings.API_ENDPOINT, BENCH_BUCKET)),
+    ("object", "GET", "{}/b/{}/o/some/object.txt".format(settings.API_ENDPOINT, BENCH_BUCKET)),
+    ("upload", "POST", "{}/b/{}/o".format(settings.UPLOAD_API_ENDPOINT, BENCH_BUCKET)),
+    ("download", "GET", "{}/b/{}/o/some/object.txt".format(settings.DOWNLOAD_API_ENDPOINT, BENCH_BUCKET)),
+    ("internal", "GET", "/metrics"),
+    ("public", "GET", "/{}/some/object.txt".format(BENCH_BUCKET)),
+)
+
+
+# Objects of the large bucket of the storage opened by the startup workload
+STARTUP_OBJECTS = 10000
+
+# Number of times the startup workload opens the storage
+STARTUP_REPEATS = 5
+
+# Bucket left empty by the startup workload, its first request doesn't need any object
+STARTUP_EMPTY_BUCKET = "bench-empty"
+
+
+def _free_port(host):
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind((host, 0))
+        return sock.getsockname()[1]
+
+
+def _percentile(sorted_values, percentile):
+    """Nearest-rank percentile of a sorted list"""
+
+    if not sorted_values:
+        return None
+    rank = max(int(math.ceil(percentile / 100.0 * len(sorted_values))) - 1, 0)
+    return sorted_values[rank]
+
+
+def _object_path(bucket_name, object_name):
+    return "{}/b/{}/o/{}".format(settings.API_ENDPOINT, bucket_name, quote(object_name, safe=""))
+
+
+class BenchError(Exception):
+    """An operation of the benchmark got an unexpected response"""
+
+
+def _noop_handler(request, response, storage):
+    pass
+
+
+class _RoutingParent(object):
+    """Stands in for the connection handler the requests of the routing workload come from"""
+
+    storage = None
+
+    def __init__(self):
+        self.server = types.SimpleNamespace(
+            server_address=("localhost", 0),
+            metrics=metrics.Metrics(),
+            profiler=debug.RequestProfiler(),
+            compression_cache=compression.CompressionCache(),
+            slow_request_threshold=None,
+        )
+
+
+def run_routing(dispatches=ROUTING_DISPATCHES):
+    """Measures the per-request overhead of the router, without any socket nor storage
+
+    Requests go through `Router` as those of a connection do (parsing, route lookup, metrics,
+    timing, writing the response), but to handlers which do nothing.
+
+    Keyword Arguments:
+        dispatches {int} -- Number of requests dispatched for each route group (default: {ROUTING_DISPATCHES})
+
+    Returns:
+        dict -- By route group, the throughput and latencies of the dispatches, and the mean
+                time of the route lookup alone
+    """
+
+    routes = Router.compile_routes([
+        (regex, {method: _noop_handler for method in methods})
+        for regex, methods in HANDLERS
+    ])
+    parent = _RoutingParent()
+    headers = email.message.Message()
+
+    results = {}
+    for group, method, path in ROUTING_PATHS:
+        latencies = []
+        for _ in range(dispatches):
+            start = time.perf_counter()
+            status, _, _ = Router.dispatch(parent, method, path, headers, b"", routes)
+            latencies.append(time.perf_counter() - start)
+        if status != 200:
+            raise BenchError("{} {} was routed to {}".format(method, path, status))
+
+        start = time.perf_counter()
+        for _ in range(dispatches):
+            Router.find_route(path, routes)
+        lookup = (time.perf_counter() - start) / dispatches
+
+        elapsed = sum(latencies)
+        latencies.sort()
+        results[group] = {
+            "operations": dispatches,
+            "seconds": round(elapsed, 6),
+            "ops_per_sec": round(dispatches / elapsed, 2) if elapsed else None,
+            "latency_us": {
+                "p{}".format(percentile): round(_percentile(latencies, percentile) * 1e6, 3)
+                for percentile in PERCENTILES
+            },
+            "lookup_us": round(lookup * 1e6, 3),
+        }
+    return results
+
+
+def run_startup(objects=STARTUP_OBJECTS, metadata_backend=JSON_BACKEND, dedup=False, repeats=STARTUP_REPEATS):
+    """Measures how long an on-disk storage holding many objects takes to open, as on a restart
+
+    The storage gets a bucket of `objects` objects and an empty bucket, written through the
+    storage as a running emulator would, so that the metadata is left as it would be (a
+    compacted snapshot followed by the latest records of the journal). It is then opened
+    `repeats` times, in this process, the server isn't involved.
+
+    Keyword Arguments:
+        objects {int} -- Number of objects of the large bucket (default: {STARTUP_OBJECTS})
+        metadata_backend {str} -- Metadata backend of the storage (default: {"json"})
+        dedup {bool} -- Whether the storage deduplicates contents (default: {False})
+        repeats {int} -- Number of times the storage is opened (default: {STARTUP_REPEATS})
+
+    Returns:
+        dict -- The median and best times in milliseconds to open the storage ("open"), to
+                then answer a request about the empty bucket ("first_request"), and to then
+                list the first page of the large bucket ("first_listing")
+    """
+
+    data_dir = tempfile.mkdtemp(prefix="gcloud-storage-emulator-bench-")
+    try:
+        storage = Storage(data_dir=data_dir, dedup=dedup, metadata_backend=metadata_backend)
+        for bucket_name in (BENCH_BUCKET, STARTUP_EMPTY_BUCKET):
+            storage.create_bucket(bucket_name, {"kind": "storage#bucket", "name": bucket_name, "id": bucket_name})
+        for i in range(objects):
+            name = "seed-{}/object-{:06d}".format(i % SEED_PREFIXES, i)
+            storage.create_file(BENCH_BUCKET, name, b"", {
+                "kind": "storage#object",
+                "name": name,
+                "bucket": BENCH_BUCKET,
+                "contentType": "application/octet-stream",
+                "generation": "1",
+                "metageneration": "1",
+                "storageClass": "STANDARD",
+            })
+        del storage
+
+        timings = {"open": [], "first_request": [], "first_listing": []}
+        for _ in range(repeats):
+            start = time.perf_counter()
+            storage = Storage(data_dir=data_dir, dedup=dedup, metadata_backend=metadata_backend)
+            timings["open"].append(time.perf_counter() - start)
+            storage.get_bucket(STARTUP_EMPTY_BUCKET)
+            timings["first_request"].append(time.perf_counter() - start)
+            storage.get_file_list(BENCH_BUCKET, max_results=1000)
+            timings["first_listing"].append(time.perf_counter() - start)
+            del storage
+    finally:
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+    result = {"objects": objects, "metadata": metadata_backend, "repeats": repeats}
+    for measure, seconds in timings.items():
+        seconds.sort()
+        result["{}_ms".format(measure)] = {
+            "p50": round(_percentile(seconds, 50) * 1000, 3),
+            "min": round(seconds[0] * 1000, 3),
+        }
+    return result
+
+
+class Benchmark(object):
+    """Drives workloads against a running emulator, from several client threads
+
+    Each client thread keeps its own connection open. An operation is timed from sending
+    its first request to reading the whole response of its last one.
+
+    Arguments:
+        host {str} -- Host of the emulator
+        port {int} -- Port of the emulator
+
+    Keyword Arguments:
+        concurrency {int} -- Number of client threads (default: {8})
+        requests {int} -- Number of operations per workload (default: {200})
+        small_size {int} -- Size in bytes of the small objects (default: {1KiB})
+        large_size {int} -- Size in bytes of the large objects (default: {4MiB})
+        routing_dispatches {int} -- Requests dispatched by the routing workload for each
+                                    route group (default: {ROUTING_DISPATCHES})
+        startup_objects {int} -- Objects of the storage opened by the startup workload
+                                 (default: {STARTUP_OBJECTS})
+        metadata_backend {str} -- Metadata backend of the storage opened by the startup
+                                  workload (default: {"json"})
+        dedup {bool} -- Whether the storage opened by the startup workload deduplicates
+                        contents (default: {False})
+    """
+
+    def __init__(self, host, port, concurrency=8, requests=200, small_size=1024, large_size=4 * 1024 * 1024,
+                 routing_dispatches=ROUTING_DISPATCHES, startup_objects=STARTUP_OBJECTS,
+                 metadata_backend=JSON_BACKEND, dedup=False):
+        self._host = host
+        self._port = port
+        self._concurrency = concurrency
+        self._requests = requests
+        self._small_size = small_size
+        self._large_size = large_size
+        self._routing_dispatches = routing_dispatches
+        self._startup_objects = startup_objects
+        self._metadata_backend = metadata_backend
+        self._dedup = dedup
+        self._small_content = os.urandom(small_size)
+        self._large_content = os.urandom(large_size)
+        self._seed_names = [
+            "seed-{}/object-{:06d}".format(i % SEED_PREFIXES, i)
+            for i in range(SEED_OBJECTS)
+        ]
+        self._delete_names = ["delete/object-{:06d}".format(i) for i in range(requests)]
+
+    def _connect(self):
+        return http.client.HTTPConnection(self._host, self._port, timeout=60)
+
+    def _request(self, connection, method, path, body=None, headers=None, expected=(200,)):
+        connection.request(method, path, body=body, headers=headers or {})
+        response = connection.getresponse()
+        data = response.read()
+        if response.status not in expected:
+            raise BenchError("{} {} answered {}".format(method, path, response.status))
+        return response, data
+
+    def _content(self, content, i):
+        # Every upload has its own content, which dedup can't store only once
+        return struct.pack(">Q", i) + content[8:] if len(content) >= 8 else content
+
+    def _upload(self, connection, object_name, content):
+        boundary = uuid.uuid4().hex
+        body = b"".join([
+            "--{}\r\nContent-Type: application/json; charset=UTF-8\r\n\r\n".format(boundary).encode(),
+            json.dumps({"name": object_name}).encode(),
+            "\r\n--{}\r\nContent-Type: application/octet-stream\r\n\r\n".format(boundary).encode(),
+            content,
+            "\r\n--{}--\r\n".format(boundary).encode(),
+        ])
+        self._request(
+            connection,
+            "POST",
+            "{}/b/{}/o?uploadType=multipart".format(settings.UPLOAD_API_ENDPOINT, BENCH_BUCKET),
+            body=body,
+            headers={"Content-Type": "multipart/related; boundary={}".format(boundary)},
+        )
+
+    def _seed(self, connection, names):
+        for i, name in enumerate(names):
+            self._upload(connection, name, self._content(self._small_content, i))
+
+    def prepare(self, workload, connection):
+        """Creates the objects the workload reads, this isn't timed"""
+
+        if workload in ("download", "list", "copy"):
+            self._seed(connection, self._seed_names)
+        elif workload == "delete":
+            self._seed(connection, self._delete_names)
+
+    def run_operation(self, workload, connection, i):
+        """Runs the i-th operation of the workload
+
+        Returns:
+            int -- Number of bytes of object content sent or received
+        """
+
+        if workload == "upload_small":
+            self._upload(connection, "small/object-{:06d}".format(i), self._content(self._small_content, i))
+            return self._small_size
+
+        if workload == "upload_large":
+            self._upload(connection, "large/object-{:06d}".format(i), self._content(self._large_content, i))
+            return self._large_size
+
+        if workload == "resumable_upload":
+            return self._resumable_upload(connection, "resumable/object-{:06d}".format(i), i)
+
+        seed_names = self._seed_names
+        if workload == "download":
+            _, data = self._request(
+                connection,
+                "GET",
+                "{}/b/{}/o/{}?alt=media".format(
+                    settings.DOWNLOAD_API_ENDPOINT, BENCH_BUCKET, quote(seed_names[i % len(seed_names)], safe="")
+                ),
+            )
+            return len(data)
+
+        if workload == "list":
+            self._request(
+                connection,
+                "GET",
+                "{}/b/{}/o?prefix=seed-{}/&maxResults=100".format(
+                    settings.API_ENDPOINT, BENCH_BUCKET, i % SEED_PREFIXES
+                ),
+            )
+            return 0
+
+        if workload == "copy":
+            self._request(
+                connection,
+                "POST",
+                "{}/copyTo/b/{}/o/{}".format(
+                    _object_path(BENCH_BUCKET, seed_names[i % len(seed_names)]),
+                    BENCH_BUCKET,
+                    quote("copy/object-{:06d}".format(i), safe=""),
+                ),
+            )
+            return 0
+
+        if workload == "delete":
+            self._request(connection, "DELETE", _object_path(BENCH_BUCKET, self._delete_names[i]), expected=(200, 204))
+            return 0
+
+        raise ValueError("Unknown workload '{}'".format(workload))
+
+    def _resumable_upload(self, connection, object_name, i):
+        response, _ = self._request(
+            connection,
+            "POST",
+            "{}/b/{}/o?uploadType=resumable".format(settings.UPLOAD_API_ENDPOINT, BENCH_BUCKET),
+            body=json.dumps({"name": object_name}).encode(),
+            headers={"Content-Type": "application/json; charset=UTF-8"},
+        )
+        location = urlparse(response.getheader("Location"))
+        session_path = "{}?{}".format(location.path, location.query)
+
+        content = self._content(self._large_content, i)
+        for first in range(0, len(content), RESUMABLE_CHUNK_SIZE):
+            chunk = content[first:first + RESUMABLE_CHUNK_SIZE]
+            last = first + len(chunk) - 1
+            self._request(
+                connection,
+                "PUT",
+                session_path,
+                body=chunk,
+                headers={"Content-Range": "bytes {}-{}/{}".format(first, last, len(content))},
+                expected=(200, 308),
+            )
+        return len(content)
+
+    def run_workload(self, workload):
+        """Runs the operations of the workload from the client threads
+
+        Returns:
+            dict -- Throughput and latency statistics of the workload
+        """
+
+        if workload == "routing":
+            # Measured in this process, the server isn't involved
+            return run_routing(self._routing_dispatches)
+        if workload == "startup":
+            # Measured in this process, over a storage of its own
+            return run_startup(self._startup_objects, self._metadata_backend, self._dedup)
+
+        connection = self._connect()
+        try:
+            self.prepare(workload, connection)
+        finally:
+            connection.close()
+
+        latencies = []
+        errors = []
+        transferred = [0]
+        next_operation = iter(range(self._requests))
+        lock = threading.Lock()
+
+        def client():
+            connection = self._connect()
+            try:
+                while True:
+                    with lock:
+                        i = next(next_operation, None)
+                    if i is None:
+                        return
+
+                    start = time.perf_counter()
+                    try:
+                        size = self.run_operation(workload, connection, i)
+                    except (BenchError, OSError, http.client.HTTPException) as e:
+                        connection.close()
+                        with lock:
+                            errors.append(str(e))
+                        continue
+                    latency = time.perf_counter() - start
+                    with lock:
+                        latencies.append(latency)
+                        transferred[0] += size
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=client) for _ in range(self._concurrency)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+
+        latencies.sort()
+        result = {
+            "operations": len(latencies),
+            "errors": len(errors),
+            "seconds": round(elapsed, 6),
+            "ops_per_sec": round(len(latencies) / elapsed, 2) if elapsed else None,
+            "mb_per_sec": round(transferred[0] / elapsed / 1e6, 2) if elapsed else None,
+            "latency_ms": {
+                "p{}".format(percentile): (
+                    round(_percentile(latencies, percentile) * 1000, 3) if latencies else None
+                )
+                for percentile in PERCENTILES
+            },
+        }
+        if errors:
+            result["first_error"] = errors[0]
+        return result
+
+    def run(self, workloads=WORKLOADS):
+        connection = self._connect()
+        try:
+            self._request(
+                connection,
+                "POST",
+                "{}/b".format(settings.API_ENDPOINT),
+                body=json.dumps({"name": BENCH_BUCKET}).encode(),
+                headers={"Content-Type": "application/json"},
+                expected=(200, 409),
+            )
+        finally:
+            connection.close()
+        return {workload: self.run_workload(workload) for workload in workloads}
+
+
+def run_benchmark(workloads=WORKLOADS, in_memory=False, workers=DEFAULT_WORKERS, processes=1, dedup=False,
+                  metadata_backend=JSON_BACKEND, host="localhost", concurrency=8, requests=200, small_size=1024,
+                  large_size=4 * 1024 * 1024, routing_dispatches=ROUTING_DISPATCHES, startup_objects=STARTUP_OBJECTS):
+    """Starts an emulator on a free port, with its own temporary storage, and benchmarks it
+
+    Returns:
+        dict -- The settings of the run, and the results by workload
+
+    Raises:
+        ValueError: If a workload is unknown
+    """
+
+    unknown = set(workloads) - set(WORKLOADS)
+    if unknown:
+        raise ValueError("Unknown workloads: {}".format(", ".join(sorted(unknown))))
+
+    data_dir = tempfile.mkdtemp(prefix="gcloud-storage-emulator-bench-")
+    port = _free_port(host)
+    server = create_server(
+        host,
+        port,
+        in_memory,
+        workers=workers,
+        dedup=dedup,
+        processes=processes,
+        metadata_backend=metadata_backend,
+        data_dir=data_dir,
+    )
+    server.start()
+    try:
+        benchmark = Benchmark(
+            host,
+            port,
+            concurrency=concurrency,
+            requests=requests,
+            small_size=small_size,
+            large_size=large_size,
+            routing_dispatches=routing_dispatches,
+            startup_objects=startup_objects,
+            metadata_backend=metadata_backend,
+            dedup=dedup,
+        )
+        results = benchmark.run(workloads)
+    finally:
+        server.stop()
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+    return {
+        "settings": {
+            "in_memory": in_memory,
+            "workers": workers,
+            "processes": processes,
+            "dedup": dedup,
+            "metadata": metadata_backend,
+            "concurrency": concurrency,
+            "requests": requests,
+            "small_size": small_size,
+            "large_size": large_size,
+            "routing_dispatches": routing_dispatches,
+            "startup_objects": startup_objects,
+        },
+        "workloads": results,
+    }
@@ -0,0 +1,620 @@
+import errno
+import hashlib
+import io
+import logging
+import os
+import shutil
+import stat
+import uuid
+from collections import namedtuple
+
+import fs
+from fs.errors import FileExpected, ResourceNotFound
+
+from gcloud_storage_emulator.checksums import Checksums
+from gcloud_storage_emulator.exceptions import NotFound
+
+logger = logging.getLogger(__name__)
+
+# Directory, within the storage fs, holding the files being written
+SPOOL_DIR = ".spool"
+
+# Prefix of the spool files holding the content received by resumable upload sessions
+UPLOAD_FILE_PREFIX = "upload-"
+
+# Directory, within the storage fs, holding the deduplicated contents
+BLOBS_DIR = ".blobs"
+
+# Size of the chunks in which streamed contents are copied
+COPY_CHUNK_SIZE = 1024 * 1024
+
+# Content written by a blob store but not visible as an object yet: `handle` is specific
+# to the blob store, `size` is the number of bytes written, `digest` the SHA-256 of the
+# content when it is deduplicated, and `checksums` the Object resource fields holding its
+# MD5 and CRC-32C
+SpooledBlob = namedtuple("SpooledBlob", ["handle", "size", "digest", "checksums"])
+
+
+def _iter_chunks(content):
+    """Yields the content in chunks, the content being either bytes or a readable binary file"""
+
+    if not hasattr(content, "read"):
+        if len(content):
+            yield content
+        return
+
+    while True:
+        chunk = content.read(COPY_CHUNK_SIZE)
+        if not chunk:
+            return
+        yield chunk
+
+
+def _fileno(file):
+    try:
+        return file.fileno()
+    except (AttributeError, io.UnsupportedOperation):
+        return None
+
+
+def _copy_file_range(source, destination):
+    """Copies the rest of the source file into the destination file, within the kernel
+
+    The content never goes through Python, and filesystems supporting reflinks (e.g. btrfs,
+    XFS) share the blocks instead of copying them.
+
+    Returns:
+        int -- Number of bytes copied, or None if the files can't be copied this way
+    """
+
+    source_fd, destination_fd = _fileno(source), _fileno(destination)
+    if not hasattr(os, "copy_file_range") or source_fd is None or destination_fd is None:
+        return None
+
+    source_stat = os.fstat(source_fd)
+    if not stat.S_ISREG(source_stat.st_mode):
+        return None
+
+    offset = source.tell()
+    size = source_stat.st_size - offset
+    copied = 0
+    while copied < size:
+        try:
+            count = os.copy_file_range(source_fd, destination_fd, size - copied, offset + copied, copied)
+        except OSError as e:
+            # Not supported by the kernel or between these filesystems
+            if copied == 0 and e.errno in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP):
+                return None
+            raise
+        if count == 0:
+            break
+        copied += count
+    return copied
+
+
+def _link_tree(source, destination, exclude=()):
+    """Recreates the files of a directory in another one as hard links
+
+    Links share the content of the files, so this only costs a few system calls per file
+    whatever their size. It is only correct for files which are never modified in place.
+    Files are copied when they can't be linked, e.g. across devices.
+
+    Arguments:
+        source {str} -- System path of the directory to link
+        destination {str} -- System path of the directory to create the links in
+
+    Keyword Arguments:
+        exclude {tuple} -- Paths, relative to `source`, of the files and directories to
+                           leave out (default: {()})
+    """
+
+    for directory, directory_names, file_names in os.walk(source):
+        relative_directory = os.path.relpath(directory, source)
+        directory_names[:] = [
+            name for name in directory_names
+            if os.path.normpath(os.path.join(relative_directory, name)) not in exclude
+        ]
+        os.makedirs(os.path.join(destination, relative_directory), exist_ok=True)
+        for file_name in file_names:
+            relative_path = os.path.normpath(os.path.join(relative_directory, file_name))
+            if relative_path in exclude:
+                continue
+
+            source_path = os.path.join(source, relative_path)
+            destination_path = os.path.join(destination, relative_path)
+            try:
+                os.link(source_path, destination_path)
+            except OSError:
+                shutil.copyfile(source_path, destination_path)
+
+
+class _Hashes(object):
+    """Hashes of a content fed chunk by chunk: its checksums and, to deduplicate it, its digest"""
+
+    def __init__(self, dedup=False):
+        self.size = 0
+        self._checksums = Checksums()
+        self._sha256 = hashlib.sha256() if dedup else None
+
+    def update(self, chunk):
+        self.size += len(chunk)
+        self._checksums.update(chunk)
+        if self._sha256 is not None:
+            self._sha256.update(chunk)
+
+    def checksums(self):
+        return self._checksums.to_dict()
+
+    def digest(self):
+        return self._sha256.hexdigest() if self._sha256 is not None else None
+
+
+def _copy_chunks(content, file, hashes=None):
+    """Writes the content into the file, feeding it to the hashes on the way
+
+    Returns:
+        int -- Number of bytes written
+    """
+
+    size = 0
+    for chunk in _iter_chunks(content):
+        file.write(chunk)
+        if hashes is not None:
+            hashes.update(chunk)
+        size += len(chunk)
+    return size
+
+
+class FSBlobStore(object):
+    """Stores object contents as files in a pyfilesystem, following the `bucket/object/name` tree
+
+    Files are written aside and moved into place once complete, so a file being read (e.g. by
+    a download streaming it) is never modified: overwriting an object replaces the file.
+
+    With `dedup`, contents are instead stored once under their SHA-256 digest in `.blobs`, and
+    shared by every object with the same content. `commit` then returns the digest, the blob
+    id the storage passes back to read or delete the object; the storage only deletes blobs
+    once no object references them anymore. Objects without a blob id are always read from
+    the tree, so dedup can be turned on for an existing storage.
+    """
+
+    def __init__(self, storage_fs, dedup=False):
+        self._fs = storage_fs
+        self._dedup = dedup
+        # Hashes of the content received by each resumable upload session
+        self._upload_hashes = {}
+
+    def _spool_path(self):
+        self._fs.makedir(SPOOL_DIR, recreate=True)
+        return fs.path.join(SPOOL_DIR, uuid.uuid4().hex)
+
+    def _blob_path(self, digest):
+        return fs.path.join(BLOBS_DIR, digest[:2], digest)
+
+    def _path(self, bucket_name, file_name, blob_id):
+        if blob_id is not None:
+            return self._blob_path(blob_id)
+        return fs.path.join(bucket_name, file_name)
+
+    def _blob_digest(self, content):
+        """Returns the digest of the content if it is one of the blobs, opened from the start"""
+
+        name = getattr(content, "name", None)
+        if not isinstance(name, (str, bytes)) or not hasattr(content, "tell") or content.tell() != 0:
+            return None
+        path = os.fsdecode(name)
+        digest = os.path.basename(path)
+        try:
+            if path != self._fs.getsyspath(self._blob_path(digest)):
+                return None
+        except (fs.errors.NoSysPath, ValueError):
+            return None
+        return digest
+
+    def spool(self, content, checksums=None):
+        """Writes the content aside, without making it visible as an object yet
+
+        Streamed contents are copied chunk by chunk, never held in memory as a whole, and
+        hashed on the way.
+
+        Arguments:
+            content {bytes|file} -- Content to write, as bytes or as a readable binary file
+
+        Keyword Arguments:
+            checksums {dict} -- Checksums of the content when they are known already, e.g.
+                                when copying an object. The content can then be copied by the
+                                kernel instead. (default: {None})
+
+        Returns:
+            SpooledBlob -- To be passed over to `commit` or `discard`
+        """
+
+        spool_path = self._spool_path()
+        if checksums is not None and self._dedup:
+            digest = self._blob_digest(content)
+            if digest is not None:
+                # Copying a blob: it is linked rather than copied, the link keeps it alive even
+                # if the source object is deleted before the copy is committed
+                os.link(self._fs.getsyspath(self._blob_path(digest)), self._fs.getsyspath(spool_path))
+                return SpooledBlob(spool_path, self._fs.getsize(spool_path), digest, checksums)
+
+        try:
+            with self._fs.openbin(spool_path, mode="w") as file:
+                if checksums is not None and not self._dedup and hasattr(content, "read"):
+                    copied = _copy_file_range(content, file)
+                    if copied is not None:
+                        return SpooledBlob(spool_path, copied, None, checksums)
+
+                hashes = _Hashes(self._dedup)
+                size = _copy_chunks(content, file, hashes)
+        except Exception:
+            self._fs.remove(spool_path)
+            raise
+        return SpooledBlob(spool_path, size, hashes.digest(), hashes.checksums())
+
+    def commit(self, spooled, bucket_name, file_name):
+        """Moves spooled content into place, replacing the object if it exists
+
+        Returns:
+            str -- The blob id of the object, None if it isn't deduplicated
+        """
+
+        if spooled.digest is None:
+            path = fs.path.join(bucket_name, file_name)
+            self._fs.makedirs(fs.path.dirname(path), recreate=True)
+            self._fs.move(spooled.handle, path, overwrite=True)
+            return None
+
+        path = self._blob_path(spooled.digest)
+        if self._fs.exists(path):
+            self._fs.remove(spooled.handle)
+        else:
+            self._fs.makedirs(fs.path.dirname(path), recreate=True)
+            self._fs.move(spooled.handle, path)
+        return spooled.digest
+
+    def discard(self, spooled):
+        try:
+            self._fs.remove(spooled.handle)
+        except ResourceNotFound:
+            pass
+
+    def write(self, bucket_name, file_name, content):
+        spooled = self.spool(content)
+        self.commit(spooled, bucket_name, file_name)
+        return spooled.size
+
+    def _upload_path(self, upload_id):
+        # Upload ids contain the object name, which isn't a valid file name
+        digest = hashlib.sha1(upload_id.encode("utf-8")).hexdigest()
+        return fs.path.join(SPOOL_DIR, UPLOAD_FILE_PREFIX + digest)
+
+    def append_upload(self, upload_id, content):
+        """Appends a chunk to the content received so far by a resumable upload session
+
+        The session's content is kept in a spool file, so it survives restarts. It is hashed
+        as it is received, so finishing the upload doesn't read it again.
+
+        Arguments:
+            upload_id {str} -- Id of the resumable upload session
+            content {bytes|file} -- Chunk to append, as bytes or as a readable binary file
+
+        Returns:
+            int -- Number of bytes received by the session so far
+        """
+
+        self._fs.makedir(SPOOL_DIR, recreate=True)
+        path = self._upload_path(upload_id)
+        hashes = self._upload_hashes.pop(upload_id, None)
+        if hashes is not None and hashes.size != self.upload_size(upload_id):
+            # The hashes of the session were lost, e.g. by a restart: it is hashed when finished
+            hashes = None
+        elif hashes is None and self.upload_size(upload_id) == 0:
+            hashes = _Hashes(self._dedup)
+
+        with self._fs.openbin(path, mode="a") as file:
+            _copy_chunks(content, file, hashes)
+
+        size = self._fs.getsize(path)
+        if hashes is not None:
+            self._upload_hashes[upload_id] = hashes
+        return size
+
+    def truncate_upload(self, upload_id, size):
+        """Drops what a resumable upload session received past the given size, e.g. a rejected chunk"""
+
+        # The hashes can't be rolled back, they are computed again when the upload is finished
+        self._upload_hashes.pop(upload_id, None)
+        try:
+            with self._fs.openbin(self._upload_path(upload_id), mode="r+") as file:
+                file.truncate(size)
+        except ResourceNotFound:
+            pass
+
+    def upload_size(self, upload_id):
+        try:
+            return self._fs.getsize(self._upload_path(upload_id))
+        except ResourceNotFound:
+            return 0
+
+    def upload_blob(self, upload_id):
+        """Returns the content received by a resumable upload session, ready to be committed
+
+        Returns:
+            SpooledBlob -- To be passed over to `commit` or `discard`
+        """
+
+        self._fs.makedir(SPOOL_DIR, recreate=True)
+        path = self._upload_path(upload_id)
+        if not self._fs.exists(path):
+            self._fs.create(path)
+
+        size = self._fs.getsize(path)
+        hashes = self._upload_hashes.pop(upload_id, None)
+        if hashes is None or hashes.size != size:
+            hashes = _Hashes(self._dedup)
+            with self._fs.openbin(path, mode="r") as file:
+                for chunk in _iter_chunks(file):
+                    hashes.update(chunk)
+        return SpooledBlob(path, size, hashes.digest(), hashes.checksums())
+
+    def read(self, bucket_name, file_name, blob_id=None):
+        try:
+            with self._fs.openbin(self._path(bucket_name, file_name, blob_id), mode="r") as file:
+                return file.read()
+        except (FileExpected, ResourceNotFound) as e:
+            logger.error("Resource not found:")
+            logger.error(e)
+            raise NotFound
+
+    def open(self, bucket_name, file_name, blob_id=None):
+        """Opens an object for reading, the returned file can be used with `os.sendfile`"""
+
+        try:
+            return self._fs.openbin(self._path(bucket_name, file_name, blob_id), mode="r")
+        except (FileExpected, ResourceNotFound):
+            raise NotFound
+
+    def delete(self, bucket_name, file_name, blob_id=None):
+        if blob_id is not None:
+            try:
+                self._fs.remove(self._blob_path(blob_id))
+            except ResourceNotFound:
+                logger.info("No blob to remove '{}'".format(blob_id))
+            return
+
+        try:
+            with self._fs.opendir(bucket_name) as bucket_dir:
+                bucket_dir.remove(file_name)
+        except ResourceNotFound:
+            logger.info("No file to remove '{}/{}'".format(bucket_name, file_name))
+
+    def delete_bucket(self, bucket_name):
+        try:
+            self._fs.removetree(bucket_name)
+        except ResourceNotFound:
+            logger.info("No folder to remove '{}'".format(bucket_name))
+
+    def snapshot(self, directory, exclude=()):
+        """Saves the files of the storage into a directory, to be restored later
+
+        Files are linked rather than copied, as they are never modified in place: they are
+        replaced by new ones. Only the content of the resumable upload sessions, which grows
+        in place, is copied. Files being written aren't part of any object yet, they are
+        left out.
+
+        Arguments:
+            directory {str} -- System path of the snapshot directory, which must not exist
+
+        Keyword Arguments:
+            exclude {tuple} -- Paths of other files to leave out (default: {()})
+        """
+
+        root = self._fs.getsyspath("/")
+        _link_tree(root, directory, exclude=(SPOOL_DIR,) + tuple(exclude))
+        self._copy_uploads(root, directory)
+
+    def restore(self, directory, exclude=()):
+        """Replaces all the files of the storage by the ones of a snapshot
+
+        Arguments:
+            directory {str} -- System path of a directory written by `snapshot`
+
+        Keyword Arguments:
+            exclude {tuple} -- Paths of files to leave alone, in the storage and in the
+                               snapshot (default: {()})
+        """
+
+        self.wipe(exclude=exclude)
+        root = self._fs.getsyspath("/")
+        _link_tree(directory, root, exclude=(SPOOL_DIR,) + tuple(exclude))
+        self._copy_uploads(directory, root)
+
+    def _copy_uploads(self, source, destination):
+        spool_dir = os.path.join(source, SPOOL_DIR)
+        if not os.path.isdir(spool_dir):
+            return
+
+        os.makedirs(os.path.join(destination, SPOOL_DIR), exist_ok=True)
+        for file_name in os.listdir(spool_dir):
+            if file_name.startswith(UPLOAD_FILE_PREFIX):
+                shutil.copyfile(os.path.join(spool_dir, file_name), os.path.join(destination, SPOOL_DIR, file_name))
+
+    def wipe(self, exclude=()):
+        self._upload_hashes = {}
+        try:
+            for path in self._fs.listdir('.'):
+                if path in exclude:
+                    continue
+                if self._fs.isdir(path):
+                    self._fs.removetree(path)
+                else:
+                    self._fs.remove(path)
+        except ResourceNotFound as e:
+            logger.warning(e)
+
+
+class MemoryBlobStore(object):
+    """Keeps object contents in memory as immutable bytes, without ever touching the disk
+
+    Contents are stored as given and handed out as-is, so reading an object never copies it.
+    Snapshots share the contents of each bucket with the live store, which copies those of a
+    bucket the first time it changes it.
+    """
+
+    def __init__(self):
+        self._blobs = {}
+        # Buckets whose contents are shared with a snapshot
+        self._shared = set()
+        # Content received by the resumable upload sessions and its hashes, by upload id
+        self._uploads = {}
+
+    def spool(self, content, checksums=None):
+        if isinstance(content, MemoryFile) and content.tell() == 0 and checksums is not None:
+            # Objects being copied share the same immutable bytes
+            return SpooledBlob(content._content, len(content._content), None, checksums)
+
+        hashes = _Hashes()
+        if hasattr(content, "read"):
+            buffer = io.BytesIO()
+            _copy_chunks(content, buffer, hashes)
+            content = buffer.getvalue()
+        else:
+            # bytes() is a no-op on bytes, it only copies mutable buffers so they can't change under us
+            content = bytes(content)
+            hashes.update(content)
+        return SpooledBlob(content, len(content), None, hashes.checksums())
+
+    def _own_bucket(self, bucket_name):
+        if bucket_name in self._shared:
+            self._shared.discard(bucket_name)
+            self._blobs[bucket_name] = dict(self._blobs[bucket_name])
+
+    def commit(self, spooled, bucket_name, file_name):
+        self._own_bucket(bucket_name)
+        self._blobs.setdefault(bucket_name, {})[file_name] = spooled.handle
+        return None
+
+    def discard(self, spooled):
+        pass
+
+    def write(self, bucket_name, file_name, content):
+        spooled = self.spool(content)
+        self.commit(spooled, bucket_name, file_name)
+        return spooled.size
+
+    def append_upload(self, upload_id, content):
+        if upload_id not in self._uploads:
+            self._uploads[upload_id] = (io.BytesIO(), _Hashes())
+        buffer, hashes = self._uploads[upload_id]
+        buffer.seek(0, io.SEEK_END)
+        _copy_chunks(content, buffer, hashes)
+        return buffer.tell()
+
+    def truncate_upload(self, upload_id, size):
+        if upload_id not in self._uploads:
+            return
+        buffer, _ = self._uploads[upload_id]
+        buffer.truncate(size)
+        # The hashes can't be rolled back, fresh ones no longer match the content and are
+        # computed again when the upload is finished
+        self._uploads[upload_id] = (buffer, _Hashes())
+
+    def upload_size(self, upload_id):
+        if upload_id not in self._uploads:
+            return 0
+        return self._uploads[upload_id][0].seek(0, io.SEEK_END)
+
+    def upload_blob(self, upload_id):
+        buffer, hashes = self._uploads.pop(upload_id, (io.BytesIO(), _Hashes()))
+        content = buffer.getvalue()
+        if hashes.size != len(content):
+            # A chunk was only partly written
+            hashes = _Hashes()
+            hashes.update(content)
+        return SpooledBlob(content, len(content), None, hashes.checksums())
+
+    def read(self, bucket_name, file_name, blob_id=None):
+        try:
+            return self._blobs[bucket_name][file_name]
+        except KeyError:
+            raise NotFound
+
+    def open(self, bucket_name, file_name, blob_id=None):
+        return MemoryFile(self.read(bucket_name, file_name))
+
+    def delete(self, bucket_name, file_name, blob_id=None):
+        self._own_bucket(bucket_name)
+        self._blobs.get(bucket_name, {}).pop(file_name, None)
+
+    def delete_bucket(self, bucket_name):
+        self._shared.discard(bucket_name)
+        self._blobs.pop(bucket_name, None)
+
+    def snapshot(self):
+        """Returns a copy of the contents, to be passed over to `restore` later
+
+        Contents are immutable, and the dicts pointing at them are shared until changed, so
+        the cost depends on the number of buckets rather than of objects.
+        """
+
+        self._shared = set(self._blobs)
+        return (
+            dict(self._blobs),
+            {upload_id: buffer.getvalue() for upload_id, (buffer, _) in self._uploads.items()},
+        )
+
+    def restore(self, snapshot):
+        blobs, uploads = snapshot
+        self._blobs = dict(blobs)
+        self._shared = set(blobs)
+        self._uploads = {}
+        for upload_id, content in uploads.items():
+            self.append_upload(upload_id, content)
+
+    def wipe(self, exclude=()):
+        self._blobs = {}
+        self._shared = set()
+        self._uploads = {}
+
+
+class MemoryFile(object):
+    """Read-only file over an in-memory blob
+
+    Reads return memoryview slices of the blob, so streaming it never copies the content.
+    """
+
+    def __init__(self, content):
+        self._content = content
+        self._view = memoryview(content)
+        self._position = 0
+
+    def read(self, size=-1):
+        start = self._position
+        end = len(self._view)
+        if size is not None and size >= 0:
+            end = min(start + size, end)
+        self._position = max(start, end)
+        return self._view[start:end]
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            offset += len(self._view)
+        if offset < 0:
+            raise ValueError("Negative seek position {}".format(offset))
+        self._position = offset
+        return offset
+
+    def tell(self):
+        return self._position
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
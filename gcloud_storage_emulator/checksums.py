@@ -0,0 +1,95 @@
+import base64
+import hashlib
+import struct
+
+try:
+    import google_crc32c
+except ImportError:  # pragma: no cover
+    google_crc32c = None
+
+# Fields of the GCS Object resource holding the checksums of its content
+CHECKSUM_FIELDS = ("md5Hash", "crc32c")
+
+# google-crc32c falls back to a pure Python implementation when its C extension can't be
+# built, the table below is just as fast
+_USE_C_EXTENSION = google_crc32c is not None and getattr(google_crc32c, "implementation", None) == "c"
+
+# CRC-32C (Castagnoli), reversed polynomial
+_CRC32C_POLYNOMIAL = 0x82F63B78
+
+
+def _make_crc32c_table():
+    table = []
+    for byte in range(256):
+        crc = byte
+        for _ in range(8):
+            crc = (crc >> 1) ^ _CRC32C_POLYNOMIAL if crc & 1 else crc >> 1
+        table.append(crc)
+    return table
+
+
+_CRC32C_TABLE = _make_crc32c_table()
+
+
+def crc32c_update(crc, data):
+    """Extends a CRC-32C with more data, using a lookup table
+
+    Arguments:
+        crc {int} -- CRC-32C of the data so far, 0 to start
+        data {bytes} -- The data to add
+
+    Returns:
+        int -- CRC-32C of the data so far, followed by `data`
+    """
+
+    table = _CRC32C_TABLE
+    crc ^= 0xFFFFFFFF
+    for byte in memoryview(data).cast("B"):
+        crc = table[(crc ^ byte) & 0xFF] ^ (crc >> 8)
+    return crc ^ 0xFFFFFFFF
+
+
+class Checksums(object):
+    """Computes the MD5 and CRC-32C of a content fed chunk by chunk, as GCS reports them"""
+
+    def __init__(self):
+        self._md5 = hashlib.md5()
+        self._crc32c = google_crc32c.Checksum() if _USE_C_EXTENSION else 0
+
+    def update(self, chunk):
+        self._md5.update(chunk)
+        if _USE_C_EXTENSION:
+            # The extension only takes bytes, not other buffers such as memoryviews
+            self._crc32c.update(chunk if isinstance(chunk, bytes) else bytes(chunk))
+        else:
+            self._crc32c = crc32c_update(self._crc32c, chunk)
+
+    def to_dict(self):
+        """Returns the checksums as the fields of a GCS Object resource (base64 encoded)"""
+
+        if _USE_C_EXTENSION:
+            crc32c = self._crc32c.digest()
+        else:
+            crc32c = struct.pack(">I", self._crc32c)
+
+        return {
+            "md5Hash": base64.b64encode(self._md5.digest()).decode("ascii"),
+            "crc32c": base64.b64encode(crc32c).decode("ascii"),
+        }
+
+
+def from_resource(file_obj):
+    """Returns the checksums of a GCS Object resource, or None if it doesn't have them all"""
+
+    if not all(field in file_obj for field in CHECKSUM_FIELDS):
+        return None
+    return {field: file_obj[field] for field in CHECKSUM_FIELDS}
+
+
+def goog_hash_header(file_obj):
+    """Formats the checksums of a GCS Object resource as an `x-goog-hash` header value"""
+
+    checksums = from_resource(file_obj)
+    if checksums is None:
+        return None
+    return "crc32c={},md5={}".format(checksums["crc32c"], checksums["md5Hash"])
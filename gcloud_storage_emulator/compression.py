@@ -0,0 +1,187 @@
+import hashlib
+import io
+import threading
+import zlib
+from collections import OrderedDict
+
+GZIP = "gzip"
+
+# JSON bodies smaller than this are sent as is, compressing them saves less than it costs
+MIN_COMPRESSED_SIZE = 1024
+
+# Trades a little of the ratio for speed, JSON listings compress well at any level
+COMPRESSION_LEVEL = 5
+
+# Total size of the compressed bodies kept by a CompressionCache
+DEFAULT_CACHE_SIZE = 32 * 1024 * 1024
+
+# Window bits for zlib to read and write the gzip format, rather than the zlib one
+_GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+
+def accepts_gzip(accept_encoding):
+    """Whether an `Accept-Encoding` header allows a gzip response
+
+    Arguments:
+        accept_encoding {str} -- Value of the header, or None if there is none
+
+    Returns:
+        bool -- True if gzip (or any encoding) is accepted with a non-zero quality
+    """
+
+    if not accept_encoding:
+        return False
+
+    accepted = None
+    for coding in accept_encoding.split(","):
+        name, _, params = coding.partition(";")
+        name = name.strip().lower()
+        if name not in (GZIP, "x-gzip", "*"):
+            continue
+
+        quality = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        # An explicit gzip entry takes precedence over the wildcard one
+        if name != "*" or accepted is None:
+            accepted = quality > 0
+    return bool(accepted)
+
+
+def compress(data):
+    """Compresses bytes in the gzip format
+
+    The output only depends on the input (no timestamp in the header), so that identical
+    bodies get identical compressed forms.
+    """
+
+    compressor = zlib.compressobj(COMPRESSION_LEVEL, zlib.DEFLATED, _GZIP_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+class CompressionCache(object):
+    """Least recently used cache of the compressed forms of response bodies
+
+    Bodies are looked up by digest: a listing served again unchanged reuses its compressed
+    form, whatever changed in the storage in between, without any invalidation.
+
+    Keyword Arguments:
+        max_size {int} -- Total size in bytes of the compressed bodies kept (default: {DEFAULT_CACHE_SIZE})
+    """
+
+    def __init__(self, max_size=DEFAULT_CACHE_SIZE):
+        self._lock = threading.Lock()
+        self._max_size = max_size
+        self._size = 0
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def compress(self, data):
+        """Returns the gzip compressed form of the bytes, from the cache if it's there"""
+
+        key = hashlib.sha1(data).digest()
+        with self._lock:
+            compressed = self._entries.get(key)
+            if compressed is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return compressed
+            self.misses += 1
+
+        compressed = compress(data)
+        if len(compressed) > self._max_size:
+            return compressed
+
+        with self._lock:
+            if key not in self._entries:
+                self._entries[key] = compressed
+                self._size += len(compressed)
+                while self._size > self._max_size:
+                    _, evicted = self._entries.popitem(last=False)
+                    self._size -= len(evicted)
+        return compressed
+
+
+def is_gzip(file):
+    """Whether a binary file holds complete gzip members, and nothing else
+
+    The file is read from its current position to its end. The content is decompressed and
+    dropped as it goes, a chunk of input at a time.
+
+    Returns:
+        bool -- False if the content is corrupt, truncated, or followed by data which isn't gzip
+    """
+
+    decompressor = zlib.decompressobj(_GZIP_WBITS)
+    data = b""
+    while True:
+        if not data:
+            data = file.read(io.DEFAULT_BUFFER_SIZE)
+            if not data:
+                return decompressor.eof
+        if decompressor.eof:
+            # What follows a member must be another member
+            decompressor = zlib.decompressobj(_GZIP_WBITS)
+        try:
+            decompressor.decompress(data)
+        except zlib.error:
+            return False
+        data = decompressor.unused_data
+
+
+class GunzipStream(io.RawIOBase):
+    """Reads a gzip compressed binary file decompressed, the file is closed along with it
+
+    Unlike `gzip.GzipFile`, it can't seek: responses stream it with chunked encoding instead
+    of decompressing it twice to know its length. A corrupt file raises `zlib.error` once it is
+    reached, check it with `is_gzip` first.
+    """
+
+    def __init__(self, file):
+        super().__init__()
+        self._file = file
+        self._decompressor = zlib.decompressobj(_GZIP_WBITS)
+        # Input read past the end of a gzip member, the start of the next one
+        self._unused = b""
+        self._eof = False
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            return b"".join(iter(lambda: self.read(io.DEFAULT_BUFFER_SIZE), b""))
+        if size == 0:
+            return b""
+
+        while not self._eof:
+            data = self._unused or self._decompressor.unconsumed_tail
+            self._unused = b""
+            if not data:
+                data = self._file.read(io.DEFAULT_BUFFER_SIZE)
+                if not data:
+                    self._eof = True
+                    break
+            chunk = self._decompressor.decompress(data, size)
+            if self._decompressor.eof:
+                # Concatenated gzip members are decompressed one after the other
+                self._unused = self._decompressor.unused_data
+                self._decompressor = zlib.decompressobj(_GZIP_WBITS)
+            if chunk:
+                return chunk
+        return b""
+
+    def readinto(self, buffer):
+        data = self.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def close(self):
+        if not self.closed:
+            self._file.close()
+        super().close()
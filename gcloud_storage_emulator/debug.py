@@ -0,0 +1,247 @@
+import contextlib
+import cProfile
+import io
+import linecache
+import marshal
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+
+# Prefix of the names of the threads serving requests, see ThreadPoolHTTPServer
+WORKER_THREAD_PREFIX = "api-worker"
+
+# Seconds between two samples of the worker thread stacks
+SAMPLE_INTERVAL = 0.005
+
+# Longest profile that can be asked for, it holds a worker meanwhile
+MAX_PROFILE_SECONDS = 30
+
+# Held by the debug request lasting a while (profile, heap growth) being served
+_exclusive_lock = threading.Lock()
+
+# Number of frames kept by tracemalloc for each allocation
+TRACEMALLOC_FRAMES = 1
+
+
+@contextlib.contextmanager
+def exclusive():
+    """Runs a debug request lasting a while, unless another one is being served
+
+    Each of them holds a worker of the server, only one at a time can, so that they can't
+    take the workers serving the other requests.
+
+    Raises:
+        RuntimeError: If another one is being served
+    """
+
+    if not _exclusive_lock.acquire(blocking=False):
+        raise RuntimeError("Another debug request is in progress")
+    try:
+        yield
+    finally:
+        _exclusive_lock.release()
+
+
+class RequestProfiler(object):
+    """Profiles with cProfile the requests served while it is started
+
+    cProfile only sees the thread it is enabled in, so each request is profiled by its own
+    profiler, whose stats are added up once the request is served.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._stats = None
+        self.active = False
+
+    def start(self):
+        """Starts profiling the requests
+
+        Raises:
+            RuntimeError: If the requests are already being profiled
+        """
+
+        with self._lock:
+            if self.active:
+                raise RuntimeError("Requests are already being profiled")
+            self._stats = None
+            self.active = True
+
+    def stop(self):
+        """Stops profiling the requests
+
+        Returns:
+            pstats.Stats -- The stats of the requests served since `start`, or None if none was
+        """
+
+        with self._lock:
+            self.active = False
+            stats, self._stats = self._stats, None
+        return stats
+
+    def run(self, function, *args):
+        """Calls the function, profiling it if requests are being profiled"""
+
+        # Sub-requests (e.g. of a batch) are profiled along with their parent: a second
+        # profiler enabled in the same thread would take over from the first
+        if not self.active or getattr(self._local, "profiling", False):
+            return function(*args)
+
+        profile = cProfile.Profile()
+        self._local.profiling = True
+        try:
+            return profile.runcall(function, *args)
+        finally:
+            self._local.profiling = False
+            stats = pstats.Stats(profile)
+            with self._lock:
+                if self.active:
+                    if self._stats is None:
+                        self._stats = stats
+                    else:
+                        self._stats.add(stats)
+
+
+def format_stats(stats, limit=50):
+    """Returns the text report of the stats, sorted by cumulative time"""
+
+    output = io.StringIO()
+    if stats is None:
+        output.write("No request was served\n")
+        return output.getvalue()
+
+    stats.stream = output
+    stats.sort_stats("cumulative").print_stats(limit)
+    return output.getvalue()
+
+
+def dump_stats(stats):
+    """Returns the stats serialized like `pstats.Stats.dump_stats` would write them"""
+
+    if stats is None:
+        return marshal.dumps({})
+    return marshal.dumps(stats.stats)
+
+
+def _frame_label(frame):
+    code = frame.f_code
+    return "{} ({}:{})".format(code.co_name, os.path.basename(code.co_filename), code.co_firstlineno)
+
+
+def _is_idle(frame):
+    # Idle workers wait for work in the loop of the thread pool
+    code = frame.f_code
+    return code.co_name == "_worker" and code.co_filename.endswith(os.path.join("concurrent", "futures", "thread.py"))
+
+
+def sample_stacks(seconds, interval=SAMPLE_INTERVAL):
+    """Samples the stacks of the worker threads for a while
+
+    Arguments:
+        seconds {float} -- How long to sample for
+
+    Keyword Arguments:
+        interval {float} -- Seconds between two samples (default: {SAMPLE_INTERVAL})
+
+    Returns:
+        str -- The stacks in the collapsed format of flamegraph.pl (one "outer;...;inner count"
+               line per stack), idle workers left out
+    """
+
+    current = threading.get_ident()
+    counts = {}
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        workers = {
+            thread.ident
+            for thread in threading.enumerate()
+            if thread.name.startswith(WORKER_THREAD_PREFIX) and thread.ident != current
+        }
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id not in workers or _is_idle(frame):
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(_frame_label(frame))
+                frame = frame.f_back
+            key = ";".join(reversed(stack))
+            counts[key] = counts.get(key, 0) + 1
+        time.sleep(interval)
+
+    return "".join(
+        "{} {}\n".format(stack, count)
+        for stack, count in sorted(counts.items(), key=lambda item: item[1], reverse=True)
+    )
+
+
+def start_tracing_allocations():
+    """Starts tracing memory allocations, if not done yet
+
+    Returns:
+        bool -- Whether tracing was started by this call
+    """
+
+    if tracemalloc.is_tracing():
+        return False
+    tracemalloc.start(TRACEMALLOC_FRAMES)
+    return True
+
+
+def stop_tracing_allocations():
+    """Stops tracing memory allocations, which slows every allocation down meanwhile"""
+
+    tracemalloc.stop()
+
+
+def _format_size(size):
+    for unit in ("B", "KiB", "MiB"):
+        if abs(size) < 1024:
+            return "{:.1f} {}".format(size, unit)
+        size /= 1024.0
+    return "{:.1f} GiB".format(size)
+
+
+def heap_report(limit=25, seconds=0):
+    """Reports the source lines which allocated the most memory still in use
+
+    Arguments:
+        limit {int} -- Number of lines to report
+        seconds {float} -- When positive, the growth over that many seconds is reported instead
+
+    Returns:
+        str -- The report
+    """
+
+    filters = (
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, linecache.__file__),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    )
+    snapshot = tracemalloc.take_snapshot().filter_traces(filters)
+    current, peak = tracemalloc.get_traced_memory()
+    lines = ["{} traced, {} at peak".format(_format_size(current), _format_size(peak))]
+
+    if seconds > 0:
+        time.sleep(seconds)
+        later = tracemalloc.take_snapshot().filter_traces(filters)
+        lines.append("Top {} growths over {}s".format(limit, seconds))
+        for diff in later.compare_to(snapshot, "lineno")[:limit]:
+            frame = diff.traceback[0]
+            lines.append("{:>12} {:>+10} blocks  {}:{}".format(
+                ("+" if diff.size_diff >= 0 else "") + _format_size(diff.size_diff),
+                diff.count_diff,
+                frame.filename,
+                frame.lineno,
+            ))
+    else:
+        lines.append("Top {} allocations".format(limit))
+        for stat in snapshot.statistics("lineno")[:limit]:
+            frame = stat.traceback[0]
+            lines.append("{:>12} {:>10} blocks  {}:{}".format(
+                _format_size(stat.size), stat.count, frame.filename, frame.lineno
+            ))
+    return "\n".join(lines) + "\n"
@@ -4,3 +4,15 @@ class NotFound(Exception):
 
 class Conflict(Exception):
     pass
+
+
+class PreconditionFailed(Exception):
+    """A precondition of the request doesn't hold, e.g. `ifGenerationMatch`
+
+    Arguments:
+        parameter {str} -- Name of the precondition which failed
+    """
+
+    def __init__(self, parameter):
+        super().__init__("Precondition '{}' failed".format(parameter))
+        self.parameter = parameter
@@ -0,0 +1,141 @@
+import email.parser
+import logging
+import os
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+from urllib.parse import urlparse
+
+from gcloud_storage_emulator import settings
+
+logger = logging.getLogger("api.batch")
+
+# Maximum number of requests in a single batch, as enforced by GCS
+MAX_BATCH_REQUESTS = 100
+
+# Maximum size of the body of a batch request. Batches only hold metadata requests, so
+# the body is read in memory.
+MAX_BATCH_SIZE = 10 * 1024 * 1024
+
+# Number of requests of the batches run concurrently. They have their own pool, as a batch
+# waiting for its requests in the pool of the server could starve it.
+BATCH_WORKERS = 8
+
+_executor = None
+_executor_pid = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor():
+    # The pool is created by each process: the threads of a pool aren't copied along with it
+    # when the server forks its worker processes
+    global _executor, _executor_pid
+
+    with _executor_lock:
+        if _executor is None or _executor_pid != os.getpid():
+            _executor = ThreadPoolExecutor(max_workers=BATCH_WORKERS, thread_name_prefix="batch-worker")
+            _executor_pid = os.getpid()
+        return _executor
+
+
+def _parse_batch(content_type, body):
+    """Splits the multipart/mixed body of a batch into the requests it holds
+
+    Raises:
+        ValueError: If the body isn't a valid batch
+
+    Returns:
+        list -- (Content-ID, method, path, headers, body) tuple of each request
+    """
+
+    message = email.parser.BytesParser().parsebytes(
+        b"Content-Type: " + content_type.encode("latin-1") + b"\r\n\r\n" + body
+    )
+    if not message.is_multipart():
+        raise ValueError("Batch requests must be multipart")
+
+    parts = message.get_payload()
+    if len(parts) > MAX_BATCH_REQUESTS:
+        raise ValueError("Too many requests in the batch, the maximum is {}".format(MAX_BATCH_REQUESTS))
+
+    requests = []
+    for part in parts:
+        payload = part.get_payload(decode=True) or b""
+        request_line, _, rest = payload.partition(b"\n")
+        try:
+            method, uri, _ = request_line.decode("ascii").strip().split(" ", 2)
+        except (UnicodeError, ValueError):
+            raise ValueError("Invalid request in the batch: '{}'".format(request_line))
+
+        request_message = email.parser.BytesParser().parsebytes(rest)
+        url = urlparse(uri)
+        path = url.path + ("?" + url.query if url.query else "")
+        if path.startswith(settings.BATCH_API_ENDPOINT):
+            raise ValueError("Batch requests can't be nested")
+
+        requests.append((
+            part.get("Content-ID"),
+            method,
+            path,
+            request_message,
+            request_message.get_payload(decode=True) or b"",
+        ))
+    return requests
+
+
+def _format_part(content_id, status, headers, body):
+    status = HTTPStatus(status)
+    lines = [
+        "Content-Type: application/http",
+        "Content-ID: {}".format(content_id),
+        "",
+        "HTTP/1.1 {} {}".format(status.value, status.phrase),
+    ]
+    lines.extend("{}: {}".format(key, value) for key, value in headers)
+    lines.extend(["", ""])
+    return "\r\n".join(lines).encode("utf-8") + body
+
+
+def batch(request, response, storage, *args, **kwargs):
+    """Runs the requests of a batch (https://cloud.google.com/storage/docs/batch)
+
+    Every request goes through the router like any other, they are run concurrently and
+    their responses are sent back in the order of the batch.
+    """
+
+    content_type = request.get_header("Content-Type", "")
+    if not content_type.startswith("multipart/"):
+        response.status = HTTPStatus.BAD_REQUEST
+        return
+
+    body = request.body.read(MAX_BATCH_SIZE + 1)
+    if len(body) > MAX_BATCH_SIZE:
+        response.status = HTTPStatus.REQUEST_ENTITY_TOO_LARGE
+        return
+
+    try:
+        requests = _parse_batch(content_type, body)
+    except ValueError as e:
+        logger.error(e)
+        response.status = HTTPStatus.BAD_REQUEST
+        return
+
+    executor = _get_executor()
+    futures = [
+        executor.submit(request.dispatch, method, path, headers, sub_body)
+        for _, method, path, headers, sub_body in requests
+    ]
+
+    boundary = "batch_{}".format(uuid.uuid4().hex)
+    parts = []
+    for i, ((content_id, _, _, _, _), future) in enumerate(zip(requests, futures)):
+        if content_id:
+            content_id = "<response-{}>".format(content_id.strip("<>"))
+        else:
+            content_id = "<response-{}>".format(i + 1)
+        parts.append(_format_part(content_id, *future.result()))
+
+    delimiter = "--{}".format(boundary).encode("ascii")
+    content = b"".join(delimiter + b"\r\n" + part + b"\r\n" for part in parts) + delimiter + b"--\r\n"
+    response.write_file(content, content_type="multipart/mixed; boundary={}".format(boundary))
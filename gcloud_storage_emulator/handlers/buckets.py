@@ -64,27 +64,41 @@ def _make_bucket_resource(bucket_name):
 
 def get(request, response, storage, *args, **kwargs):
     name = request.params.get("bucket_name")
-    if name and storage.buckets.get(name):
-        response.json(storage.buckets.get(name))
+    bucket = storage.get_bucket(name) if name else None
+    if bucket:
+        response.json(bucket)
     else:
         response.status = HTTPStatus.NOT_FOUND
 
 
 def ls(request, response, storage, *args, **kwargs):
     logger.info("[BUCKETS] List received")
-    response.json({
+    prefix = request.query.get("prefix")[0] if request.query.get("prefix") else None
+    page_token = request.query.get("pageToken")[0] if request.query.get("pageToken") else None
+    try:
+        max_results = min(int(request.query.get("maxResults", [settings.MAX_RESULTS])[0]), settings.MAX_RESULTS)
+        if max_results < 1:
+            raise ValueError
+        bucket_list, next_page_token = storage.get_bucket_list(prefix, max_results, page_token)
+    except ValueError:
+        response.status = HTTPStatus.BAD_REQUEST
+        return
+
+    result = {
         "kind": "storage#buckets",
-        "items": list(storage.buckets.values()),
-    })
+        "items": bucket_list,
+    }
+    if next_page_token:
+        result["nextPageToken"] = next_page_token
+    response.json(result)
 
 
 def create_bucket(name, storage):
-    if storage.get_bucket(name):
+    bucket = _make_bucket_resource(name)
+    try:
+        return storage.create_bucket(name, bucket)
+    except Conflict:
         return False
-    else:
-        bucket = _make_bucket_resource(name)
-        storage.create_bucket(name, bucket)
-        return bucket
 
 
 def insert(request, response, storage, *args, **kwargs):
@@ -96,8 +110,6 @@ def insert(request, response, storage, *args, **kwargs):
             response.status = HTTPStatus.CONFLICT
             response.json(CONFLICT)
         else:
-            bucket = _make_bucket_resource(name)
-            storage.create_bucket(name, bucket)
             response.json(bucket)
     else:
         response.status = HTTPStatus.BAD_REQUEST
@@ -1,17 +1,30 @@
-import math
+import io
+import logging
+import re
 import time
 import urllib.parse
 from datetime import datetime
 from http import HTTPStatus
 
-from gcloud_storage_emulator.exceptions import NotFound
+from gcloud_storage_emulator import checksums, compression, preconditions, settings
+from gcloud_storage_emulator.exceptions import NotFound, PreconditionFailed
 
+logger = logging.getLogger("api.object")
 
-def _make_object_resource(base_url, bucket_name, object_name, content_type, content_length):
-    time_id = math.floor(time.time())
+_RANGE_RE = re.compile(r"bytes=(\d*)-(\d*)")
+_CONTENT_RANGE_RE = re.compile(r"bytes (?:(\d+)-(\d+)|\*)/(\d+|\*)")
+
+# Metadata of the uploads kept in the object resources, with the names the API gives them
+_UPLOADED_METADATA = ("contentEncoding", "cacheControl")
+
+
+def _make_object_resource(base_url, bucket_name, object_name, content_type, content_length, metadata=None):
+    # The storage gives the object its final generation, and the fields derived from it, once
+    # the object is committed
+    time_id = int(time.time() * 1000000)
     now = str(datetime.now())
 
-    return {
+    obj = {
         "kind": "storage#object",
         "id": "{}/{}/{}".format(bucket_name, object_name, time_id),
         "selfLink": "/storage/v1/b/{}/o/{}".format(bucket_name, object_name),
@@ -25,25 +38,124 @@ def _make_object_resource(base_url, bucket_name, object_name, content_type, cont
         "storageClass": "STANDARD",
         "timeStorageClassUpdated": now,
         "size": content_length,
-        "md5Hash": "NOT_IMPLEMENTED",
         "mediaLink": "{}/download/storage/v1/b/{}/o/{}?generation={}&alt=media".format(
             base_url,
             bucket_name,
             object_name,
             time_id,
         ),
-        "crc32c": "lj+ong==",
-        "etag": "CO6Q4+qNnOcCEAE="
+        "etag": preconditions.make_etag(time_id, 1),
     }
+    if metadata:
+        obj.update((key, metadata[key]) for key in _UPLOADED_METADATA if metadata.get(key))
+    return obj
+
+
+def _parse_range(range_header, size):
+    """Parses a single byte range of a `Range` header
+
+    Arguments:
+        range_header {str} -- Value of the `Range` header
+        size {int} -- Size of the object
+
+    Returns:
+        tuple -- The (first, last) byte positions, both inclusive, or None if the header
+                 has to be ignored (malformed, or asking for multiple ranges). When the
+                 range can't be satisfied, first is beyond the end of the object.
+    """
+
+    match = _RANGE_RE.fullmatch(range_header.strip())
+    if not match or not any(match.groups()):
+        return None
+
+    first, last = match.groups()
+    if not first:
+        # Suffix range, e.g. "bytes=-500" for the last 500 bytes
+        suffix_length = int(last)
+        if suffix_length == 0:
+            return size, size
+        return max(size - suffix_length, 0), size - 1
+
+    first = int(first)
+    if not last:
+        return first, size - 1
+
+    last = int(last)
+    if last < first:
+        return None
+    return first, min(last, size - 1)
+
+
+def _parse_content_range(content_range):
+    """Parses the `Content-Range` header of a resumable upload request
+
+    Arguments:
+        content_range {str} -- Value of the `Content-Range` header, e.g. "bytes 0-999/*"
+
+    Raises:
+        ValueError: If the header is malformed
+
+    Returns:
+        tuple -- The (first, last) byte positions of the chunk, both inclusive, or (None, None)
+                 for a status query ("bytes */..."), and the total size of the upload, or None
+                 if it isn't known yet
+    """
+
+    match = _CONTENT_RANGE_RE.fullmatch(content_range.strip())
+    if not match:
+        raise ValueError("Invalid Content-Range '{}'".format(content_range))
+
+    first, last, total = match.groups()
+    total = int(total) if total != "*" else None
+    if first is None:
+        return None, None, total
+
+    first, last = int(first), int(last)
+    if last < first or (total is not None and last >= total):
+        raise ValueError("Invalid Content-Range '{}'".format(content_range))
+    return first, last, total
+
+
+def _skip(stream, count):
+    while count > 0:
+        chunk = stream.read(min(count, io.DEFAULT_BUFFER_SIZE))
+        if not chunk:
+            return
+        count -= len(chunk)
+
+
+def _not_modified(request, response, obj, conditions):
+    """Checks the preconditions of a read, and whether the client's copy is still current
+
+    Returns:
+        bool -- True if the object isn't to be sent, the response status is set then
+    """
+
+    response["ETag"] = '"{}"'.format(obj["etag"])
+    try:
+        preconditions.check(obj, conditions)
+    except PreconditionFailed as e:
+        if e.parameter in preconditions.NOT_MATCH_PARAMETERS:
+            response.status = HTTPStatus.NOT_MODIFIED
+        else:
+            response.status = HTTPStatus.PRECONDITION_FAILED
+        return True
+
+    if preconditions.matches_etag(request.get_header("If-None-Match"), obj["etag"]):
+        response.status = HTTPStatus.NOT_MODIFIED
+        return True
+    return False
 
 
 def _multipart_upload(request, response, storage):
+    # The size is only known once the content has been streamed to the storage
     obj = _make_object_resource(
         request.base_url,
         request.params["bucket_name"],
         request.data["meta"]["name"],
         request.data["content-type"],
-        str(len(request.data["content"])),
+        None,
+        request.data["meta"],
     )
 
     storage.create_file(
@@ -51,6 +163,7 @@ def _multipart_upload(request, response, storage):
         request.data["meta"]["name"],
         request.data["content"],
         obj,
+        preconditions=preconditions.from_query(request.query),
     )
 
     response.json(obj)
@@ -65,6 +178,7 @@ def _create_resumable_upload(request, response, storage):
         request.data["name"],
         content_type,
         content_length,
+        request.data,
     )
 
     id = storage.create_resumable_upload(
@@ -90,51 +204,153 @@ def insert(request, response, storage, *args, **kwargs):
 
     uploadType = uploadType[0]
 
+    try:
+        request.data
+        preconditions.from_query(request.query)
+    except ValueError:
+        response.status = HTTPStatus.BAD_REQUEST
+        return
+
     if uploadType == "resumable":
         if isinstance(request.data, dict):
             return _create_resumable_upload(request, response, storage)
         return upload_partial(request, response, storage, *args, **kwargs)
 
     if uploadType == "multipart":
-        return _multipart_upload(request, response, storage)
+        try:
+            return _multipart_upload(request, response, storage)
+        except PreconditionFailed:
+            response.status = HTTPStatus.PRECONDITION_FAILED
 
 
 def upload_partial(request, response, storage, *args, **kwargs):
-    upload_id = request.query.get("upload_id")[0]
-    obj = storage.create_file_for_resumable_upload(upload_id, request.data)
+    """Receives the content of a resumable upload session
+
+    The content can be sent in a single request, or in chunks described by a `Content-Range`
+    header. Chunks are appended to the session until the last one, which creates the object.
+    Until then requests are answered with `308 Resume Incomplete`, whose `Range` header tells
+    the bytes received so far. "bytes */<total>" requests only query that status. Once the
+    session is over, they get the object it created, e.g. for a client which lost the response
+    to its last chunk.
+
+    The session URL carries the query string of the request which started the session, the
+    preconditions it has are checked once the object is created.
+    """
+
     response["Access-Control-Allow-Origin"] = "http://localhost:3010"
     response["Access-Control-Allow-Credentials"] = "true"
-    return response.json(obj)
+
+    upload_id = request.query.get("upload_id", [None])[0]
+    content_range = request.get_header("Content-Range")
+    try:
+        if upload_id is None:
+            raise ValueError("Missing upload_id")
+        if content_range is not None:
+            first, last, total = _parse_content_range(content_range)
+        conditions = preconditions.from_query(request.query)
+    except ValueError:
+        response.status = HTTPStatus.BAD_REQUEST
+        return
+
+    try:
+        if content_range is None:
+            return response.json(
+                storage.create_file_for_resumable_upload(upload_id, request.body, preconditions=conditions)
+            )
+
+        try:
+            _, received = storage.get_resumable_upload(upload_id)
+        except NotFound:
+            return response.json(storage.get_finished_resumable_upload(upload_id))
+
+        if first is not None:
+            if first > received:
+                # Chunks must follow each other, a gap in the content can't be filled later
+                response.status = HTTPStatus.BAD_REQUEST
+                return
+
+            # The client resends the bytes it doesn't know have been received, skip them
+            skipped = min(received, last + 1) - first
+            _skip(request.body, skipped)
+            try:
+                # Nothing of a chunk which isn't as long as its Content-Range says is kept
+                received = storage.append_to_resumable_upload(
+                    upload_id, request.body, size=last + 1 - first - skipped
+                )
+            except ValueError:
+                response.status = HTTPStatus.BAD_REQUEST
+                return
+
+        if total is not None and received >= total:
+            if received > total:
+                response.status = HTTPStatus.BAD_REQUEST
+                return
+            return response.json(storage.finish_resumable_upload(upload_id, preconditions=conditions))
+    except NotFound:
+        response.status = HTTPStatus.NOT_FOUND
+        return
+    except PreconditionFailed:
+        response.status = HTTPStatus.PRECONDITION_FAILED
+        return
+
+    response.status = HTTPStatus.PERMANENT_REDIRECT
+    if received > 0:
+        response["Range"] = "bytes=0-{}".format(received - 1)
 
 
 def get(request, response, storage, *args, **kwargs):
     if request.query.get("alt") == ["media"]:
         return download(request, response, storage, *args, **kwargs)
     try:
+        conditions = preconditions.from_query(request.query)
         obj = storage.get_file_obj(request.params["bucket_name"], request.params["object_id"])
-        response.json(obj)
+    except ValueError:
+        response.status = HTTPStatus.BAD_REQUEST
+        return
     except NotFound:
         response.status = HTTPStatus.NOT_FOUND
+        return
+
+    if not _not_modified(request, response, obj, conditions):
+        response.json(obj)
 
 
 def ls(request, response, storage, *args, **kwargs):
     bucket_name = request.params["bucket_name"]
     prefix = request.query.get("prefix")[0] if request.query.get("prefix") else None
     delimiter = request.query.get('delimiter')[0] if request.query.get("delimiter") else None
+    page_token = request.query.get("pageToken")[0] if request.query.get("pageToken") else None
     try:
-        files = storage.get_file_list(bucket_name, prefix, delimiter)
+        max_results = min(int(request.query.get("maxResults", [settings.MAX_RESULTS])[0]), settings.MAX_RESULTS)
+        if max_results < 1:
+            raise ValueError
+        files, prefixes, next_page_token = storage.get_file_list(
+            bucket_name, prefix, delimiter, max_results, page_token
+        )
+    except ValueError:
+        response.status = HTTPStatus.BAD_REQUEST
     except NotFound:
         response.status = HTTPStatus.NOT_FOUND
     else:
-        response.json({
-            "kind": "storage#object",
-            "items": files
-        })
+        result = {
+            "kind": "storage#objects",
+            "items": files,
+        }
+        if prefixes:
+            result["prefixes"] = prefixes
+        if next_page_token:
+            result["nextPageToken"] = next_page_token
+        response.json(result)
 
 
 def copy(request, response, storage, *args, **kwargs):
     try:
+        # Preconditions apply to the destination object
+        conditions = preconditions.from_query(request.query)
         obj = storage.get_file_obj(request.params["bucket_name"], request.params["object_id"])
+    except ValueError:
+        response.status = HTTPStatus.BAD_REQUEST
+        return
     except NotFound:
         response.status = HTTPStatus.NOT_FOUND
         return
@@ -145,25 +361,100 @@ def copy(request, response, storage, *args, **kwargs):
         request.params["dest_object_id"],
         obj["contentType"],
         obj["size"],
+        obj,
     )
 
-    file = storage.get_file(request.params["bucket_name"], request.params["object_id"])
-    storage.create_file(request.params["dest_bucket_name"], request.params["dest_object_id"], file, dest_obj)
+    try:
+        storage.copy_file(
+            request.params["bucket_name"],
+            request.params["object_id"],
+            request.params["dest_bucket_name"],
+            request.params["dest_object_id"],
+            dest_obj,
+            preconditions=conditions,
+        )
+    except NotFound:
+        response.status = HTTPStatus.NOT_FOUND
+        return
+    except PreconditionFailed:
+        response.status = HTTPStatus.PRECONDITION_FAILED
+        return
 
     response.json(dest_obj)
 
 
 def download(request, response, storage, *args, **kwargs):
     try:
-        file = storage.get_file(request.params["bucket_name"], request.params["object_id"])
-        obj = storage.get_file_obj(request.params["bucket_name"], request.params["object_id"])
-        response.write_file(file, content_type=obj.get("contentType"))
+        conditions = preconditions.from_query(request.query)
+        obj, file = storage.open_file(request.params["bucket_name"], request.params["object_id"])
+    except ValueError:
+        response.status = HTTPStatus.BAD_REQUEST
+        return
     except NotFound:
         response.status = HTTPStatus.NOT_FOUND
+        return
+
+    if _not_modified(request, response, obj, conditions):
+        # Only headers are sent, the content isn't read
+        file.close()
+        return
+
+    # Hashes of the whole object, computed when it was written
+    goog_hash = checksums.goog_hash_header(obj)
+    if goog_hash is not None:
+        response["x-goog-hash"] = goog_hash
+    size = file.seek(0, io.SEEK_END)
+    file.seek(0)
+
+    if obj.get("contentEncoding") == compression.GZIP:
+        response["x-goog-stored-content-encoding"] = compression.GZIP
+        response["x-goog-stored-content-length"] = str(size)
+        accept_encoding = request.get_header("Accept-Encoding")
+        if not compression.accepts_gzip(accept_encoding) and "no-transform" not in obj.get("cacheControl", ""):
+            # The status and headers can't be taken back once the content is streamed: a content
+            # which can't be decompressed is sent as stored instead
+            is_gzip = compression.is_gzip(file)
+            file.seek(0)
+            if is_gzip:
+                # Decompressive transcoding: the content is decompressed on the fly, for clients
+                # which can't. As with GCS, ranges are then ignored.
+                response.write_stream(compression.GunzipStream(file), content_type=obj.get("contentType"))
+                return
+            logger.warning("Object {}/{} isn't valid gzip, it is sent as stored".format(
+                request.params["bucket_name"], request.params["object_id"]
+            ))
+        response["Content-Encoding"] = compression.GZIP
+
+    response["Accept-Ranges"] = "bytes"
+    byte_range = _parse_range(request.get_header("Range", ""), size)
+    if byte_range is None:
+        response.write_stream(file, size, content_type=obj.get("contentType"))
+        return
+
+    first, last = byte_range
+    if first >= size:
+        file.close()
+        response.status = HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE
+        response["Content-Range"] = "bytes */{}".format(size)
+        return
+
+    # Only the requested range is read, starting from its position in the file
+    file.seek(first)
+    response.status = HTTPStatus.PARTIAL_CONTENT
+    response["Content-Range"] = "bytes {}-{}/{}".format(first, last, size)
+    response.write_stream(file, last - first + 1, content_type=obj.get("contentType"))
 
 
 def delete(request, response, storage, *args, **kwargs):
     try:
-        storage.delete_file(request.params["bucket_name"], request.params["object_id"])
+        storage.delete_file(
+            request.params["bucket_name"],
+            request.params["object_id"],
+            preconditions=preconditions.from_query(request.query),
+        )
+    except ValueError:
+        response.status = HTTPStatus.BAD_REQUEST
     except NotFound:
         response.status = HTTPStatus.NOT_FOUND
+    except PreconditionFailed:
+        response.status = HTTPStatus.PRECONDITION_FAILED
@@ -0,0 +1,134 @@
+import base64
+import binascii
+import sys
+from bisect import bisect_left
+
+
+def prefix_upper_bound(prefix):
+    """Returns the smallest string sorting after every string starting with the prefix
+
+    Returns None when there is no such string, i.e. the prefix range extends to the end.
+    """
+
+    prefix = prefix.rstrip(chr(sys.maxunicode))
+    if not prefix:
+        return None
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+class SortedNames(object):
+    """Sorted list of the object names in a bucket
+
+    Prefix queries are answered with a binary search, so they cost O(log n + k) where k is
+    the number of names returned. Delimiter queries jump over every name sharing a common
+    prefix instead of visiting them.
+    """
+
+    def __init__(self, names=()):
+        self._names = sorted(names)
+
+    def __len__(self):
+        return len(self._names)
+
+    def copy(self):
+        """Returns an independent copy of the index, without sorting the names again"""
+
+        index = SortedNames()
+        index._names = list(self._names)
+        return index
+
+    def add(self, name):
+        names = self._names
+        # Fast path for names inserted in order, e.g. when seeding fixtures
+        if not names or names[-1] < name:
+            names.append(name)
+            return
+
+        i = bisect_left(names, name)
+        if i == len(names) or names[i] != name:
+            names.insert(i, name)
+
+    def discard(self, name):
+        names = self._names
+        i = bisect_left(names, name)
+        if i < len(names) and names[i] == name:
+            del names[i]
+
+    def _range(self, prefix):
+        names = self._names
+        lo = bisect_left(names, prefix)
+        upper_bound = prefix_upper_bound(prefix)
+        hi = len(names) if upper_bound is None else bisect_left(names, upper_bound, lo)
+        return lo, hi
+
+    def list(self, prefix="", delimiter=None, start_at=None, max_results=None):
+        """Lists the names starting with the prefix, rolling them up on the delimiter
+
+        Names containing the delimiter after the prefix are not returned, their common prefix
+        (up to and including the delimiter) is returned instead, as GCS does.
+
+        Results are paginated by position in the index: `start_at` is the key returned by
+        the previous page, so fetching a page never rescans the ones before it.
+
+        Keyword Arguments:
+            prefix {str} -- Only list names starting with this prefix (default: {""})
+            delimiter {str} -- Delimiter used to compute the common prefixes (default: {None})
+            start_at {str} -- Only list names sorting at or after this key (default: {None})
+            max_results {int} -- Maximum number of names and prefixes to return (default: {None})
+
+        Returns:
+            tuple -- (list of names, list of common prefixes, key of the next page or None)
+        """
+
+        prefix = prefix or ""
+        names = self._names
+        lo, hi = self._range(prefix)
+        if start_at is not None:
+            lo = bisect_left(names, start_at, lo, hi)
+
+        if not delimiter:
+            end = hi if max_results is None else min(hi, lo + max_results)
+            next_start = names[end - 1] + "\0" if end < hi else None
+            return names[lo:end], [], next_start
+
+        results = []
+        prefixes = []
+        i = lo
+        next_start = None
+        while i < hi:
+            if max_results is not None and len(results) + len(prefixes) == max_results:
+                next_start = names[i]
+                break
+
+            name = names[i]
+            position = name.find(delimiter, len(prefix))
+            if position == -1:
+                results.append(name)
+                i += 1
+                continue
+
+            common_prefix = name[:position + len(delimiter)]
+            prefixes.append(common_prefix)
+            upper_bound = prefix_upper_bound(common_prefix)
+            i = hi if upper_bound is None else bisect_left(names, upper_bound, i, hi)
+
+        return results, prefixes, next_start
+
+
+def encode_page_token(start_at):
+    """Turns an index position into an opaque page token"""
+
+    return base64.urlsafe_b64encode(start_at.encode("utf-8")).decode("ascii")
+
+
+def decode_page_token(page_token):
+    """Turns a page token back into an index position
+
+    Raises:
+        ValueError: If the token is malformed
+    """
+
+    try:
+        return base64.b64decode(page_token.encode("ascii"), altchars=b"-_", validate=True).decode("utf-8")
+    except (binascii.Error, UnicodeError):
+        raise ValueError("Invalid page token '{}'".format(page_token))
@@ -0,0 +1,342 @@
+import json
+import logging
+import os
+
+from fs.errors import ResourceNotFound
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_FILE = ".meta"
+JOURNAL_FILE = ".journal"
+
+# Version of the snapshot file written by `Journal.compact`
+SNAPSHOT_FORMAT = 2
+
+# The journal is folded into the snapshot once it holds more records than this, or more
+# records than there were items in the last snapshot, whichever is bigger. Tying the
+# threshold to the snapshot size keeps the amortized cost of a write constant.
+COMPACTION_MIN_RECORDS = 1000
+
+
+class Journal(object):
+    """Append-only log of metadata mutations on top of a JSON snapshot
+
+    Every mutation is appended to the journal as a single JSON line, so persisting it
+    costs the same regardless of how much metadata is stored. The journal is periodically
+    compacted: the full state is written to a new snapshot, atomically swapped with the
+    previous one, and the journal is truncated.
+
+    Records are plain "set" or "delete" operations, so replaying a record twice (e.g. after
+    a crash between the snapshot swap and the truncation) is harmless.
+
+    The snapshot starts with a header line holding the buckets, the resumable uploads and
+    where the objects of each bucket are in the rest of the file. Only the header is read
+    on load, so startup doesn't depend on the number of objects: the segment of a bucket
+    is read by `read_segment` when its objects are first needed. Snapshots written as a
+    single JSON document by previous versions are still loaded, as a whole.
+    """
+
+    def __init__(self, storage_fs):
+        self._fs = storage_fs
+        self._file = None
+        self._records = 0
+        self._snapshot_size = 0
+        self._torn = False
+        # Where this instance is up to in the journal, and which files it was reading: the
+        # journal can be shared with other processes, see `read_new_records`
+        self._position = 0
+        self._identity = None
+        # The snapshot file stays open while segments may be read from it, so a snapshot
+        # swapped by another process can't pull it from under this instance
+        self._snapshot_file = None
+        # Segments by bucket name, as [offset, length, number of objects, number of
+        # deduplicated objects, total size of the objects]
+        self._segments = {}
+        self._segments_start = 0
+
+    def _file_identity(self, path):
+        try:
+            file_stat = os.stat(self._fs.getsyspath(path))
+        except FileNotFoundError:
+            return None
+        return file_stat.st_dev, file_stat.st_ino
+
+    def _update_identity(self):
+        self._identity = (self._file_identity(SNAPSHOT_FILE), self._file_identity(JOURNAL_FILE))
+
+    def load(self):
+        """Reads the snapshot header and the journal records written after it
+
+        Returns:
+            tuple -- (snapshot dict, list of journal records). Objects are only included in
+                     the snapshot if it has no segments, the buckets with a segment are the
+                     keys of its "segments" item.
+        """
+
+        self.close()
+        snapshot = self._load_snapshot()
+        self._update_identity()
+        self._position = 0
+        records = []
+        try:
+            with self._fs.open(JOURNAL_FILE, mode="r") as journal_file:
+                for line in journal_file:
+                    try:
+                        records.append(json.loads(line))
+                    except ValueError:
+                        # Only the last record can be torn, by a crash in the middle of a write.
+                        # Records appended after it would be unreadable, so the journal has to be
+                        # compacted before being written again.
+                        logger.warning("Ignoring truncated journal record")
+                        self._torn = True
+                        break
+                    self._position += len(line.encode("utf-8"))
+        except ResourceNotFound:
+            pass
+
+        self._records = len(records)
+        self._snapshot_size = _count_items(snapshot, self._segments)
+        return snapshot, records
+
+    def _load_snapshot(self):
+        try:
+            snapshot_file = self._fs.open(SNAPSHOT_FILE, mode="rb")
+        except ResourceNotFound:
+            return {}
+
+        try:
+            header = json.loads(snapshot_file.readline().decode("utf-8"))
+        except ValueError:
+            header = None
+        if not isinstance(header, dict) or header.get("format") != SNAPSHOT_FORMAT:
+            # Written by a previous version
+            snapshot_file.seek(0)
+            try:
+                return json.loads(snapshot_file.read().decode("utf-8"))
+            finally:
+                snapshot_file.close()
+
+        self._snapshot_file = snapshot_file
+        self._segments = header.pop("segments")
+        self._segments_start = snapshot_file.tell()
+        header["segments"] = list(self._segments)
+        return header
+
+    def _read_raw_segment(self, bucket_name):
+        offset, length = self._segments[bucket_name][:2]
+        self._snapshot_file.seek(self._segments_start + offset)
+        return self._snapshot_file.read(length)
+
+    def read_segment(self, bucket_name):
+        """Reads the objects of a bucket from the snapshot loaded last
+
+        Returns:
+            dict -- With the "objects" and "blob_ids" of the bucket, or None if the snapshot
+                    has no segment for it
+        """
+
+        if bucket_name not in self._segments:
+            return None
+        return json.loads(self._read_raw_segment(bucket_name).decode("utf-8"))
+
+    def may_reference_blobs(self, bucket_name):
+        """Whether the segment of the bucket holds deduplicated objects"""
+
+        segment = self._segments.get(bucket_name)
+        return segment is not None and segment[3] > 0
+
+    def segment_stats(self, bucket_name):
+        """Returns the number of objects in the segment of the bucket, and their total size"""
+
+        segment = self._segments.get(bucket_name)
+        if segment is None:
+            return 0, 0
+        return segment[2], segment[4]
+
+    def append(self, record):
+        """Appends a single mutation record to the journal"""
+
+        if self._file is None:
+            self._file = self._fs.open(JOURNAL_FILE, mode="a")
+            self._update_identity()
+
+        line = _dumps(record) + "\n"
+        self._file.write(line)
+        self._file.flush()
+        self._records += 1
+        self._position += len(line.encode("utf-8"))
+
+    def read_new_records(self):
+        """Reads the records appended by other processes since this journal was loaded or written
+
+        Processes sharing the journal must take turns: between two turns, the others may
+        have appended records, or compacted or removed the journal.
+
+        Returns:
+            list -- The new records, or None if the journal was compacted or removed meanwhile:
+                    it then has to be loaded again
+        """
+
+        if (self._file_identity(SNAPSHOT_FILE), self._file_identity(JOURNAL_FILE)) != self._identity:
+            return None
+
+        try:
+            with open(self._fs.getsyspath(JOURNAL_FILE), "rb") as journal_file:
+                journal_file.seek(self._position)
+                data = journal_file.read()
+        except FileNotFoundError:
+            data = b""
+
+        # A record is only complete once its line break is written
+        data = data[:data.rfind(b"\n") + 1]
+        try:
+            records = [json.loads(line.decode("utf-8")) for line in data.splitlines()]
+        except ValueError:
+            return None
+
+        self._position += len(data)
+        self._records += len(records)
+        return records
+
+    def needs_compaction(self):
+        return self._torn or self._records > max(COMPACTION_MIN_RECORDS, self._snapshot_size)
+
+    def compact(self, snapshot, unloaded=()):
+        """Replaces the snapshot with the given state and truncates the journal
+
+        Arguments:
+            snapshot {dict} -- The full metadata state, but for the objects of the `unloaded`
+                               buckets
+
+        Keyword Arguments:
+            unloaded {iterable} -- Buckets whose objects haven't changed since the last
+                                   snapshot, and are copied over from it (default: {()})
+        """
+
+        segments = {}
+        chunks = []
+        offset = 0
+        blob_ids = snapshot.get("blob_ids") or {}
+        for bucket_name, bucket_objects in (snapshot.get("objects") or {}).items():
+            bucket_blob_ids = blob_ids.get(bucket_name) or {}
+            chunk = (_dumps({"objects": bucket_objects, "blob_ids": bucket_blob_ids}) + "\n").encode("utf-8")
+            segments[bucket_name] = [
+                offset, len(chunk), len(bucket_objects), len(bucket_blob_ids), object_sizes(bucket_objects.values())
+            ]
+            chunks.append(chunk)
+            offset += len(chunk)
+        for bucket_name in unloaded:
+            chunk = self._read_raw_segment(bucket_name)
+            segments[bucket_name] = [offset] + self._segments[bucket_name][1:]
+            chunks.append(chunk)
+            offset += len(chunk)
+
+        header = {
+            "format": SNAPSHOT_FORMAT,
+            "buckets": snapshot.get("buckets") or {},
+            "resumable": snapshot.get("resumable") or {},
+            "segments": segments,
+        }
+        with self._fs.open(SNAPSHOT_FILE + ".tmp", mode="wb") as snapshot_file:
+            snapshot_file.write((_dumps(header) + "\n").encode("utf-8"))
+            for chunk in chunks:
+                snapshot_file.write(chunk)
+        self._fs.move(SNAPSHOT_FILE + ".tmp", SNAPSHOT_FILE, overwrite=True)
+
+        self.close()
+        self._snapshot_file = self._fs.open(SNAPSHOT_FILE, mode="rb")
+        self._snapshot_file.readline()
+        self._segments = segments
+        self._segments_start = self._snapshot_file.tell()
+        self._fs.open(JOURNAL_FILE, mode="w").close()
+        self._records = 0
+        self._snapshot_size = _count_items(header, segments)
+        self._torn = False
+        self._position = 0
+        self._update_identity()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        if self._snapshot_file is not None:
+            self._snapshot_file.close()
+            self._snapshot_file = None
+        self._segments = {}
+
+    def remove(self):
+        """Deletes both the snapshot and the journal"""
+
+        self.close()
+        for path in (SNAPSHOT_FILE, JOURNAL_FILE):
+            try:
+                self._fs.remove(path)
+            except ResourceNotFound:
+                pass
+        self._records = 0
+        self._snapshot_size = 0
+        self._torn = False
+        self._position = 0
+        self._update_identity()
+
+
+def _dumps(value):
+    return json.dumps(value, separators=(",", ":"))
+
+
+def object_sizes(file_objs):
+    """Returns the total size of the given Object resources"""
+
+    total = 0
+    for file_obj in file_objs:
+        try:
+            total += int(file_obj.get("size") or 0)
+        except (AttributeError, TypeError, ValueError):
+            pass
+    return total
+
+
+def _count_items(snapshot, segments):
+    buckets = snapshot.get("buckets") or {}
+    objects = snapshot.get("objects") or {}
+    resumable = snapshot.get("resumable") or {}
+    return (
+        len(buckets)
+        + sum(len(bucket_objects) for bucket_objects in objects.values())
+        + sum(segment[2] for segment in segments.values())
+        + len(resumable)
+    )
+
+
+class NullJournal(object):
+    """Journal of the in-memory storage: metadata only lives in the Storage dicts"""
+
+    def load(self):
+        return {}, []
+
+    def append(self, record):
+        pass
+
+    def needs_compaction(self):
+        return False
+
+    def read_segment(self, bucket_name):
+        return None
+
+    def may_reference_blobs(self, bucket_name):
+        return False
+
+    def segment_stats(self, bucket_name):
+        return 0, 0
+
+    def compact(self, snapshot, unloaded=()):
+        pass
+
+    def read_new_records(self):
+        return []
+
+    def close(self):
+        pass
+
+    def remove(self):
+        pass
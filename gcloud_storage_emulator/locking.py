@@ -0,0 +1,60 @@
+import os
+import threading
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None
+
+
+class InterProcessLock(object):
+    """Reentrant lock shared by the threads of this process and by the other processes locking the same file
+
+    Threads take turns on an RLock, processes on an exclusive `flock` of the file. The file
+    lock is only taken by the outermost acquisition, which then calls `on_acquire`: this is
+    where the holder catches up on what other processes did since its last turn.
+
+    Raises:
+        RuntimeError: If the platform doesn't support file locks
+    """
+
+    def __init__(self, path, on_acquire=None):
+        if fcntl is None:
+            raise RuntimeError("Sharing a storage between processes requires fcntl file locks")
+
+        self._lock = threading.RLock()
+        self._depth = 0
+        self._on_acquire = on_acquire
+        # Each instance needs its own open file description: flock locks are tied to it, and
+        # it is shared with the processes forked afterwards
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+
+    def acquire(self):
+        self._lock.acquire()
+        self._depth += 1
+        if self._depth > 1:
+            return
+
+        try:
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            if self._on_acquire is not None:
+                self._on_acquire()
+        except Exception:
+            self.release()
+            raise
+
+    def release(self):
+        self._depth -= 1
+        if self._depth == 0:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+        self._lock.release()
+
+    def close(self):
+        os.close(self._fd)
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.release()
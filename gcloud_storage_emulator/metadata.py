@@ -0,0 +1,721 @@
+import json
+import logging
+import os
+import sqlite3
+from contextlib import contextmanager
+
+from gcloud_storage_emulator.index import SortedNames, prefix_upper_bound
+from gcloud_storage_emulator.journal import JOURNAL_FILE, object_sizes
+
+logger = logging.getLogger(__name__)
+
+# Database of the SQLite metadata store, within the storage fs
+DATABASE_FILE = ".metadata.db"
+
+# Metadata backends, as selected by Storage
+JSON_BACKEND = "json"
+SQLITE_BACKEND = "sqlite"
+BACKENDS = (JSON_BACKEND, SQLITE_BACKEND)
+
+# Metadata is changed by applying records, persisted as they are by the journal:
+#     {"op": "put_bucket", "name": ..., "value": Bucket resource}
+#     {"op": "delete_bucket", "name": ...}
+#     {"op": "put_object", "bucket": ..., "name": ..., "value": Object resource, "blob": blob id or None}
+#     {"op": "delete_object", "bucket": ..., "name": ...}
+#     {"op": "put_resumable", "id": ..., "value": Object resource}
+#     {"op": "delete_resumable", "id": ...}
+
+
+class JournaledMetadata(object):
+    """Metadata held in dicts, and persisted by a journal (see `journal.Journal`)
+
+    Object names are kept in sorted indexes, so listings only cost O(log n + k). Buckets are
+    loaded upfront, but the objects of a bucket are only read from the snapshot, and their
+    index built, when the bucket is first used: until then, the journal records changing
+    them are kept aside. Every object of a used bucket is held in memory though, see
+    `SQLiteMetadata` for large storages.
+
+    In-memory snapshots (`copy_state` and `set_state`) share the objects, references to their
+    blobs and name index of each bucket with the live state, which copies those of a bucket
+    the first time it changes it.
+    """
+
+    # Files of the storage fs written in place, which snapshots can't share
+    files = (JOURNAL_FILE,)
+
+    def __init__(self, journal):
+        self._journal = journal
+        self._set_state({}, {}, {}, {})
+
+    def _set_state(self, buckets, objects, resumable, blob_ids, unloaded=(), pending=None):
+        self.buckets = buckets
+        self.objects = objects
+        self.resumable = resumable
+        self.blob_ids = blob_ids
+        # Buckets whose objects are still to be read from the snapshot, and the records
+        # to apply to them once they are
+        self._unloaded = set(unloaded)
+        self._pending = pending or {}
+        # Buckets whose objects, blob ids and index are shared with a snapshot
+        self._shared = set()
+        self._bucket_index = SortedNames(self.buckets)
+        self._index = {
+            bucket_name: SortedNames(bucket_objects)
+            for bucket_name, bucket_objects in self.objects.items()
+        }
+        # Number of objects referencing each deduplicated blob, in the loaded buckets
+        self._references = {}
+        for bucket_blob_ids in self.blob_ids.values():
+            for blob_id in bucket_blob_ids.values():
+                self._references[blob_id] = self._references.get(blob_id, 0) + 1
+        # Number and total size of the objects, kept up to date as records are applied
+        self._object_count = 0
+        self._object_bytes = 0
+        for bucket_objects in self.objects.values():
+            self._count_objects(bucket_objects.values())
+        for bucket_name in self._unloaded:
+            self._count_segment(bucket_name)
+
+    def _count_objects(self, file_objs, sign=1):
+        file_objs = list(file_objs)
+        self._object_count += sign * len(file_objs)
+        self._object_bytes += sign * object_sizes(file_objs)
+
+    def _count_segment(self, bucket_name, sign=1):
+        count, size = self._journal.segment_stats(bucket_name)
+        self._object_count += sign * count
+        self._object_bytes += sign * size
+
+    def load(self):
+        snapshot, records = self._journal.load()
+        self.buckets = snapshot.get("buckets") or {}
+        self.objects = snapshot.get("objects") or {}
+        self.resumable = snapshot.get("resumable") or {}
+        self.blob_ids = snapshot.get("blob_ids") or {}
+        self._unloaded = set(snapshot.get("segments") or ())
+        self._pending = {}
+        for record in records:
+            self._apply_record(record)
+        self._set_state(self.buckets, self.objects, self.resumable, self.blob_ids, self._unloaded, self._pending)
+
+        if self._journal.needs_compaction():
+            self.compact()
+
+    def _load_bucket(self, bucket_name):
+        """Reads the objects of the bucket from the snapshot, if not done yet"""
+
+        if bucket_name not in self._unloaded:
+            return
+
+        self._unloaded.discard(bucket_name)
+        self._count_segment(bucket_name, -1)
+        segment = self._journal.read_segment(bucket_name) or {}
+        if segment.get("objects"):
+            self.objects[bucket_name] = segment["objects"]
+            self._count_objects(segment["objects"].values())
+        if segment.get("blob_ids"):
+            self.blob_ids[bucket_name] = segment["blob_ids"]
+            for blob_id in segment["blob_ids"].values():
+                self._references[blob_id] = self._references.get(blob_id, 0) + 1
+        for record in self._pending.pop(bucket_name, ()):
+            self._apply_record(record)
+        self._index[bucket_name] = SortedNames(self.objects.get(bucket_name, ()))
+
+    def _own_bucket(self, bucket_name):
+        """Copies what the bucket shares with a snapshot, before it is changed"""
+
+        if bucket_name not in self._shared:
+            return
+
+        self._shared.discard(bucket_name)
+        if bucket_name in self.objects:
+            self.objects[bucket_name] = dict(self.objects[bucket_name])
+        if bucket_name in self.blob_ids:
+            self.blob_ids[bucket_name] = dict(self.blob_ids[bucket_name])
+        if bucket_name in self._index:
+            self._index[bucket_name] = self._index[bucket_name].copy()
+
+    def _load_all(self):
+        for bucket_name in list(self._unloaded):
+            self._load_bucket(bucket_name)
+
+    def close(self):
+        self._journal.close()
+
+    def sync(self):
+        """Applies the records written to the journal by the other processes sharing it"""
+
+        records = self._journal.read_new_records()
+        if records is None:
+            self.load()
+            return
+
+        for record in records:
+            self._apply_record(record)
+            self._update_index(record)
+
+    def compact(self):
+        """Writes the whole metadata state as the new snapshot, truncating the journal
+
+        Buckets which weren't used since the last snapshot are copied over as they are.
+        """
+
+        for bucket_name in list(self._pending):
+            self._load_bucket(bucket_name)
+        self._journal.compact(self._to_dict(), unloaded=self._unloaded)
+
+    def commit(self, record):
+        """Applies a single metadata mutation and persists it to the journal
+
+        The journal is compacted into a new snapshot when it grows too big
+        """
+
+        self._apply_record(record)
+        self._update_index(record)
+        self._journal.append(record)
+        if self._journal.needs_compaction():
+            self.compact()
+
+    def _unreference(self, blob_id):
+        count = self._references.get(blob_id, 0) - 1
+        if count > 0:
+            self._references[blob_id] = count
+        else:
+            self._references.pop(blob_id, None)
+
+    def _apply_record(self, record):
+        op = record["op"]
+        if record.get("bucket") in self._unloaded:
+            self._pending.setdefault(record["bucket"], []).append(record)
+        elif op == "put_bucket":
+            self.buckets[record["name"]] = record["value"]
+        elif op == "delete_bucket":
+            self.buckets.pop(record["name"], None)
+            self._shared.discard(record["name"])
+            self._count_objects(self.objects.pop(record["name"], {}).values(), -1)
+            if record["name"] in self._unloaded:
+                self._count_segment(record["name"], -1)
+                self._unloaded.discard(record["name"])
+            self._pending.pop(record["name"], None)
+            for blob_id in self.blob_ids.pop(record["name"], {}).values():
+                self._unreference(blob_id)
+        elif op == "put_object":
+            self._own_bucket(record["bucket"])
+            bucket_objects = self.objects.setdefault(record["bucket"], {})
+            if record["name"] in bucket_objects:
+                self._count_objects((bucket_objects[record["name"]],), -1)
+            bucket_objects[record["name"]] = record["value"]
+            self._count_objects((record["value"],))
+            previous_blob_id = self.blob_ids.get(record["bucket"], {}).pop(record["name"], None)
+            if previous_blob_id is not None:
+                self._unreference(previous_blob_id)
+            # Deduplicated objects point at the blob holding their content
+            blob_id = record.get("blob")
+            if blob_id is not None:
+                self.blob_ids.setdefault(record["bucket"], {})[record["name"]] = blob_id
+                self._references[blob_id] = self._references.get(blob_id, 0) + 1
+        elif op == "delete_object":
+            self._own_bucket(record["bucket"])
+            previous = self.objects.get(record["bucket"], {}).pop(record["name"], None)
+            if previous is not None:
+                self._count_objects((previous,), -1)
+            blob_id = self.blob_ids.get(record["bucket"], {}).pop(record["name"], None)
+            if blob_id is not None:
+                self._unreference(blob_id)
+        elif op == "put_resumable":
+            self.resumable[record["id"]] = record["value"]
+        elif op == "delete_resumable":
+            self.resumable.pop(record["id"], None)
+        else:
+            logger.warning("Unknown journal operation '{}'".format(op))
+
+    def _update_index(self, record):
+        op = record["op"]
+        if record.get("bucket") in self._unloaded:
+            # Indexed once the bucket is loaded
+            return
+        if op == "put_bucket":
+            self._bucket_index.add(record["name"])
+        elif op == "put_object":
+            bucket_index = self._index.get(record["bucket"])
+            if bucket_index is None:
+                bucket_index = self._index[record["bucket"]] = SortedNames()
+            bucket_index.add(record["name"])
+        elif op == "delete_object":
+            bucket_index = self._index.get(record["bucket"])
+            if bucket_index is not None:
+                bucket_index.discard(record["name"])
+        elif op == "delete_bucket":
+            self._bucket_index.discard(record["name"])
+            self._index.pop(record["name"], None)
+
+    def _to_dict(self):
+        return {
+            "buckets": self.buckets,
+            "objects": self.objects,
+            "resumable": self.resumable,
+            "blob_ids": self.blob_ids,
+        }
+
+    def to_dict(self):
+        self._load_all()
+        return self._to_dict()
+
+    def get_bucket(self, bucket_name):
+        return self.buckets.get(bucket_name)
+
+    def get_buckets(self):
+        return dict(self.buckets)
+
+    def list_buckets(self, prefix=None, start_at=None, max_results=None):
+        names, _, next_start = self._bucket_index.list(prefix, start_at=start_at, max_results=max_results)
+        return [self.buckets[name] for name in names], next_start
+
+    def get_object(self, bucket_name, file_name):
+        self._load_bucket(bucket_name)
+        return self.objects.get(bucket_name, {}).get(file_name)
+
+    def get_blob_id(self, bucket_name, file_name):
+        self._load_bucket(bucket_name)
+        return self.blob_ids.get(bucket_name, {}).get(file_name)
+
+    def list_objects(self, bucket_name, prefix=None, delimiter=None, start_at=None, max_results=None):
+        self._load_bucket(bucket_name)
+        bucket_index = self._index.get(bucket_name)
+        if bucket_index is None:
+            return [], [], None
+
+        names, prefixes, next_start = bucket_index.list(prefix, delimiter, start_at, max_results)
+        bucket_objects = self.objects[bucket_name]
+        return [bucket_objects[name] for name in names], prefixes, next_start
+
+    def has_objects(self, bucket_name):
+        self._load_bucket(bucket_name)
+        return bool(self.objects.get(bucket_name))
+
+    def get_resumable(self, file_id):
+        return self.resumable.get(file_id)
+
+    def has_resumable(self, bucket_name):
+        return any(file_obj.get("bucket") == bucket_name for file_obj in self.resumable.values())
+
+    def stats(self):
+        """Returns the number of buckets, objects and resumable uploads, and the total size of the objects
+
+        Buckets with changes in the journal which aren't loaded yet are loaded first, the
+        others are counted from the snapshot.
+        """
+
+        for bucket_name in list(self._pending):
+            self._load_bucket(bucket_name)
+        return {
+            "buckets": len(self.buckets),
+            "objects": self._object_count,
+            "bytes": self._object_bytes,
+            "resumable": len(self.resumable),
+        }
+
+    def is_blob_referenced(self, blob_id):
+        # Any bucket may reference the blob, but the ones without deduplicated objects
+        # don't need to be loaded to know they don't
+        for bucket_name in list(self._unloaded):
+            if bucket_name in self._pending or self._journal.may_reference_blobs(bucket_name):
+                self._load_bucket(bucket_name)
+        return blob_id in self._references
+
+    def wipe(self):
+        self._journal.remove()
+        self._set_state({}, {}, {}, {})
+
+    def save(self, directory):
+        """Writes the metadata for a snapshot of the storage fs into `directory`
+
+        The snapshot file is part of the storage fs, so it is saved along with the files.
+        """
+
+        self.compact()
+
+    def restore(self, directory):
+        """Loads the metadata of a snapshot, once the storage fs files are restored"""
+
+        self.load()
+
+    def copy_state(self):
+        """Returns a copy of the metadata, to be passed over to `set_state` later
+
+        Resources are replaced rather than modified once committed, and the data of each
+        bucket is shared until either side changes it, so the cost of a copy depends on the
+        number of buckets rather than of objects.
+        """
+
+        self._load_all()
+        self._shared = set(self.objects) | set(self.blob_ids) | set(self._index)
+        return {
+            "buckets": dict(self.buckets),
+            "objects": dict(self.objects),
+            # Finishing a pending upload fills its resource in, they aren't shared
+            "resumable": {file_id: dict(file_obj) for file_id, file_obj in self.resumable.items()},
+            "blob_ids": dict(self.blob_ids),
+            "bucket_index": self._bucket_index.copy(),
+            "index": dict(self._index),
+            "references": dict(self._references),
+            "object_count": self._object_count,
+            "object_bytes": self._object_bytes,
+        }
+
+    def set_state(self, state):
+        """Brings back the metadata copied by `copy_state`, which can be brought back again"""
+
+        self.buckets = dict(state["buckets"])
+        self.objects = dict(state["objects"])
+        self.resumable = {file_id: dict(file_obj) for file_id, file_obj in state["resumable"].items()}
+        self.blob_ids = dict(state["blob_ids"])
+        self._bucket_index = state["bucket_index"].copy()
+        self._index = dict(state["index"])
+        self._references = dict(state["references"])
+        self._object_count = state["object_count"]
+        self._object_bytes = state["object_bytes"]
+        self._unloaded = set()
+        self._pending = {}
+        self._shared = set(self.objects) | set(self.blob_ids) | set(self._index)
+
+
+_SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS buckets (name TEXT PRIMARY KEY, value TEXT NOT NULL) WITHOUT ROWID",
+    # Listings are range scans of the primary key, names sort the same in SQLite and Python
+    # as the UTF-8 byte order is the code point order
+    "CREATE TABLE IF NOT EXISTS objects ("
+    "bucket TEXT NOT NULL, name TEXT NOT NULL, value TEXT NOT NULL, blob TEXT, PRIMARY KEY (bucket, name)"
+    ") WITHOUT ROWID",
+    "CREATE INDEX IF NOT EXISTS objects_blob ON objects (blob) WHERE blob IS NOT NULL",
+    "CREATE TABLE IF NOT EXISTS resumable (id TEXT PRIMARY KEY, bucket TEXT, value TEXT NOT NULL) WITHOUT ROWID",
+    "CREATE INDEX IF NOT EXISTS resumable_bucket ON resumable (bucket)",
+    # Statistics of the metadata, updated along with it so they never need counting
+    "CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL) WITHOUT ROWID",
+)
+
+_TABLES = ("buckets", "objects", "resumable", "counters")
+
+_COUNTERS = ("buckets", "objects", "bytes", "resumable")
+
+
+def _create_schema(db):
+    for statement in _SCHEMA:
+        db.execute(statement)
+
+
+def _dumps(value):
+    return json.dumps(value, separators=(",", ":"))
+
+
+class SQLiteMetadata(object):
+    """Metadata stored in a SQLite database, only loaded in memory as needed
+
+    Each record is committed in its own transaction, in WAL mode, so writes cost the same
+    whatever the number of objects. Listings are range scans of the `(bucket, name)`
+    primary key, skipping the names under a common prefix when rolling them up.
+
+    The metadata of a storage previously using the journal is imported when the database
+    is created.
+    """
+
+    # Files of the storage fs written in place, which snapshots can't share
+    files = (DATABASE_FILE, DATABASE_FILE + "-wal", DATABASE_FILE + "-shm", DATABASE_FILE + "-journal")
+
+    def __init__(self, storage_fs, journal):
+        self._fs = storage_fs
+        self._journal = journal
+        self._db = None
+
+    def _path(self):
+        return self._fs.getsyspath(DATABASE_FILE)
+
+    def load(self):
+        self.close()
+        created = not os.path.exists(self._path())
+        # Transactions are handled explicitly. The storage lock serializes the threads using
+        # the connection, and the processes sharing the database.
+        self._db = sqlite3.connect(self._path(), timeout=30, isolation_level=None, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        _create_schema(self._db)
+        if created:
+            self._import_journal()
+        if self._db.execute("SELECT COUNT(*) FROM counters").fetchone()[0] != len(_COUNTERS):
+            self._init_counters()
+
+    def _init_counters(self):
+        # Only for databases written before the counters existed, which have to be counted once
+        with self._transaction():
+            counters = {
+                "buckets": self._db.execute("SELECT COUNT(*) FROM buckets").fetchone()[0],
+                "objects": self._db.execute("SELECT COUNT(*) FROM objects").fetchone()[0],
+                "bytes": object_sizes(json.loads(value) for value, in self._db.execute("SELECT value FROM objects")),
+                "resumable": self._db.execute("SELECT COUNT(*) FROM resumable").fetchone()[0],
+            }
+            self._db.executemany("INSERT OR REPLACE INTO counters (name, value) VALUES (?, ?)", counters.items())
+
+    def _count(self, **deltas):
+        for name, delta in deltas.items():
+            if delta:
+                self._db.execute("UPDATE counters SET value = value + ? WHERE name = ?", (delta, name))
+
+    def _import_journal(self):
+        journaled = JournaledMetadata(self._journal)
+        journaled.load()
+        metadata = journaled.to_dict()
+        if not any(metadata.values()):
+            return
+
+        logger.info("Importing the journaled metadata into the SQLite database")
+        blob_ids = metadata["blob_ids"]
+        with self._transaction():
+            self._db.executemany(
+                "INSERT INTO buckets (name, value) VALUES (?, ?)",
+                ((name, _dumps(value)) for name, value in metadata["buckets"].items()),
+            )
+            self._db.executemany(
+                "INSERT INTO objects (bucket, name, value, blob) VALUES (?, ?, ?, ?)",
+                (
+                    (bucket_name, name, _dumps(value), blob_ids.get(bucket_name, {}).get(name))
+                    for bucket_name, bucket_objects in metadata["objects"].items()
+                    for name, value in bucket_objects.items()
+                ),
+            )
+            self._db.executemany(
+                "INSERT INTO resumable (id, bucket, value) VALUES (?, ?, ?)",
+                ((file_id, value.get("bucket"), _dumps(value)) for file_id, value in metadata["resumable"].items()),
+            )
+        self._journal.remove()
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    @contextmanager
+    def _transaction(self):
+        self._db.execute("BEGIN")
+        try:
+            yield
+        except BaseException:
+            self._db.execute("ROLLBACK")
+            raise
+        self._db.execute("COMMIT")
+
+    def sync(self):
+        # Other processes write to the same database, nothing is cached
+        pass
+
+    def commit(self, record):
+        with self._transaction():
+            self._apply_record(record)
+
+    def _apply_record(self, record):
+        op = record["op"]
+        if op == "put_bucket":
+            if self.get_bucket(record["name"]) is None:
+                self._count(buckets=1)
+            self._db.execute(
+                "INSERT OR REPLACE INTO buckets (name, value) VALUES (?, ?)",
+                (record["name"], _dumps(record["value"])),
+            )
+        elif op == "delete_bucket":
+            removed = [
+                json.loads(value)
+                for value, in self._db.execute("SELECT value FROM objects WHERE bucket = ?", (record["name"],))
+            ]
+            self._db.execute("DELETE FROM objects WHERE bucket = ?", (record["name"],))
+            cursor = self._db.execute("DELETE FROM buckets WHERE name = ?", (record["name"],))
+            self._count(buckets=-cursor.rowcount, objects=-len(removed), bytes=-object_sizes(removed))
+        elif op == "put_object":
+            previous = self.get_object(record["bucket"], record["name"])
+            if previous is not None:
+                self._count(objects=-1, bytes=-object_sizes((previous,)))
+            self._db.execute(
+                "INSERT OR REPLACE INTO objects (bucket, name, value, blob) VALUES (?, ?, ?, ?)",
+                (record["bucket"], record["name"], _dumps(record["value"]), record.get("blob")),
+            )
+            self._count(objects=1, bytes=object_sizes((record["value"],)))
+        elif op == "delete_object":
+            previous = self.get_object(record["bucket"], record["name"])
+            if previous is not None:
+                self._db.execute(
+                    "DELETE FROM objects WHERE bucket = ? AND name = ?", (record["bucket"], record["name"])
+                )
+                self._count(objects=-1, bytes=-object_sizes((previous,)))
+        elif op == "put_resumable":
+            if self.get_resumable(record["id"]) is None:
+                self._count(resumable=1)
+            self._db.execute(
+                "INSERT OR REPLACE INTO resumable (id, bucket, value) VALUES (?, ?, ?)",
+                (record["id"], record["value"].get("bucket"), _dumps(record["value"])),
+            )
+        elif op == "delete_resumable":
+            cursor = self._db.execute("DELETE FROM resumable WHERE id = ?", (record["id"],))
+            self._count(resumable=-cursor.rowcount)
+        else:
+            logger.warning("Unknown metadata operation '{}'".format(op))
+
+    def to_dict(self):
+        """Returns the whole metadata as dicts, which can be big"""
+
+        objects = {}
+        blob_ids = {}
+        for bucket_name, name, value, blob_id in self._db.execute("SELECT bucket, name, value, blob FROM objects"):
+            objects.setdefault(bucket_name, {})[name] = json.loads(value)
+            if blob_id is not None:
+                blob_ids.setdefault(bucket_name, {})[name] = blob_id
+        resumable = {
+            file_id: json.loads(value)
+            for file_id, value in self._db.execute("SELECT id, value FROM resumable")
+        }
+        return {"buckets": self.get_buckets(), "objects": objects, "resumable": resumable, "blob_ids": blob_ids}
+
+    def _fetch_value(self, query, params):
+        row = self._db.execute(query, params).fetchone()
+        return json.loads(row[0]) if row is not None else None
+
+    def get_bucket(self, bucket_name):
+        return self._fetch_value("SELECT value FROM buckets WHERE name = ?", (bucket_name,))
+
+    def get_buckets(self):
+        return {name: json.loads(value) for name, value in self._db.execute("SELECT name, value FROM buckets")}
+
+    def _range_query(self, table, columns, where, params, start, end, limit=None):
+        query = "SELECT {} FROM {} WHERE {}name >= ?".format(columns, table, where)
+        params = params + (start,)
+        if end is not None:
+            query += " AND name < ?"
+            params += (end,)
+        query += " ORDER BY name"
+        if limit is not None:
+            query += " LIMIT ?"
+            params += (limit,)
+        return self._db.execute(query, params)
+
+    def list_buckets(self, prefix=None, start_at=None, max_results=None):
+        prefix = prefix or ""
+        start = max(prefix, start_at) if start_at is not None else prefix
+        limit = max_results + 1 if max_results is not None else None
+        rows = self._range_query("buckets", "name, value", "", (), start, prefix_upper_bound(prefix), limit).fetchall()
+
+        next_start = None
+        if max_results is not None and len(rows) > max_results:
+            rows = rows[:max_results]
+            next_start = rows[-1][0] + "\0"
+        return [json.loads(value) for _, value in rows], next_start
+
+    def get_object(self, bucket_name, file_name):
+        return self._fetch_value("SELECT value FROM objects WHERE bucket = ? AND name = ?", (bucket_name, file_name))
+
+    def get_blob_id(self, bucket_name, file_name):
+        row = self._db.execute(
+            "SELECT blob FROM objects WHERE bucket = ? AND name = ?", (bucket_name, file_name)
+        ).fetchone()
+        return row[0] if row is not None else None
+
+    def list_objects(self, bucket_name, prefix=None, delimiter=None, start_at=None, max_results=None):
+        """Lists objects the same way as `index.SortedNames.list`, see there for the arguments
+
+        Returns:
+            tuple -- (list of Object resources, list of common prefixes, key of the next page or None)
+        """
+
+        prefix = prefix or ""
+        start = max(prefix, start_at) if start_at is not None else prefix
+        end = prefix_upper_bound(prefix)
+
+        if not delimiter:
+            limit = max_results + 1 if max_results is not None else None
+            rows = self._range_query(
+                "objects", "name, value", "bucket = ? AND ", (bucket_name,), start, end, limit
+            ).fetchall()
+            next_start = None
+            if max_results is not None and len(rows) > max_results:
+                rows = rows[:max_results]
+                next_start = rows[-1][0] + "\0"
+            return [json.loads(value) for _, value in rows], [], next_start
+
+        results = []
+        prefixes = []
+        while start is not None:
+            # Rows are read one by one: once a common prefix is found, the names under it are
+            # skipped by querying again past them
+            cursor = self._range_query("objects", "name, value", "bucket = ? AND ", (bucket_name,), start, end)
+            start = None
+            for name, value in cursor:
+                if max_results is not None and len(results) + len(prefixes) == max_results:
+                    return [json.loads(result) for result in results], prefixes, name
+
+                position = name.find(delimiter, len(prefix))
+                if position == -1:
+                    results.append(value)
+                    continue
+
+                common_prefix = name[:position + len(delimiter)]
+                prefixes.append(common_prefix)
+                start = prefix_upper_bound(common_prefix)
+                break
+
+        return [json.loads(result) for result in results], prefixes, None
+
+    def has_objects(self, bucket_name):
+        return self._db.execute("SELECT 1 FROM objects WHERE bucket = ? LIMIT 1", (bucket_name,)).fetchone() is not None
+
+    def get_resumable(self, file_id):
+        return self._fetch_value("SELECT value FROM resumable WHERE id = ?", (file_id,))
+
+    def has_resumable(self, bucket_name):
+        return self._db.execute(
+            "SELECT 1 FROM resumable WHERE bucket = ? LIMIT 1", (bucket_name,)
+        ).fetchone() is not None
+
+    def is_blob_referenced(self, blob_id):
+        return self._db.execute("SELECT 1 FROM objects WHERE blob = ? LIMIT 1", (blob_id,)).fetchone() is not None
+
+    def wipe(self):
+        # The database is emptied rather than deleted, other processes may be using it
+        with self._transaction():
+            for table in _TABLES:
+                self._db.execute("DELETE FROM {}".format(table))
+            self._db.executemany("INSERT INTO counters (name, value) VALUES (?, 0)", ((name,) for name in _COUNTERS))
+
+    def stats(self):
+        """Returns the number of buckets, objects and resumable uploads, and the total size of the objects"""
+
+        counters = dict(self._db.execute("SELECT name, value FROM counters"))
+        return {name: counters.get(name, 0) for name in _COUNTERS}
+
+    def save(self, directory):
+        """Copies the metadata into a new database in `directory`, for a snapshot of the storage fs"""
+
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, DATABASE_FILE)
+        snapshot_db = sqlite3.connect(path)
+        try:
+            _create_schema(snapshot_db)
+            snapshot_db.commit()
+        finally:
+            snapshot_db.close()
+        self._copy_tables(path, into_snapshot=True)
+
+    def restore(self, directory):
+        """Replaces the metadata with the one saved in `directory` by `save`
+
+        The rows are copied into the database rather than replacing it, as other processes
+        may be using it.
+        """
+
+        self._copy_tables(os.path.join(directory, DATABASE_FILE), into_snapshot=False)
+
+    def _copy_tables(self, path, into_snapshot):
+        self._db.execute("ATTACH DATABASE ? AS snapshot", (path,))
+        source, destination = ("main", "snapshot") if into_snapshot else ("snapshot", "main")
+        try:
+            with self._transaction():
+                for table in _TABLES:
+                    self._db.execute("DELETE FROM {}.{}".format(destination, table))
+                    self._db.execute("INSERT INTO {}.{} SELECT * FROM {}.{}".format(destination, table, source, table))
+        finally:
+            self._db.execute("DETACH DATABASE snapshot")
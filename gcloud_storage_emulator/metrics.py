@@ -0,0 +1,178 @@
+import threading
+import time
+from bisect import bisect_left
+
+# Upper bounds, in seconds, of the request latency histogram buckets
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Route of the requests which didn't match any, so that arbitrary paths can't add series
+UNMATCHED_ROUTE = "unmatched"
+
+PREFIX = "gcs_emulator"
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _escape(value):
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _labels(**labels):
+    return ",".join('{}="{}"'.format(name, _escape(str(value))) for name, value in labels.items())
+
+
+def _format_number(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+class _RouteStats(object):
+    """Latency histogram and byte counters of the requests of a route and method"""
+
+    __slots__ = ("buckets", "sum", "count", "bytes_in", "bytes_out")
+
+    def __init__(self):
+        # Number of requests in each latency bucket, the last one for the slower ones
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+
+class Metrics(object):
+    """Request metrics of a server, rendered in the Prometheus text format
+
+    Recording a request costs a lock and a few dict operations: it is meant to be left on.
+    Series are kept by route pattern rather than by path, so their number stays bounded.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        # Requests by (route, method, status)
+        self._requests = {}
+        # _RouteStats by (route, method)
+        self._routes = {}
+        # Seconds spent in each stage of the requests, see the timing module
+        self._stages = {}
+
+    def start_request(self):
+        """Counts a request in flight
+
+        Returns:
+            float -- The start time of the request, to pass over to `end_request`
+        """
+
+        with self._lock:
+            self._in_flight += 1
+        return time.perf_counter()
+
+    def end_request(self, start, route, method, status, bytes_in, bytes_out, stages=None):
+        """Records a request once its response is sent
+
+        Arguments:
+            start {float} -- As returned by `start_request`
+            route {str} -- The pattern of the route the request matched
+            method {str} -- The HTTP method of the request
+            status {int} -- The status code of the response
+            bytes_in {int} -- Size of the request body
+            bytes_out {int} -- Size of the response body
+
+        Keyword Arguments:
+            stages {dict} -- Seconds spent by the request in each stage (default: {None})
+        """
+
+        duration = time.perf_counter() - start
+        bucket = bisect_left(LATENCY_BUCKETS, duration)
+        key = (route, method)
+        with self._lock:
+            self._in_flight -= 1
+            request_key = (route, method, status)
+            self._requests[request_key] = self._requests.get(request_key, 0) + 1
+
+            stats = self._routes.get(key)
+            if stats is None:
+                stats = self._routes[key] = _RouteStats()
+            stats.buckets[bucket] += 1
+            stats.sum += duration
+            stats.count += 1
+            stats.bytes_in += bytes_in
+            stats.bytes_out += bytes_out
+
+            if stages:
+                for stage, seconds in stages.items():
+                    self._stages[stage] = self._stages.get(stage, 0.0) + seconds
+
+    def render(self, storage_stats=None):
+        """Renders the metrics in the Prometheus text exposition format
+
+        Keyword Arguments:
+            storage_stats {dict} -- As returned by `Storage.stats`, exposed as gauges (default: {None})
+
+        Returns:
+            str -- The metrics
+        """
+
+        with self._lock:
+            in_flight = self._in_flight
+            requests = sorted(self._requests.items())
+            routes = sorted(
+                (key, (list(stats.buckets), stats.sum, stats.count, stats.bytes_in, stats.bytes_out))
+                for key, stats in self._routes.items()
+            )
+            stages = list(self._stages.items())
+
+        lines = []
+
+        def metric(name, metric_type, help_text, samples):
+            lines.append("# HELP {}_{} {}".format(PREFIX, name, help_text))
+            lines.append("# TYPE {}_{} {}".format(PREFIX, name, metric_type))
+            for suffix, labels, value in samples:
+                lines.append("{}_{}{}{} {}".format(
+                    PREFIX, name, suffix, "{" + labels + "}" if labels else "", _format_number(value)
+                ))
+
+        metric("requests_in_flight", "gauge", "Requests being served.", [("", "", in_flight)])
+        metric("requests_total", "counter", "Requests served, by route, method and status code.", [
+            ("", _labels(route=route, method=method, status=status), count)
+            for (route, method, status), count in requests
+        ])
+
+        histogram = []
+        for (route, method), (buckets, total, count, _, _) in routes:
+            cumulative = 0
+            for bound, bucket_count in zip(LATENCY_BUCKETS + (float("inf"),), buckets):
+                cumulative += bucket_count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                histogram.append(("_bucket", _labels(route=route, method=method, le=le), cumulative))
+            histogram.append(("_sum", _labels(route=route, method=method), total))
+            histogram.append(("_count", _labels(route=route, method=method), count))
+        metric("request_duration_seconds", "histogram", "Time spent serving requests, by route and method.", histogram)
+
+        metric("request_bytes_total", "counter", "Bytes received in request bodies, by route and method.", [
+            ("", _labels(route=route, method=method), bytes_in)
+            for (route, method), (_, _, _, bytes_in, _) in routes
+        ])
+        metric("response_bytes_total", "counter", "Bytes sent in response bodies, by route and method.", [
+            ("", _labels(route=route, method=method), bytes_out)
+            for (route, method), (_, _, _, _, bytes_out) in routes
+        ])
+
+        metric("request_stage_seconds_total", "counter", "Time spent by the requests in each stage.", [
+            ("", _labels(stage=stage), seconds)
+            for stage, seconds in stages
+        ])
+
+        if storage_stats is not None:
+            metric("buckets", "gauge", "Buckets in the storage.", [("", "", storage_stats["buckets"])])
+            metric("objects", "gauge", "Objects in the storage.", [("", "", storage_stats["objects"])])
+            metric("object_bytes", "gauge", "Total size of the objects in the storage.", [
+                ("", "", storage_stats["bytes"])
+            ])
+            metric("resumable_uploads", "gauge", "Resumable upload sessions not finished yet.", [
+                ("", "", storage_stats["resumable"])
+            ])
+
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,193 @@
+import binascii
+import email.message
+import email.parser
+
+# Size of the reads issued on the underlying stream
+CHUNK_SIZE = 256 * 1024
+
+# Maximum size of the headers of a single part
+MAX_HEADERS_SIZE = 64 * 1024
+
+
+class MultipartError(ValueError):
+    pass
+
+
+def get_boundary(content_type):
+    """Extracts the boundary parameter of a multipart Content-Type header
+
+    Raises:
+        MultipartError: If the header has no boundary
+    """
+
+    message = email.message.Message()
+    message["Content-Type"] = content_type
+    boundary = message.get_param("boundary")
+    if not boundary:
+        raise MultipartError("Missing multipart boundary in '{}'".format(content_type))
+    return boundary
+
+
+class MultipartReader(object):
+    """Incremental parser of multipart bodies (RFC 2046)
+
+    Parts are read one after the other straight from the underlying stream: at most one
+    chunk of the body is held in memory at any time, whatever the size of the parts.
+
+        reader = MultipartReader(stream, boundary)
+        part = reader.next_part()
+        while part is not None:
+            part.headers.get_content_type(), part.read(...)
+            part = reader.next_part()
+    """
+
+    def __init__(self, stream, boundary, chunk_size=CHUNK_SIZE):
+        self._stream = stream
+        self._chunk_size = chunk_size
+        self._delimiter = b"\r\n--" + boundary.encode("latin-1")
+        # The first delimiter of the body isn't preceded by a line break
+        self._buffer = bytearray(b"\r\n")
+        self._eof = False
+        self._at_delimiter = False
+        self._done = False
+
+    def _fill(self):
+        if self._eof:
+            return False
+        data = self._stream.read(self._chunk_size)
+        if not data:
+            self._eof = True
+            return False
+        self._buffer += data
+        return True
+
+    def _read_line(self, limit):
+        while True:
+            index = self._buffer.find(b"\r\n")
+            if index != -1:
+                line = bytes(self._buffer[:index])
+                del self._buffer[:index + 2]
+                return line
+            if len(self._buffer) > limit or not self._fill():
+                raise MultipartError("Malformed multipart body")
+
+    def _read_data(self, size):
+        """Returns up to `size` bytes of the current part, or b"" once it is over"""
+
+        if self._at_delimiter:
+            return b""
+
+        while True:
+            index = self._buffer.find(self._delimiter)
+            if index != -1:
+                available = index
+                break
+            # Keep enough bytes to recognize a delimiter split across two reads
+            available = len(self._buffer) - len(self._delimiter) + 1
+            if available >= self._chunk_size:
+                break
+            if not self._fill():
+                raise MultipartError("Unexpected end of multipart body")
+
+        if size is not None and 0 <= size < available:
+            available = size
+        data = bytes(self._buffer[:available])
+        del self._buffer[:available]
+
+        if self._buffer.startswith(self._delimiter):
+            del self._buffer[:len(self._delimiter)]
+            self._at_delimiter = True
+        return data
+
+    def next_part(self):
+        """Moves on to the next part of the body
+
+        The rest of the current part, if any, is skipped.
+
+        Returns:
+            MultipartPart -- The next part, or None after the last one
+        """
+
+        if self._done:
+            return None
+
+        while self._read_data(self._chunk_size):
+            pass
+
+        # The delimiter is followed by "--" for the closing one, or by a line break
+        while len(self._buffer) < 2 and self._fill():
+            pass
+        if self._buffer.startswith(b"--"):
+            self._done = True
+            return None
+        self._read_line(MAX_HEADERS_SIZE)
+
+        header_lines = []
+        while True:
+            line = self._read_line(MAX_HEADERS_SIZE)
+            if not line:
+                break
+            header_lines.append(line)
+            if sum(len(header_line) for header_line in header_lines) > MAX_HEADERS_SIZE:
+                raise MultipartError("Multipart headers too long")
+
+        headers = email.parser.BytesHeaderParser().parsebytes(b"\r\n".join(header_lines) + b"\r\n\r\n")
+        self._at_delimiter = False
+        part = MultipartPart(self, headers)
+        if headers.get("Content-Transfer-Encoding", "").strip().lower() == "base64":
+            return _Base64Part(part)
+        return part
+
+
+class MultipartPart(object):
+    """Readable content of a single part of a multipart body"""
+
+    def __init__(self, reader, headers):
+        self._reader = reader
+        self.headers = headers
+
+    def get_content_type(self):
+        return self.headers.get_content_type()
+
+    def read(self, size=-1):
+        if size is not None and size >= 0:
+            return self._reader._read_data(size)
+
+        chunks = []
+        while True:
+            chunk = self._reader._read_data(None)
+            if not chunk:
+                return b"".join(chunks)
+            chunks.append(chunk)
+
+
+class _Base64Part(object):
+    """Decodes a base64 encoded part on the fly"""
+
+    def __init__(self, part):
+        self._part = part
+        self.headers = part.headers
+        self._pending = b""
+
+    def get_content_type(self):
+        return self._part.get_content_type()
+
+    def read(self, size=-1):
+        while True:
+            chunk = self._part.read(size)
+            data = self._pending + b"".join(chunk.split())
+            if not chunk:
+                self._pending = b""
+                try:
+                    return binascii.a2b_base64(data)
+                except binascii.Error:
+                    raise MultipartError("Invalid base64 content")
+
+            # Only whole quantums of 4 characters can be decoded
+            decodable = len(data) - len(data) % 4
+            self._pending = data[decodable:]
+            if decodable:
+                try:
+                    return binascii.a2b_base64(data[:decodable])
+                except binascii.Error:
+                    raise MultipartError("Invalid base64 content")
@@ -0,0 +1,122 @@
+import base64
+
+from gcloud_storage_emulator.exceptions import PreconditionFailed
+
+# Query parameters of the preconditions on the generation and metageneration of an object
+IF_GENERATION_MATCH = "ifGenerationMatch"
+IF_GENERATION_NOT_MATCH = "ifGenerationNotMatch"
+IF_METAGENERATION_MATCH = "ifMetagenerationMatch"
+IF_METAGENERATION_NOT_MATCH = "ifMetagenerationNotMatch"
+PARAMETERS = (IF_GENERATION_MATCH, IF_GENERATION_NOT_MATCH, IF_METAGENERATION_MATCH, IF_METAGENERATION_NOT_MATCH)
+
+# Preconditions whose failure on a read means the client's copy is still valid
+NOT_MATCH_PARAMETERS = (IF_GENERATION_NOT_MATCH, IF_METAGENERATION_NOT_MATCH)
+
+
+def _varint(value):
+    encoded = bytearray()
+    while True:
+        byte = value & 0x7F
+        value >>= 7
+        if value:
+            encoded.append(byte | 0x80)
+        else:
+            encoded.append(byte)
+            return bytes(encoded)
+
+
+def make_etag(generation, metageneration):
+    """Returns the etag of an object version, encoded as GCS does
+
+    GCS etags are the base64 of a protobuf message holding the generation (field 1) and the
+    metageneration (field 2), so they change whenever the content or the metadata do.
+
+    Arguments:
+        generation {int} -- Generation of the object
+        metageneration {int} -- Metageneration of the object
+
+    Returns:
+        str -- The etag
+    """
+
+    message = b"\x08" + _varint(int(generation)) + b"\x10" + _varint(int(metageneration))
+    return base64.b64encode(message).decode("ascii")
+
+
+def from_query(query):
+    """Reads the preconditions from the query parameters of a request
+
+    Arguments:
+        query {dict} -- The parsed query string, as lists of values by name
+
+    Raises:
+        ValueError: If a precondition isn't an integer
+
+    Returns:
+        dict -- The preconditions, as integers by parameter name
+    """
+
+    preconditions = {}
+    for parameter in PARAMETERS:
+        values = query.get(parameter)
+        if values:
+            preconditions[parameter] = int(values[0])
+    return preconditions
+
+
+def check(file_obj, preconditions):
+    """Checks the preconditions against the current version of an object
+
+    A missing object has the generation 0, so that `ifGenerationMatch=0` only holds when the
+    object doesn't exist, and no metageneration.
+
+    Arguments:
+        file_obj {dict} -- GCS-like Object resource, or None if the object doesn't exist
+        preconditions {dict} -- As returned by `from_query`
+
+    Raises:
+        PreconditionFailed: If a precondition doesn't hold
+    """
+
+    if not preconditions:
+        return
+
+    generation = int(file_obj["generation"]) if file_obj is not None else 0
+    metageneration = int(file_obj["metageneration"]) if file_obj is not None else None
+
+    for parameter, value in preconditions.items():
+        if parameter == IF_GENERATION_MATCH:
+            holds = generation == value
+        elif parameter == IF_GENERATION_NOT_MATCH:
+            holds = generation != value
+        elif parameter == IF_METAGENERATION_MATCH:
+            holds = metageneration == value
+        else:
+            holds = metageneration != value
+        if not holds:
+            raise PreconditionFailed(parameter)
+
+
+def matches_etag(if_none_match, etag):
+    """Whether an `If-None-Match` header lists the etag
+
+    Arguments:
+        if_none_match {str} -- Value of the header, or None if there is none
+        etag {str} -- The current etag, unquoted
+
+    Returns:
+        bool -- True if the client's copy is current
+    """
+
+    if not if_none_match:
+        return False
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate == "*":
+            return True
+        # Weak comparison, as If-None-Match calls for
+        if candidate.startswith("W/"):
+            candidate = candidate[2:]
+        if candidate.strip('"') == etag:
+            return True
+    return False
@@ -1,15 +1,23 @@
+import io
 import json
 import logging
+import math
+import os
 import re
+import selectors
+import signal
+import socket
 import threading
 import time
-from email.parser import BytesParser
+from concurrent.futures import ThreadPoolExecutor
 from functools import partial
 from http import server, HTTPStatus
 from urllib.parse import parse_qs, urlparse, unquote
 
-from gcloud_storage_emulator import settings
-from gcloud_storage_emulator.handlers import buckets, objects
+from gcloud_storage_emulator import compression, debug, metrics, multipart, settings, timing
+from gcloud_storage_emulator.exceptions import NotFound
+from gcloud_storage_emulator.handlers import batch, buckets, objects
+from gcloud_storage_emulator.metadata import JSON_BACKEND
 from gcloud_storage_emulator.storage import Storage
 
 logger = logging.getLogger(__name__)
@@ -20,6 +28,26 @@ POST = "POST"
 PUT = "PUT"
 DELETE = "DELETE"
 
+# Number of requests served concurrently by a single server
+DEFAULT_WORKERS = 8
+
+# Size of the chunks in which streamed response bodies are written
+STREAM_CHUNK_SIZE = 1024 * 1024
+
+# Seconds after which an idle keep-alive connection is closed
+KEEP_ALIVE_TIMEOUT = 60
+
+# Seconds a client may stall in the middle of a request (e.g. of its body) before its
+# connection is closed, so that it doesn't hold a worker forever
+REQUEST_TIMEOUT = 30
+
+# Request bodies left unread by a handler are skipped to reuse the connection when they
+# are smaller than this, the connection is closed otherwise
+MAX_DISCARDED_BODY_SIZE = 1024 * 1024
+
+# Maximum length of the size line of a chunk, in a chunked request body
+MAX_CHUNK_SIZE_LINE = 1024
+
 
 def _wipe_data(req, res, storage):
     keep_buckets = bool(req.query.get('keep-buckets'))
@@ -31,10 +59,131 @@ def _wipe_data(req, res, storage):
     res.write("OK")
 
 
+def _snapshot(req, res, storage):
+    name = req.query.get("name", [None])[0]
+    if not name:
+        res.status = HTTPStatus.BAD_REQUEST
+        return
+
+    try:
+        storage.snapshot(name)
+    except ValueError as e:
+        logger.error(e)
+        res.status = HTTPStatus.BAD_REQUEST
+        return
+    logger.debug("Storage saved as snapshot '{}'".format(name))
+    res.write("OK")
+
+
+def _restore(req, res, storage):
+    name = req.query.get("name", [None])[0]
+    if not name:
+        res.status = HTTPStatus.BAD_REQUEST
+        return
+
+    try:
+        storage.restore(name)
+    except ValueError as e:
+        logger.error(e)
+        res.status = HTTPStatus.BAD_REQUEST
+        return
+    except NotFound:
+        res.status = HTTPStatus.NOT_FOUND
+        return
+    logger.debug("Storage restored from snapshot '{}'".format(name))
+    res.write("OK")
+
+
 def _health_check(req, res, storage):
     res.write("OK")
 
 
+def _metrics(req, res, storage):
+    text = req.server.metrics.render(storage.stats())
+    res.write_file(text.encode("utf-8"), content_type=metrics.CONTENT_TYPE)
+
+
+def _debug_seconds(req, default):
+    """Returns the `seconds` query parameter, capped, or None if it isn't a valid number"""
+
+    try:
+        seconds = float(req.query.get("seconds", [default])[0])
+    except ValueError:
+        return None
+    if math.isnan(seconds) or seconds < 0:
+        return None
+    return min(seconds, debug.MAX_PROFILE_SECONDS)
+
+
+def _debug_profile(req, res, storage):
+    if not req.server.debug_endpoints:
+        res.status = HTTPStatus.NOT_FOUND
+        return
+
+    seconds = _debug_seconds(req, 10)
+    mode = req.query.get("mode", ["trace"])[0]
+    output_format = req.query.get("format", ["text"])[0]
+    if seconds is None or mode not in ("trace", "sample") or output_format not in ("text", "pstats"):
+        res.status = HTTPStatus.BAD_REQUEST
+        return
+
+    try:
+        with debug.exclusive():
+            if mode == "sample":
+                stacks = debug.sample_stacks(seconds)
+            else:
+                req.server.profiler.start()
+                try:
+                    time.sleep(seconds)
+                finally:
+                    stats = req.server.profiler.stop()
+    except RuntimeError as e:
+        logger.error(e)
+        res.status = HTTPStatus.CONFLICT
+        return
+
+    if mode == "sample":
+        res.write_file(stacks.encode("utf-8"), content_type="text/plain; charset=utf-8")
+    elif output_format == "pstats":
+        res.write_file(debug.dump_stats(stats))
+    else:
+        res.write_file(debug.format_stats(stats).encode("utf-8"), content_type="text/plain; charset=utf-8")
+
+
+def _debug_heap(req, res, storage):
+    if not req.server.debug_endpoints:
+        res.status = HTTPStatus.NOT_FOUND
+        return
+
+    if req.query.get("stop"):
+        debug.stop_tracing_allocations()
+        res.write("OK")
+        return
+
+    seconds = _debug_seconds(req, 0)
+    try:
+        limit = int(req.query.get("limit", [25])[0])
+    except ValueError:
+        limit = None
+    if seconds is None or limit is None or limit < 1:
+        res.status = HTTPStatus.BAD_REQUEST
+        return
+
+    if debug.start_tracing_allocations():
+        logger.info("[API] Tracing memory allocations")
+    try:
+        if seconds > 0:
+            with debug.exclusive():
+                report = debug.heap_report(limit, seconds)
+        else:
+            report = debug.heap_report(limit)
+    except RuntimeError as e:
+        logger.error(e)
+        res.status = HTTPStatus.CONFLICT
+        return
+    res.write_file(report.encode("utf-8"), content_type="text/plain; charset=utf-8")
+
+
 HANDLERS = (
     (r"^{}/b$".format(settings.API_ENDPOINT), {GET: buckets.ls, POST: buckets.insert}),
     (
@@ -67,48 +216,199 @@ HANDLERS = (
         {GET: objects.download},
     ),
 
+    (r"^{}$".format(settings.BATCH_API_ENDPOINT), {POST: batch.batch}),
+
     # Internal API, not supported by the real GCS
     (r"^/$", {GET: _health_check}),  # Health check endpoint
     (r"^/wipe$", {GET: _wipe_data}),  # Wipe all data
+    (r"^/_snapshot$", {GET: _snapshot}),  # Save the storage state under a name
+    (r"^/_restore$", {GET: _restore}),  # Bring back a saved storage state
+    (r"^/metrics$", {GET: _metrics}),  # Request and storage metrics, for Prometheus
+    (r"^/_debug/profile$", {GET: _debug_profile}),  # Profile the requests, with --debug-endpoints
+    (r"^/_debug/heap$", {GET: _debug_heap}),  # Top memory allocations, with --debug-endpoints
 
     # Public file serving, same as object.download
     (r"^/(?P<bucket_name>[-.\w]+)/(?P<object_id>.*[^/]+)$", {GET: objects.download}),
 )
 
 
-def _read_data(request_handler):
-    if not request_handler.headers["Content-Length"] or not request_handler.headers["Content-Type"]:
-        return None
+# Literal first segment of a route pattern's path, e.g. "storage" for "^/storage/v1/b$"
+_ROUTE_PREFIX_RE = re.compile(r"\^/([-.\w]*)(?:/|\$)")
+
+# Named group of a route pattern, without nested groups
+_ROUTE_PARAM_RE = re.compile(r"\(\?P<(\w+)>[^()]*\)")
+
+
+def _route_label(regex):
+    """Returns a readable version of a route pattern, e.g. "/storage/v1/b/{bucket_name}" for metrics"""
+
+    return _ROUTE_PARAM_RE.sub(r"{\1}", regex).lstrip("^").rstrip("$")
+
+
+def _compile_routes(handlers):
+    """Compiles the route patterns, bucketed by the first segment of the paths they match
+
+    Requests then only try the patterns of their own bucket (e.g. "storage", "upload"...)
+    before the generic ones, whose first segment isn't literal (e.g. public object URLs).
+    Within a bucket patterns are tried in the order of `handlers`.
+
+    Returns:
+        tuple -- (dict of route lists by first path segment, list of generic routes), each
+                 route being a (compiled pattern, dict of handlers by method, label) tuple
+    """
+
+    routes = {}
+    generic_routes = []
+    for regex, methods in handlers:
+        route = (re.compile(regex), methods, _route_label(regex))
+        prefix_match = _ROUTE_PREFIX_RE.match(regex)
+        if prefix_match:
+            routes.setdefault(prefix_match.group(1), []).append(route)
+        else:
+            generic_routes.append(route)
+    return routes, generic_routes
+
 
-    raw_data = request_handler.rfile.read(int(request_handler.headers["Content-Length"]))
+ROUTES, GENERIC_ROUTES = _compile_routes(HANDLERS)
+
+
+def _find_route(path, routes=None):
+    """Finds the route of a request path
+
+    Keyword Arguments:
+        routes {tuple} -- As returned by `_compile_routes`, defaults to the routes of `HANDLERS`
+
+    Returns:
+        tuple -- (match object, dict of handlers by method, route label), or (None, None, None)
+                 if no route matches
+    """
+
+    prefixed_routes, generic_routes = routes if routes is not None else (ROUTES, GENERIC_ROUTES)
+    segment = path[1:].split("/", 1)[0]
+    for candidates in (prefixed_routes.get(segment, ()), generic_routes):
+        for pattern, methods, label in candidates:
+            match = pattern.fullmatch(path)
+            if match:
+                return match, methods, label
+    return None, None, None
+
+
+class _BodyReader(object):
+    """Reads the body of a request, without ever reading past its Content-Length"""
+
+    def __init__(self, rfile, length):
+        self._rfile = rfile
+        self._remaining = length
+        self.bytes_read = 0
+
+    def read(self, size=-1):
+        if size is None or size < 0 or size > self._remaining:
+            size = self._remaining
+        data = self._rfile.read(size)
+        self._remaining -= len(data)
+        self.bytes_read += len(data)
+        return data
+
+
+_CHUNK_SIZE_RE = re.compile(rb"([0-9a-fA-F]+)[ \t]*(?:;.*)?")
+
+
+class _ChunkedBodyReader(object):
+    """Reads the body of a request sent with `Transfer-Encoding: chunked`
+
+    Raises:
+        ValueError: When reading a malformed or truncated body
+    """
+
+    def __init__(self, rfile):
+        self._rfile = rfile
+        self._remaining = 0
+        self._done = False
+        self.bytes_read = 0
+
+    def _read_line(self):
+        line = self._rfile.readline(MAX_CHUNK_SIZE_LINE + 1)
+        if not line.endswith(b"\n"):
+            raise ValueError("Malformed chunked request body")
+        return line.rstrip(b"\r\n")
+
+    def _next_chunk(self):
+        match = _CHUNK_SIZE_RE.fullmatch(self._read_line())
+        if not match:
+            raise ValueError("Malformed chunked request body")
+
+        self._remaining = int(match.group(1), 16)
+        if self._remaining == 0:
+            # The last chunk can be followed by trailer fields, which are ignored
+            while self._read_line():
+                pass
+            self._done = True
+
+    def read(self, size=-1):
+        chunks = []
+        while not self._done:
+            if self._remaining == 0:
+                self._next_chunk()
+                continue
+
+            if size is None or size < 0:
+                data = self._rfile.read(self._remaining)
+            else:
+                data = self._rfile.read(min(size, self._remaining))
+            if not data:
+                raise ValueError("Truncated chunked request body")
+
+            self._remaining -= len(data)
+            self.bytes_read += len(data)
+            if self._remaining == 0:
+                self._read_line()
+            chunks.append(data)
+            if size is not None and size >= 0:
+                break
+        return b"".join(chunks)
+
+
+def _is_chunked(headers):
+    return "chunked" in (headers.get("Transfer-Encoding") or "").lower()
+
+
+def _read_data(request_handler, body):
+    headers = request_handler.headers
+    if not headers["Content-Type"] or not (headers["Content-Length"] or _is_chunked(headers)):
+        return None
 
     content_type = request_handler.headers["Content-Type"]
 
     if content_type.startswith("application/json"):
         # RFC8259 mandates utf-8
-        return json.loads(raw_data)
+        return json.loads(body.read())
 
     if content_type.startswith("multipart/"):
-        parser = BytesParser()
-        header = bytes("Content-Type:" + content_type + "\r\n", "utf-8")
-
-        msg = parser.parsebytes(header + raw_data)
-        payload = msg.get_payload()
+        reader = multipart.MultipartReader(body, multipart.get_boundary(content_type))
 
         # For multipart upload, google API expect the first item to be a json-encoded
-        # object, and the second (and only other) part, the file content
+        # object, and the second (and only other) part, the file content. The content
+        # isn't read here, but streamed by the handler straight into the storage.
+        meta_part = reader.next_part()
+        meta = json.loads(meta_part.read()) if meta_part is not None else None
+        content_part = reader.next_part()
+        if content_part is None:
+            raise multipart.MultipartError("Expected a metadata and a content part")
+
         return {
-            "meta": json.loads(payload[0].get_payload()),
-            "content": payload[1].get_payload(decode=True),
-            "content-type": payload[1].get_content_type(),
+            "meta": meta,
+            "content": content_part,
+            "content-type": content_part.get_content_type(),
         }
 
-    return raw_data
+    # Any other content is streamed by the handler
+    return body
 
 
 class Request(object):
-    def __init__(self, request_handler, method):
+    def __init__(self, request_handler, method, timer=None):
         super().__init__()
+        self.timer = timer if timer is not None else timing.RequestTimer(time.perf_counter())
         self._path = request_handler.path
         self._request_handler = request_handler
         self._server_address = request_handler.server.server_address
@@ -118,6 +418,7 @@ class Request(object):
         self._query = parse_qs(self._parsed_url.query)
         self._methtod = method
         self._data = None
+        self._body = None
         self._parsed_params = None
 
     @property
@@ -128,6 +429,12 @@ class Request(object):
     def base_url(self):
         return self._base_url
 
+    @property
+    def server(self):
+        """The HTTP server the request came to"""
+
+        return self._request_handler.server
+
     @property
     def full_url(self):
         return self._full_url
@@ -151,10 +458,48 @@ class Request(object):
                 self._parsed_params[k] = unquote(v)
         return self._parsed_params
 
+    @property
+    def body(self):
+        """The raw request body, as a binary file read straight from the connection"""
+
+        if self._body is None:
+            headers = self._request_handler.headers
+            if _is_chunked(headers):
+                self._body = _ChunkedBodyReader(self._request_handler.rfile)
+            else:
+                self._body = _BodyReader(self._request_handler.rfile, int(headers["Content-Length"] or 0))
+        return self._body
+
+    @property
+    def body_size(self):
+        """Number of bytes of the body read so far"""
+
+        return self._body.bytes_read if self._body is not None else 0
+
+    def discard_body(self):
+        """Reads whatever the handler left of the body, so the connection can serve another request
+
+        Returns:
+            bool -- False if the body was too big or malformed: the connection must be closed
+        """
+
+        try:
+            discarded = 0
+            while discarded <= MAX_DISCARDED_BODY_SIZE:
+                chunk = self.body.read(STREAM_CHUNK_SIZE)
+                if not chunk:
+                    return True
+                discarded += len(chunk)
+        except (ValueError, OSError):
+            pass
+        return False
+
     @property
     def data(self):
         if not self._data:
-            self._data = _read_data(self._request_handler)
+            start = time.perf_counter()
+            self._data = _read_data(self._request_handler, self.body)
+            self.timer.add(timing.READ, start)
         return self._data
 
     def get_header(self, key, default=None):
@@ -163,17 +508,75 @@ class Request(object):
     def set_match(self, match):
         self._match = match
 
+    def dispatch(self, method, path, headers, body):
+        """Runs another request through the router, e.g. the requests of a batch
+
+        Arguments:
+            method {str} -- The HTTP method of the request
+            path {str} -- The path of the request, query string included
+            headers {email.message.Message} -- The headers of the request
+            body {bytes} -- The body of the request
+
+        Returns:
+            tuple -- (status code, list of (name, value) header tuples, body bytes)
+        """
+
+        try:
+            return Router.dispatch(self._request_handler, method, path, headers, body)
+        except Exception:
+            return HTTPStatus.INTERNAL_SERVER_ERROR.value, [], b""
+
+
+class _SubRequestHandler(object):
+    """Stands in for the RequestHandler of a request that didn't come from a connection
+
+    The router reads the request and writes the response through it as usual, the response
+    is kept in memory.
+    """
+
+    request_version = "HTTP/1.1"
+    connection = None
+
+    def __init__(self, parent, method, path, headers, body):
+        self.server = parent.server
+        self.storage = parent.storage
+        self.command = method
+        self.path = path
+        self.headers = headers
+        # The body was read as a whole, its framing doesn't apply anymore
+        del self.headers["Transfer-Encoding"]
+        del self.headers["Content-Length"]
+        self.headers["Content-Length"] = str(len(body))
+        self.rfile = io.BytesIO(body)
+        self.wfile = io.BytesIO()
+        self.close_connection = False
+        self.status = None
+        self.response_headers = []
+
+    def send_response(self, code, message=None):
+        self.status = code
+
+    def send_header(self, keyword, value):
+        self.response_headers.append((keyword, value))
+
+    def end_headers(self):
+        pass
+
 
 class Response(object):
-    def __init__(self, handler):
+    def __init__(self, handler, timer=None):
         super().__init__()
         self._handler = handler
+        self._timer = timer if timer is not None else timing.RequestTimer(time.perf_counter())
         self.status = HTTPStatus.OK
         self._headers = {}
         self._content = ""
+        self._stream = None
+        self._content_length = None
+        # Number of bytes of the body sent
+        self.body_size = 0
 
     def write(self, content):
-        logger.warning("[RESPONSE] Content handled as string, should be handled as stream")
         self._content += content
 
     def write_file(self, content, content_type="application/octet-stream"):
@@ -182,9 +585,43 @@ class Response(object):
 
         self._content = content
 
+    def write_stream(self, stream, length=None, content_type="application/octet-stream"):
+        """Streams the content of a binary file as the response body, the file is closed afterwards
+
+        Arguments:
+            stream {file} -- The file to read from, starting at its current position
+
+        Keyword Arguments:
+            length {int} -- Number of bytes to send, defaults to the rest of the file. When it
+                            can't be known, the body is sent with chunked transfer encoding.
+        """
+
+        if content_type is not None:
+            self["Content-type"] = content_type
+
+        if length is None:
+            try:
+                position = stream.tell()
+                length = stream.seek(0, io.SEEK_END) - position
+                stream.seek(position)
+            except (AttributeError, OSError):
+                # Not seekable, e.g. a stream computed on the fly
+                length = None
+
+        self._stream = stream
+        self._content_length = length
+
     def json(self, obj):
+        start = time.perf_counter()
         self["Content-type"] = "application/json"
-        self._content = json.dumps(obj)
+        self._content = json.dumps(obj).encode("utf-8")
+        # The responses of sub-requests (e.g. of a batch) are part of another body
+        if len(self._content) >= compression.MIN_COMPRESSED_SIZE and self._handler.connection is not None:
+            self["Vary"] = "Accept-Encoding"
+            if compression.accepts_gzip(self._handler.headers.get("Accept-Encoding")):
+                self._content = self._handler.server.compression_cache.compress(self._content)
+                self["Content-Encoding"] = compression.GZIP
+        self._timer.add(timing.SERIALIZE, start)
 
     def __setitem__(self, key, value):
         self._headers[key] = value
@@ -193,57 +630,238 @@ class Response(object):
         return self._headers[key]
 
     def close(self):
-        self._handler.send_response(self.status.value, self.status.phrase)
+        start = time.perf_counter()
+        try:
+            self._send()
+        finally:
+            self._timer.add(timing.WRITE, start)
+
+    def _send(self):
+        handler = self._handler
+        handler.send_response(self.status.value, self.status.phrase)
         for (k, v) in self._headers.items():
-            self._handler.send_header(k, v)
+            handler.send_header(k, v)
+        if handler.close_connection:
+            handler.send_header("Connection", "close")
 
-        content = self._content
+        if self._stream is not None:
+            with self._stream as stream:
+                self._send_stream(stream)
+            return
+
+        if self.status == HTTPStatus.NOT_MODIFIED:
+            # Neither a body nor its length: the client keeps the one it has
+            handler.end_headers()
+            return
 
+        content = self._content
         if isinstance(self._content, str):
             content = self._content.encode("utf-8")
 
-        self._handler.send_header("Content-Lenght", str(len(content)))
-        self._handler.end_headers()
-        self._handler.wfile.write(content)
+        handler.send_header("Content-Length", str(len(content)))
+        handler.end_headers()
+        handler.wfile.write(content)
+        self.body_size = len(content)
+
+    def _send_stream(self, stream):
+        handler = self._handler
+        if self._content_length is not None:
+            handler.send_header("Content-Length", str(self._content_length))
+            handler.end_headers()
+            self._write_stream(stream, self._content_length)
+            return
+
+        if handler.request_version < "HTTP/1.1":
+            # HTTP/1.0 clients read the body until the connection is closed
+            handler.close_connection = True
+            handler.end_headers()
+            for chunk in iter(partial(stream.read, STREAM_CHUNK_SIZE), b""):
+                handler.wfile.write(chunk)
+                self.body_size += len(chunk)
+            return
+
+        handler.send_header("Transfer-Encoding", "chunked")
+        handler.end_headers()
+        for chunk in iter(partial(stream.read, STREAM_CHUNK_SIZE), b""):
+            handler.wfile.write("{:x}\r\n".format(len(chunk)).encode("ascii"))
+            handler.wfile.write(chunk)
+            handler.wfile.write(b"\r\n")
+            self.body_size += len(chunk)
+        handler.wfile.write(b"0\r\n\r\n")
+
+    def _write_stream(self, stream, length):
+        connection = self._handler.connection
+        try:
+            stream.fileno()
+        except (AttributeError, io.UnsupportedOperation):
+            pass
+        else:
+            # Actual files are sent by the kernel straight from the page cache, unless the
+            # response doesn't go to a connection (e.g. the requests of a batch)
+            if connection is not None:
+                self.body_size += connection.sendfile(stream, offset=stream.tell(), count=length)
+                return
+
+        while length > 0:
+            chunk = stream.read(min(length, STREAM_CHUNK_SIZE))
+            if not chunk:
+                break
+            self._handler.wfile.write(chunk)
+            self.body_size += len(chunk)
+            length -= len(chunk)
 
 
 class Router(object):
-    def __init__(self, request_handler):
+    def __init__(self, request_handler, routes=None):
+        """
+        Keyword Arguments:
+            routes {tuple} -- As returned by `compile_routes`, defaults to the routes of `HANDLERS`
+        """
+
         super().__init__()
         self._request_handler = request_handler
+        self._routes = routes
 
-    def handle(self, method):
-        request = Request(self._request_handler, method)
-        response = Response(self._request_handler)
+    @staticmethod
+    def compile_routes(handlers):
+        """Compiles routes for a router
 
-        for regex, handlers in HANDLERS:
-            pattern = re.compile(regex)
-            match = pattern.fullmatch(request.path)
-            if match:
-                request.set_match(match)
-                handler = handlers.get(method)
-                try:
-                    handler(request, response, self._request_handler.storage)
-                except Exception as e:
-                    logger.error("An error has occurred while running the handler for {} {}".format(
-                        request.method,
-                        request.full_url,
-                    ))
-                    logger.error(e)
-                    raise e
-                break
-        else:
-            logger.error("Method not implemented: {} - {}".format(request.method, request.path))
-            response.status = HTTPStatus.NOT_IMPLEMENTED
+        Arguments:
+            handlers {list} -- (pattern, dict of handlers by method) tuples, like `HANDLERS`
+
+        Returns:
+            tuple -- The routes, to be passed over to the router
+        """
+
+        return _compile_routes(handlers)
+
+    @staticmethod
+    def find_route(path, routes=None):
+        """Finds the route of a request path, as the router does for each request
+
+        Arguments:
+            path {str} -- The path of the request, without its query string
+
+        Keyword Arguments:
+            routes {tuple} -- As returned by `compile_routes`, defaults to the routes of `HANDLERS`
 
+        Returns:
+            tuple -- (match object, dict of handlers by method, route label), or (None, None, None)
+                     if no route matches
+        """
+
+        return _find_route(path, routes)
+
+    @classmethod
+    def dispatch(cls, parent, method, path, headers, body, routes=None):
+        """Runs a request which didn't come from a connection through a router
+
+        Arguments:
+            parent {RequestHandler} -- The handler whose server and storage serve the request
+            method {str} -- The HTTP method of the request
+            path {str} -- The path of the request, query string included
+            headers {email.message.Message} -- The headers of the request
+            body {bytes} -- The body of the request
+
+        Keyword Arguments:
+            routes {tuple} -- As returned by `compile_routes`, defaults to the routes of `HANDLERS`
+
+        Returns:
+            tuple -- (status code, list of (name, value) header tuples, body bytes)
+        """
+
+        handler = _SubRequestHandler(parent, method, path, headers, body)
+        cls(handler, routes).handle(method)
+        return handler.status, handler.response_headers, handler.wfile.getvalue()
+
+    def handle(self, method):
+        httpd = self._request_handler.server
+        server_metrics = httpd.metrics
+        start = server_metrics.start_request()
+        timer = timing.RequestTimer(start)
+        request = Request(self._request_handler, method, timer)
+        response = Response(self._request_handler, timer)
+
+        match, methods, route = _find_route(request.path, self._routes)
+        timer.add(timing.ROUTE, start)
+        status = HTTPStatus.INTERNAL_SERVER_ERROR
+        try:
+            httpd.profiler.run(self._handle, request, response, match, methods)
+            status = response.status
+        finally:
+            server_metrics.end_request(
+                start,
+                route or metrics.UNMATCHED_ROUTE,
+                method,
+                status.value,
+                request.body_size,
+                response.body_size,
+                stages=timer.stages,
+            )
+            timing.log_if_slow(timer, httpd.slow_request_threshold, method, self._request_handler.path, status.value)
+
+    def _handle(self, request, response, match, methods):
+        method = request.method
+        handler = methods.get(method) if methods else None
+        if match is None:
+            logger.error("Route not found: {} - {}".format(request.method, request.path))
+            response.status = HTTPStatus.NOT_FOUND
+        elif handler is None:
+            logger.error("Method not allowed: {} - {}".format(request.method, request.path))
+            response.status = HTTPStatus.METHOD_NOT_ALLOWED
+            response["Allow"] = ", ".join(sorted(methods))
+        else:
+            request.set_match(match)
+            try:
+                handler(request, response, timing.TimedStorage(self._request_handler.storage, request.timer))
+            except Exception as e:
+                logger.error("An error has occurred while running the handler for {} {}".format(
+                    request.method,
+                    request.full_url,
+                ))
+                logger.error(e)
+                raise e
+
+        if not request.discard_body():
+            self._request_handler.close_connection = True
         response.close()
 
 
 class RequestHandler(server.BaseHTTPRequestHandler):
+    # Connections are kept alive between requests
+    protocol_version = "HTTP/1.1"
+    # Headers and body are sent separately, Nagle's algorithm would hold the body back until
+    # the client acknowledges the headers, which it delays on a kept-alive connection
+    disable_nagle_algorithm = True
+
     def __init__(self, storage, *args, **kwargs):
         self.storage = storage
         super().__init__(*args, **kwargs)
 
+    def handle(self):
+        """Handles the requests the client has sent so far on the connection
+
+        Once they are all handled, the connection is handed back to the server if it is to be
+        kept alive: waiting for the next request doesn't hold a worker.
+        """
+
+        self.close_connection = True
+        self.handle_one_request()
+        while not self.close_connection and self._has_pending_request():
+            self.handle_one_request()
+
+    def _has_pending_request(self):
+        # Pipelined requests may already have been read into the buffer of rfile, which is
+        # dropped with this handler
+        timeout = self.connection.gettimeout()
+        self.connection.setblocking(False)
+        try:
+            return bool(self.rfile.peek(1))
+        except OSError:
+            return False
+        finally:
+            self.connection.settimeout(timeout)
+
     def do_OPTIONS(self):
         self.sendResponse(200, "ok")
 
@@ -268,7 +886,7 @@ class RequestHandler(server.BaseHTTPRequestHandler):
 
     def sendResponse(self, code, body=None, type="text/plain"):
         if code >= 400:
-            if body != None:
+            if body is not None:
                 self.send_error(code, body)
             else:
                 self.send_error(code)
@@ -279,13 +897,134 @@ class RequestHandler(server.BaseHTTPRequestHandler):
             self.send_header("Access-Control-Allow-Methods", "POST, GET, PUT, OPTION, DELETE")
             self.send_header("Access-Control-Allow-Credentials", "true")
             self.send_header("Access-Control-Allow-Headers", "x-csrftoken,X-Custom-Header")
-            if body != None:
+            content = body.encode() if body is not None else b""
+            if body is not None:
                 self.send_header("Content-Type", type)
-                self.end_headers()
-                self.wfile.write(body.encode())
+            self.send_header("Content-Length", str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+
+class ThreadPoolHTTPServer(server.HTTPServer):
+    """HTTPServer handing every connection over to a fixed-size pool of worker threads
+
+    The accept loop keeps running in the serving thread, so a slow client (e.g. a large
+    upload) only ties up one worker instead of blocking every other request.
+
+    Keep-alive connections don't hold a worker while they are idle: between two requests they
+    are watched by a selector, and handed back to the pool once the next request comes in.
+    While a request is served, reads and writes of its connection time out after
+    `request_timeout` seconds, so that stalled clients can't take every worker up.
+    """
+
+    def __init__(self, server_address, RequestHandlerClass, workers=DEFAULT_WORKERS,
+                 keep_alive_timeout=KEEP_ALIVE_TIMEOUT, listening_socket=None, debug_endpoints=False,
+                 slow_request_threshold=timing.DEFAULT_SLOW_REQUEST_THRESHOLD, request_timeout=REQUEST_TIMEOUT):
+        if workers < 1:
+            raise ValueError("workers must be a positive integer")
+        if listening_socket is None:
+            super().__init__(server_address, RequestHandlerClass)
+        else:
+            # Accepting connections on a socket bound by a parent process
+            super().__init__(server_address, RequestHandlerClass, bind_and_activate=False)
+            self.socket.close()
+            self.socket = listening_socket
+            self.server_address = listening_socket.getsockname()
+            self.server_name = socket.getfqdn(self.server_address[0])
+            self.server_port = self.server_address[1]
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="api-worker")
+        self.metrics = metrics.Metrics()
+        self.compression_cache = compression.CompressionCache()
+        self.profiler = debug.RequestProfiler()
+        # Whether the /_debug endpoints answer, they give away the internals of the server
+        self.debug_endpoints = debug_endpoints
+        # Seconds after which requests are logged to the slow log, None to log none
+        self.slow_request_threshold = slow_request_threshold
+
+        self._keep_alive_timeout = keep_alive_timeout
+        self._request_timeout = request_timeout
+        self._idle_lock = threading.Lock()
+        self._idle_selector = selectors.DefaultSelector()
+        self._closed = False
+        # Wakes the selector up when connections are added or the server is closed
+        self._wakeup_reader, self._wakeup_writer = socket.socketpair()
+        self._wakeup_reader.setblocking(False)
+        self._idle_selector.register(self._wakeup_reader, selectors.EVENT_READ)
+        self._idle_thread = threading.Thread(target=self._watch_idle_connections, name="api-keep-alive")
+        self._idle_thread.daemon = True
+        self._idle_thread.start()
+
+    def process_request(self, request, client_address):
+        self._executor.submit(self._process_request_worker, request, client_address)
+
+    def _process_request_worker(self, request, client_address):
+        try:
+            # A timeout while handling the request closes the connection
+            request.settimeout(self._request_timeout)
+            handler = self.RequestHandlerClass(request, client_address, self)
+        except Exception:
+            self.handle_error(request, client_address)
+            self.shutdown_request(request)
+            return
+
+        if handler.close_connection:
+            self.shutdown_request(request)
+        else:
+            self._keep_idle(request, client_address)
+
+    def _keep_idle(self, request, client_address):
+        with self._idle_lock:
+            if self._closed:
+                self.shutdown_request(request)
+                return
+            self._idle_selector.register(request, selectors.EVENT_READ, (client_address, time.monotonic()))
+        self._wakeup_writer.send(b"\0")
+
+    def _watch_idle_connections(self):
+        last_expiry = time.monotonic()
+        while True:
+            events = self._idle_selector.select(timeout=1)
+            with self._idle_lock:
+                if self._closed:
+                    return
+
+                for key, _ in events:
+                    if key.fileobj is self._wakeup_reader:
+                        try:
+                            self._wakeup_reader.recv(4096)
+                        except BlockingIOError:
+                            pass
+                        continue
+                    # The next request is coming in (or the client closed the connection)
+                    self._idle_selector.unregister(key.fileobj)
+                    self._executor.submit(self._process_request_worker, key.fileobj, key.data[0])
+
+                now = time.monotonic()
+                if now - last_expiry >= 1:
+                    last_expiry = now
+                    for key in list(self._idle_selector.get_map().values()):
+                        if key.fileobj is not self._wakeup_reader and now - key.data[1] > self._keep_alive_timeout:
+                            self._idle_selector.unregister(key.fileobj)
+                            self.shutdown_request(key.fileobj)
+
+    def server_close(self):
+        super().server_close()
+        with self._idle_lock:
+            self._closed = True
+            for key in list(self._idle_selector.get_map().values()):
+                if key.fileobj is not self._wakeup_reader:
+                    self.shutdown_request(key.fileobj)
+        self._wakeup_writer.send(b"\0")
+        self._idle_thread.join()
+        self._idle_selector.close()
+        self._wakeup_reader.close()
+        self._wakeup_writer.close()
+        self._executor.shutdown(wait=True)
+
 
 class APIThread(threading.Thread):
-    def __init__(self, host, port, storage, *args, **kwargs):
+    def __init__(self, host, port, storage, *args, workers=DEFAULT_WORKERS, debug_endpoints=False,
+                 slow_request_threshold=timing.DEFAULT_SLOW_REQUEST_THRESHOLD, **kwargs):
         super().__init__(*args, **kwargs)
 
         self._host = host
@@ -293,9 +1032,18 @@ class APIThread(threading.Thread):
         self.is_running = threading.Event()
         self._httpd = None
         self._storage = storage
+        self._workers = workers
+        self._debug_endpoints = debug_endpoints
+        self._slow_request_threshold = slow_request_threshold
 
     def run(self):
-        self._httpd = server.HTTPServer((self._host, self._port), partial(RequestHandler, self._storage))
+        self._httpd = ThreadPoolHTTPServer(
+            (self._host, self._port),
+            partial(RequestHandler, self._storage),
+            workers=self._workers,
+            debug_endpoints=self._debug_endpoints,
+            slow_request_threshold=self._slow_request_threshold,
+        )
         self.is_running.set()
         self._httpd.serve_forever()
 
@@ -307,13 +1055,140 @@ class APIThread(threading.Thread):
             self._httpd.server_close()
 
 
+class APIProcesses(object):
+    """Serves the API from several forked processes, accepting connections on the same socket
+
+    Each process has its own pool of worker threads and its own Storage instance, the
+    instances share the on-disk storage. Spreading requests over processes lets hashing and
+    large transfers use more than one core.
+    """
+
+    def __init__(self, host, port, processes, workers=DEFAULT_WORKERS, dedup=False, metadata_backend=JSON_BACKEND,
+                 data_dir=settings.STORAGE_BASE, debug_endpoints=False,
+                 slow_request_threshold=timing.DEFAULT_SLOW_REQUEST_THRESHOLD):
+        if not hasattr(os, "fork"):
+            raise RuntimeError("Serving from several processes requires os.fork")
+
+        self._host = host
+        self._port = port
+        self._processes = processes
+        self._workers = workers
+        self._dedup = dedup
+        self._metadata_backend = metadata_backend
+        self._data_dir = data_dir
+        self._debug_endpoints = debug_endpoints
+        self._slow_request_threshold = slow_request_threshold
+        self._pids = []
+        self.is_running = threading.Event()
+
+    def start(self):
+        # Bound before forking, so the kernel spreads the connections over the processes
+        listening_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            listening_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            listening_socket.bind((self._host, self._port))
+            listening_socket.listen(ThreadPoolHTTPServer.request_queue_size)
+            for _ in range(self._processes):
+                pid = os.fork()
+                if pid == 0:
+                    self._serve(listening_socket)
+                self._pids.append(pid)
+        finally:
+            listening_socket.close()
+        self.is_running.set()
+
+    def _serve(self, listening_socket):
+        # Runs in the forked process, which must never return to the caller's code
+        status = 1
+        try:
+            storage = Storage(
+                data_dir=self._data_dir, dedup=self._dedup, shared=True, metadata_backend=self._metadata_backend
+            )
+            httpd = ThreadPoolHTTPServer(
+                (self._host, self._port),
+                partial(RequestHandler, storage),
+                workers=self._workers,
+                listening_socket=listening_socket,
+                debug_endpoints=self._debug_endpoints,
+                slow_request_threshold=self._slow_request_threshold,
+            )
+            # shutdown() waits for serve_forever() to return, it can't be called from its thread
+            signal.signal(signal.SIGTERM, lambda *args: threading.Thread(target=httpd.shutdown).start())
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            httpd.serve_forever()
+            httpd.server_close()
+            status = 0
+        except Exception:
+            logger.exception("[API] Worker process {} failed".format(os.getpid()))
+        finally:
+            os._exit(status)
+
+    def join(self, timeout=None):
+        self.is_running.clear()
+        logger.info("[API] Stopping API server processes")
+        for pid in self._pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+        deadline = time.monotonic() + (timeout if timeout is not None else KEEP_ALIVE_TIMEOUT)
+        for pid in self._pids:
+            while True:
+                try:
+                    done, _ = os.waitpid(pid, os.WNOHANG)
+                except ChildProcessError:
+                    break
+                if done:
+                    break
+                if time.monotonic() > deadline:
+                    os.kill(pid, signal.SIGKILL)
+                    os.waitpid(pid, 0)
+                    break
+                time.sleep(0.01)
+        self._pids = []
+
+
 class Server(object):
-    def __init__(self, host, port, in_memory=False, default_bucket=None):
-        self._storage = Storage(use_memory_fs=in_memory)
+    def __init__(self, host, port, in_memory=False, default_bucket=None, workers=DEFAULT_WORKERS, dedup=False,
+                 processes=1, metadata_backend=JSON_BACKEND, data_dir=settings.STORAGE_BASE, debug_endpoints=False,
+                 slow_request_threshold=timing.DEFAULT_SLOW_REQUEST_THRESHOLD):
+        if processes < 1:
+            raise ValueError("processes must be a positive integer")
+        if processes > 1 and in_memory:
+            raise ValueError("Only the on-disk storage can be served from several processes")
+
+        self._storage = Storage(
+            use_memory_fs=in_memory,
+            data_dir=data_dir,
+            dedup=dedup,
+            shared=processes > 1,
+            metadata_backend=metadata_backend,
+        )
         if default_bucket:
             logging.debug('[SERVER] Creating default bucket "{}"'.format(default_bucket))
             buckets.create_bucket(default_bucket, self._storage)
-        self._api = APIThread(host, port, self._storage)
+        if processes > 1:
+            self._api = APIProcesses(
+                host,
+                port,
+                processes,
+                workers=workers,
+                dedup=dedup,
+                metadata_backend=metadata_backend,
+                data_dir=data_dir,
+                debug_endpoints=debug_endpoints,
+                slow_request_threshold=slow_request_threshold,
+            )
+        else:
+            self._api = APIThread(
+                host,
+                port,
+                self._storage,
+                workers=workers,
+                debug_endpoints=debug_endpoints,
+                slow_request_threshold=slow_request_threshold,
+            )
 
     def start(self):
         self._api.start()
@@ -325,6 +1200,12 @@ class Server(object):
     def wipe(self, keep_buckets=False):
         self._storage.wipe(keep_buckets=keep_buckets)
 
+    def snapshot(self, name):
+        self._storage.snapshot(name)
+
+    def restore(self, name):
+        self._storage.restore(name)
+
     def run(self):
         try:
             self.start()
@@ -341,6 +1222,20 @@ class Server(object):
             self.stop()
 
 
-def create_server(host, port, in_memory, default_bucket=None):
+def create_server(host, port, in_memory, default_bucket=None, workers=DEFAULT_WORKERS, dedup=False, processes=1,
+                  metadata_backend=JSON_BACKEND, data_dir=settings.STORAGE_BASE, debug_endpoints=False,
+                  slow_request_threshold=timing.DEFAULT_SLOW_REQUEST_THRESHOLD):
     logger.info("Starting server at {}:{}".format(host, port))
-    return Server(host, port, in_memory=in_memory, default_bucket=default_bucket)
+    return Server(
+        host,
+        port,
+        in_memory=in_memory,
+        default_bucket=default_bucket,
+        workers=workers,
+        dedup=dedup,
+        processes=processes,
+        metadata_backend=metadata_backend,
+        data_dir=data_dir,
+        debug_endpoints=debug_endpoints,
+        slow_request_threshold=slow_request_threshold,
+    )
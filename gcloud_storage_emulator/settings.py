@@ -5,6 +5,12 @@ UPLOAD_API_ENDPOINT = "/upload/storage/v1"
 BATCH_API_ENDPOINT = "/batch/storage/v1"
 DOWNLOAD_API_ENDPOINT = "/download/storage/v1"
 
+# Default and maximum number of items returned by a single list request
+MAX_RESULTS = 1000
+
 # pyfilesystem assumes OS fs within CWD as base
 STORAGE_BASE = abspath("./")
 STORAGE_DIR = ".cloudstorage"
+
+# Named snapshots of the storage, next to it so wiping the storage keeps them
+SNAPSHOTS_DIR = ".cloudstorage-snapshots"
@@ -1,61 +1,188 @@
 import datetime
-import json
+import functools
 import logging
 import os
+import re
+import shutil
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
 import fs
-from fs.errors import FileExpected, ResourceNotFound
 
-from gcloud_storage_emulator.exceptions import Conflict, NotFound
-from gcloud_storage_emulator.settings import STORAGE_BASE, STORAGE_DIR
+from gcloud_storage_emulator import checksums
+from gcloud_storage_emulator.blobstore import FSBlobStore, MemoryBlobStore
+from gcloud_storage_emulator.exceptions import Conflict, NotFound, PreconditionFailed
+from gcloud_storage_emulator.index import decode_page_token, encode_page_token
+from gcloud_storage_emulator.journal import Journal, NullJournal
+from gcloud_storage_emulator.locking import InterProcessLock
+from gcloud_storage_emulator.metadata import BACKENDS, JSON_BACKEND, SQLITE_BACKEND, JournaledMetadata, SQLiteMetadata
+from gcloud_storage_emulator.preconditions import check as check_preconditions
+from gcloud_storage_emulator.preconditions import make_etag
+from gcloud_storage_emulator.settings import SNAPSHOTS_DIR, STORAGE_BASE, STORAGE_DIR
 
 logger = logging.getLogger(__name__)
 
+# File locked by the processes sharing a storage, in the storage directory. Wipes, snapshots
+# and restores leave it alone: the other processes hold locks on it.
+LOCK_FILE = ".lock"
+
+# Snapshot names are used as directory names
+_SNAPSHOT_NAME_RE = re.compile(r"[-\w][-.\w]*")
+
+# Number of finished resumable uploads whose object is kept, for clients asking for their status
+MAX_FINISHED_UPLOADS = 1000
+
+# Generation in the query string of the media link of an object
+_MEDIA_LINK_GENERATION_RE = re.compile(r"([?&]generation=)\d+")
+
+
+def _synchronized(method):
+    """Runs the decorated Storage method while holding the storage lock"""
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self._lock:
+            return method(self, *args, **kwargs)
+
+    return wrapper
+
+
+def _stamp_generation(bucket_name, file_name, file_obj, previous_obj):
+    """Gives the Object resource being committed its generation, and what derives from it
+
+    Arguments:
+        bucket_name {str} -- Name of the bucket of the object
+        file_name {str} -- Name of the object
+        file_obj {dict} -- GCS-like Object resource, updated in place
+        previous_obj {dict} -- Object resource being replaced, or None
+    """
+
+    # Generations are timestamps in microseconds, as with GCS, and always grow: a slow upload
+    # goes live after the objects written meanwhile
+    generation = int(time.time() * 1000000)
+    if previous_obj is not None and "generation" in previous_obj:
+        generation = max(generation, int(previous_obj["generation"]) + 1)
+    now = str(datetime.datetime.now())
+
+    file_obj["generation"] = str(generation)
+    file_obj["id"] = "{}/{}/{}".format(bucket_name, file_name, generation)
+    file_obj["timeCreated"] = file_obj["updated"] = file_obj["timeStorageClassUpdated"] = now
+    file_obj["etag"] = make_etag(generation, file_obj.get("metageneration", 1))
+    if "mediaLink" in file_obj:
+        file_obj["mediaLink"] = _MEDIA_LINK_GENERATION_RE.sub(
+            lambda match: match.group(1) + str(generation), file_obj["mediaLink"]
+        )
+
 
 class Storage(object):
-    def __init__(self, use_memory_fs=False, data_dir=STORAGE_BASE):
+    def __init__(self, use_memory_fs=False, data_dir=STORAGE_BASE, dedup=False, shared=False,
+                 metadata_backend=JSON_BACKEND):
+        """
+        Keyword Arguments:
+            use_memory_fs {bool} -- Keep everything in memory instead of on disk (default: {False})
+            data_dir {str} -- Absolute path of the directory holding the storage (default: {STORAGE_BASE})
+            dedup {bool} -- Store identical contents only once on disk (default: {False})
+            shared {bool} -- Whether other processes use the same data directory at the same
+                             time, e.g. the workers of a multi-process server (default: {False})
+            metadata_backend {str} -- "json" to keep the metadata in memory, persisted as JSON,
+                                      or "sqlite" to keep it in a SQLite database, which scales
+                                      to millions of objects (default: {"json"})
+
+        Raises:
+            ValueError: If data_dir isn't absolute, if the metadata backend is unknown, or if
+                        the in-memory storage is to be shared or use SQLite
+        """
+
         if not os.path.isabs(data_dir):
             raise ValueError("data_dir must be an absolute path")
+        if shared and use_memory_fs:
+            raise ValueError("Only the on-disk storage can be shared between processes")
+        if metadata_backend not in BACKENDS:
+            raise ValueError("Unknown metadata backend '{}'".format(metadata_backend))
+        if metadata_backend == SQLITE_BACKEND and use_memory_fs:
+            raise ValueError("Only the on-disk storage can keep its metadata in SQLite")
 
         self._use_memory_fs = use_memory_fs
         self._data_dir = data_dir
-        self._pwd = fs.open_fs(data_dir)
-        try:
-            self._fs = self._pwd.makedir(STORAGE_DIR)
-        except fs.errors.DirectoryExists:
-            self._fs = self._pwd.opendir(STORAGE_DIR)
+        # Snapshots of the in-memory storage, by name
+        self._snapshots = {}
+        # Object resources created by the last finished resumable uploads, by upload id
+        self._finished_uploads = OrderedDict()
+        # The API server handles requests from a pool of threads: every access to the
+        # metadata and to the files backing it goes through this lock. When processes
+        # share the storage, it also makes them take turns, and each catches up on the changes
+        # of the others when its turn comes.
+        if shared:
+            storage_dir = os.path.join(data_dir, STORAGE_DIR)
+            os.makedirs(storage_dir, exist_ok=True)
+            self._lock = InterProcessLock(os.path.join(storage_dir, LOCK_FILE), on_acquire=self._sync)
+        else:
+            self._lock = threading.RLock()
+        self._loaded = False
+
+        if use_memory_fs:
+            # Nothing is persisted: contents and metadata are only held by this instance
+            self._blobs = MemoryBlobStore()
+            self._meta = JournaledMetadata(NullJournal())
+        else:
+            self._pwd = fs.open_fs(data_dir)
+            try:
+                self._fs = self._pwd.makedir(STORAGE_DIR)
+            except fs.errors.DirectoryExists:
+                self._fs = self._pwd.opendir(STORAGE_DIR)
+            # With dedup, identical contents are only stored once on disk
+            self._blobs = FSBlobStore(self._fs, dedup=dedup)
+            if metadata_backend == SQLITE_BACKEND:
+                self._meta = SQLiteMetadata(self._fs, Journal(self._fs))
+            else:
+                self._meta = JournaledMetadata(Journal(self._fs))
 
         self._read_config_from_file()
 
-    def _write_config_to_file(self):
-        data = {
-            "buckets": self.buckets,
-            "objects": self.objects,
-            "resumable": self.resumable,
-        }
+    def _read_config_from_file(self):
+        with self._lock:
+            self._meta.load()
+            self._loaded = True
 
-        with self._fs.open(".meta", mode="w") as meta:
-            json.dump(data, meta, indent=2)
+    def _commit(self, record):
+        """Applies a single metadata mutation and persists it
 
-    def _read_config_from_file(self):
-        try:
-            with self._fs.open(".meta", mode="r") as meta:
-                data = json.load(meta)
-                self.buckets = data.get("buckets")
-                self.objects = data.get("objects")
-                self.resumable = data.get("resumable")
-        except ResourceNotFound:
-            self.buckets = {}
-            self.objects = {}
-            self.resumable = {}
-
-    def _get_or_create_dir(self, bucket_name, file_name):
-        try:
-            bucket_dir = self._fs.makedir(bucket_name)
-        except fs.errors.DirectoryExists:
-            bucket_dir = self._fs.opendir(bucket_name)
+        Arguments:
+            record {dict} -- The mutation, see `metadata` for the supported operations
+        """
+
+        self._meta.commit(record)
+
+    def _sync(self):
+        """Applies the metadata changes made by the other processes sharing the storage"""
+
+        if not self._loaded:
+            # Being loaded for the first time
+            return
+        self._meta.sync()
+
+    @property
+    def buckets(self):
+        """All the Bucket resources by name, mostly meant for debugging"""
+
+        with self._lock:
+            return self._meta.to_dict()["buckets"]
+
+    @property
+    def objects(self):
+        """All the Object resources by bucket and name, mostly meant for debugging"""
 
-        dir_name = fs.path.dirname(file_name)
-        return bucket_dir.makedirs(dir_name, recreate=True)
+        with self._lock:
+            return self._meta.to_dict()["objects"]
+
+    @property
+    def resumable(self):
+        """The Object resources of the pending resumable uploads by id, mostly meant for debugging"""
+
+        with self._lock:
+            return self._meta.to_dict()["resumable"]
 
     def get_storage_base(self):
         """Returns the pyfilesystem-compatible fs path to the storage
@@ -72,6 +199,18 @@ class Storage(object):
         else:
             return self._data_dir
 
+    @_synchronized
+    def stats(self):
+        """Returns the size of the storage, kept up to date as it changes rather than counted
+
+        Returns:
+            dict -- Number of "buckets", "objects" and pending "resumable" uploads, and total
+                    "bytes" of the objects
+        """
+
+        return self._meta.stats()
+
+    @_synchronized
     def get_bucket(self, bucket_name):
         """Get the bucket resourec object given the bucket name
 
@@ -82,9 +221,31 @@ class Storage(object):
             dict -- GCS-like Bucket resource
         """
 
-        return self.buckets.get(bucket_name)
+        return self._meta.get_bucket(bucket_name)
+
+    @_synchronized
+    def get_bucket_list(self, prefix=None, max_results=None, page_token=None):
+        """Lists the buckets whose name begin with the prefix, sorted by name
+
+        Keyword Arguments:
+            prefix {str} -- Only list buckets starting with this prefix (default: {None})
+            max_results {int} -- Maximum number of buckets to return (default: {None})
+            page_token {str} -- Token returned by the previous page (default: {None})
+
+        Raises:
+            ValueError: If the page token is invalid
+
+        Returns:
+            tuple -- (list of GCS-like Bucket resources, token of the next page or None)
+        """
+
+        start_at = decode_page_token(page_token) if page_token else None
+        buckets, next_start = self._meta.list_buckets(prefix, start_at=start_at, max_results=max_results)
+        next_page_token = encode_page_token(next_start) if next_start is not None else None
+        return buckets, next_page_token
 
-    def get_file_list(self, bucket_name, prefix=None, delimiter=None):
+    @_synchronized
+    def get_file_list(self, bucket_name, prefix=None, delimiter=None, max_results=None, page_token=None):
         """Lists all the blobs in the bucket that begin with the prefix.
 
         This can be used to list all blobs in a "folder", e.g. "public/".
@@ -101,7 +262,7 @@ class Storage(object):
             a/1.txt
             a/b/2.txt
 
-        However, if you specify prefix='a' and delimiter='/', you'll get back:
+        However, if you specify prefix='a/' and delimiter='/', you'll get back:
 
             a/1.txt
 
@@ -110,21 +271,28 @@ class Storage(object):
             a/b/
 
         Source: https://cloud.google.com/storage/docs/listing-objects#storage-list-objects-python
+
+        Names are looked up in a sorted index, so the cost of a listing depends on the number
+        of results rather than on the size of the bucket. When `max_results` is given, at most
+        that many objects and prefixes are returned, along with the token of the next page.
+
+        Raises:
+            NotFound: If the bucket doesn't exist
+            ValueError: If the page token is invalid
+
+        Returns:
+            tuple -- (list of GCS-like Object resources, list of prefixes, token of the next page or None)
         """
 
-        if bucket_name not in self.buckets:
+        if self._meta.get_bucket(bucket_name) is None:
             raise NotFound
 
-        bucket_objects = self.objects.get(bucket_name, {})
-        if prefix:
-            # TODO: Still need to implement the last part of the doc string above to
-            # TODO: populate blobs.prefixes when using a delimiter.
-            return list(file_object for file_name, file_object in bucket_objects.items()
-                        if file_name.startswith(prefix)
-                        and (not delimiter or delimiter not in file_name[len(prefix+delimiter):]))
-        else:
-            return list(bucket_objects.values())
+        start_at = decode_page_token(page_token) if page_token else None
+        objects, prefixes, next_start = self._meta.list_objects(bucket_name, prefix, delimiter, start_at, max_results)
+        next_page_token = encode_page_token(next_start) if next_start is not None else None
+        return objects, prefixes, next_page_token
 
+    @_synchronized
     def create_bucket(self, bucket_name, bucket_obj):
         """Create a bucket object representation and save it to the current fs
 
@@ -132,43 +300,125 @@ class Storage(object):
             bucket_name {str} -- Name of the GCS bucket
             bucket_obj {dict} -- GCS-like Bucket resource
 
+        Raises:
+            Conflict: If a bucket with the same name already exists
+
         Returns:
-            [type] -- [description]
+            dict -- GCS-like Bucket resource
         """
 
-        self.buckets[bucket_name] = bucket_obj
-        self._write_config_to_file()
+        if self._meta.get_bucket(bucket_name) is not None:
+            raise Conflict("Bucket '{}' already exists".format(bucket_name))
+
+        self._commit({"op": "put_bucket", "name": bucket_name, "value": bucket_obj})
         return bucket_obj
 
-    def create_file(self, bucket_name, file_name, content, file_obj):
-        """Create a text file given a string content
+    def _store_file(self, bucket_name, file_name, content, file_obj, preconditions=None):
+        # The content is written aside without holding the lock, as it may be streamed
+        # from a slow client. Only making it visible requires the lock.
+        self._commit_file(bucket_name, file_name, self._blobs.spool(content), file_obj, preconditions=preconditions)
+
+    def _commit_file(self, bucket_name, file_name, spooled, file_obj, resumable_id=None, preconditions=None):
+        with self._lock:
+            previous_obj = self._meta.get_object(bucket_name, file_name)
+            if preconditions:
+                # Checked along with the write, so that no other write can come in between
+                try:
+                    check_preconditions(previous_obj, preconditions)
+                except PreconditionFailed:
+                    self._blobs.discard(spooled)
+                    if resumable_id is not None:
+                        self._commit({"op": "delete_resumable", "id": resumable_id})
+                    raise
+
+            previous_blob_id = self._meta.get_blob_id(bucket_name, file_name)
+            try:
+                blob_id = self._blobs.commit(spooled, bucket_name, file_name)
+            except Exception:
+                self._blobs.discard(spooled)
+                raise
+
+            file_obj["size"] = str(spooled.size)
+            file_obj.update(spooled.checksums)
+            if "generation" in file_obj:
+                _stamp_generation(bucket_name, file_name, file_obj, previous_obj)
+            record = {"op": "put_object", "bucket": bucket_name, "name": file_name, "value": file_obj}
+            if blob_id is not None:
+                record["blob"] = blob_id
+            self._commit(record)
+            if resumable_id is not None:
+                self._commit({"op": "delete_resumable", "id": resumable_id})
+                self._finished_uploads[resumable_id] = file_obj
+                while len(self._finished_uploads) > MAX_FINISHED_UPLOADS:
+                    self._finished_uploads.popitem(last=False)
+            self._release_blob(bucket_name, file_name, previous_blob_id)
+
+    def _release_blob(self, bucket_name, file_name, blob_id):
+        # Deduplicated contents are only deleted once no object references them anymore
+        if blob_id is not None and not self._meta.is_blob_referenced(blob_id):
+            self._blobs.delete(bucket_name, file_name, blob_id)
+
+    def create_file(self, bucket_name, file_name, content, file_obj, preconditions=None):
+        """Create a file given its content
+
+        The size of the Object resource is set to the number of bytes written.
 
         Arguments:
             bucket_name {str} -- Name of the bucket to save to
             file_name {str} -- File name used to store data
-            content {bytes} -- Content of the file to write
+            content {bytes|file} -- Content of the file to write, as bytes or as a readable
+                                    binary file which is streamed to the storage
             file_obj {dict} -- GCS-like Object resource
+
+        Keyword Arguments:
+            preconditions {dict} -- Preconditions on the object being replaced, see
+                                    `preconditions.from_query` (default: {None})
+
+        Raises:
+            PreconditionFailed: If a precondition doesn't hold, nothing is written then
         """
 
-        file_dir = self._get_or_create_dir(bucket_name, file_name)
+        self._store_file(bucket_name, file_name, content, file_obj, preconditions=preconditions)
 
-        base_name = fs.path.basename(file_name)
-        with file_dir.open(base_name, mode="wb") as file:
-            file.write(content)
-            bucket_objects = self.objects.get(bucket_name, {})
-            bucket_objects[file_name] = file_obj
-            self.objects[bucket_name] = bucket_objects
-            self._write_config_to_file()
+    def copy_file(self, bucket_name, file_name, dest_bucket_name, dest_file_name, dest_file_obj, preconditions=None):
+        """Copy a file within the storage, without reading its content in memory
 
-    def create_resumable_upload(self, bucket_name, file_name, file_obj):
-        """Initiate the necessary data to support partial upload.
+        On disk the content is copied by the kernel (sharing the blocks on filesystems
+        supporting reflinks), in memory both objects share the same content.
+
+        Arguments:
+            bucket_name {str} -- Name of the source bucket
+            file_name {str} -- Name of the source file
+            dest_bucket_name {str} -- Name of the destination bucket
+            dest_file_name {str} -- Name of the destination file
+            dest_file_obj {dict} -- GCS-like Object resource of the destination
+
+        Keyword Arguments:
+            preconditions {dict} -- Preconditions on the destination object (default: {None})
+
+        Raises:
+            NotFound: Raised when the source object doesn't exist
+            PreconditionFailed: If a precondition doesn't hold
+        """
+
+        with self._lock:
+            file_obj = self.get_file_obj(bucket_name, file_name)
+            source = self._blobs.open(bucket_name, file_name, self._meta.get_blob_id(bucket_name, file_name))
 
-        This doesn't fully support partial upload, but expect the secondary PUT
-        call to send all the data in one go.
+        # The source can be overwritten meanwhile: the open file still holds the content it had,
+        # whose checksums don't need to be computed again
+        with source:
+            spooled = self._blobs.spool(source, checksums=checksums.from_resource(file_obj))
+        self._commit_file(dest_bucket_name, dest_file_name, spooled, dest_file_obj, preconditions=preconditions)
 
-        Basically, we try to comply to the bare minimum to the API described in
-        https://cloud.google.com/storage/docs/performing-resumable-uploads ignoring
-        any potential network failures
+    @_synchronized
+    def create_resumable_upload(self, bucket_name, file_name, file_obj):
+        """Starts a resumable upload session, as described in
+        https://cloud.google.com/storage/docs/performing-resumable-uploads
+
+        The session is recorded in the metadata, so it survives restarts. Its content is spooled
+        aside as it comes, in one go or chunk by chunk with `append_to_resumable_upload`, and only
+        becomes an object when `finish_resumable_upload` commits it.
 
         Arguments:
             bucket_name {string} -- Name of the bucket to save to
@@ -180,41 +430,139 @@ class Storage(object):
         """
 
         file_id = "{}:{}:{}".format(bucket_name, file_name, datetime.datetime.now())
-        self.resumable[file_id] = file_obj
-        self._write_config_to_file()
+        self._commit({"op": "put_resumable", "id": file_id, "value": file_obj})
         return file_id
 
-    def create_file_for_resumable_upload(self, file_id, content):
-        """Create a binary file following a partial upload request
+    @_synchronized
+    def get_resumable_upload(self, file_id):
+        """Gets the state of a resumable upload session
+
+        Arguments:
+            file_id {str} -- the `upload_id` of the partial upload session
+
+        Raises:
+            NotFound: If the session doesn't exist, or is already finished
+
+        Returns:
+            tuple -- (GCS-like Object resource, number of bytes received so far)
+        """
+
+        file_obj = self._meta.get_resumable(file_id)
+        if file_obj is None:
+            raise NotFound
+        return file_obj, self._blobs.upload_size(file_id)
+
+    @_synchronized
+    def get_finished_resumable_upload(self, file_id):
+        """Gets the object created by a resumable upload session which is over
+
+        Only the last `MAX_FINISHED_UPLOADS` finished sessions of this instance are kept.
+
+        Arguments:
+            file_id {str} -- the `upload_id` of the partial upload session
+
+        Raises:
+            NotFound: If the session isn't known to be finished
+
+        Returns:
+            dict -- GCS-like Object resource, as it was created
+        """
+
+        file_obj = self._finished_uploads.get(file_id)
+        if file_obj is None:
+            raise NotFound
+        return file_obj
+
+    def append_to_resumable_upload(self, file_id, content, size=None):
+        """Appends a chunk to a resumable upload session
+
+        The chunk is streamed to the session's spool without holding the storage lock.
+        Chunks of a session are expected one at a time, in order, as GCS does.
+
+        Arguments:
+            file_id {str} -- the `upload_id` of the partial upload session
+            content {bytes|file} -- the chunk, as bytes or as a readable binary file
+
+        Keyword Arguments:
+            size {int} -- Expected size of the chunk, a chunk of another size (or which can't be
+                          read) is dropped rather than appended (default: {None})
+
+        Raises:
+            NotFound: If the session doesn't exist, or is already finished
+            ValueError: If the chunk isn't of the expected size
+
+        Returns:
+            int -- number of bytes received so far
+        """
+
+        with self._lock:
+            if self._meta.get_resumable(file_id) is None:
+                raise NotFound
+
+        if size is None:
+            return self._blobs.append_upload(file_id, content)
+
+        previous_size = self._blobs.upload_size(file_id)
+        try:
+            received = self._blobs.append_upload(file_id, content)
+            if received - previous_size != size:
+                raise ValueError("Expected a chunk of {} bytes, got {}".format(size, received - previous_size))
+        except Exception:
+            self._blobs.truncate_upload(file_id, previous_size)
+            raise
+        return received
+
+    def finish_resumable_upload(self, file_id, preconditions=None):
+        """Turns the content received by a resumable upload session into the final file
 
         This also updates the meta with the final file-size
 
         Arguments:
             file_id {str} -- the `upload_id` of the partial upload session
-            content {bytes} -- raw content to add to the file
+
+        Keyword Arguments:
+            preconditions {dict} -- Preconditions on the object being replaced (default: {None})
+
+        Raises:
+            NotFound: If the session doesn't exist, or is already finished
+            PreconditionFailed: If a precondition doesn't hold, the session is over then
 
         Returns:
             dict -- GCS-like Object resource
         """
 
-        file_obj = self.resumable[file_id]
-        bucket_name = file_obj["bucket"]
-        file_name = file_obj["name"]
-        file_dir = self._get_or_create_dir(bucket_name, file_name)
+        with self._lock:
+            file_obj = self._meta.get_resumable(file_id)
+            if file_obj is None:
+                raise NotFound
 
-        base_name = fs.path.basename(file_name)
-        with file_dir.open(base_name, mode="wb") as file:
-            file.write(content)
+        spooled = self._blobs.upload_blob(file_id)
+        self._commit_file(
+            file_obj["bucket"], file_obj["name"], spooled, file_obj, resumable_id=file_id, preconditions=preconditions
+        )
+        return file_obj
 
-        file_obj["size"] = str(len(content))
-        bucket_objects = self.objects.get(bucket_name, {})
-        bucket_objects[file_name] = file_obj
-        self.objects[bucket_name] = bucket_objects
-        del self.resumable[file_id]
-        self._write_config_to_file()
+    def create_file_for_resumable_upload(self, file_id, content, preconditions=None):
+        """Create a binary file following a partial upload request
 
-        return file_obj
+        This also updates the meta with the final file-size
 
+        Arguments:
+            file_id {str} -- the `upload_id` of the partial upload session
+            content {bytes|file} -- raw content to add to the file, as bytes or as a
+                                    readable binary file
+
+        Keyword Arguments:
+            preconditions {dict} -- Preconditions on the object being replaced (default: {None})
+
+        Returns:
+            dict -- GCS-like Object resource
+        """
+
+        self.append_to_resumable_upload(file_id, content)
+        return self.finish_resumable_upload(file_id, preconditions=preconditions)
+
+    @_synchronized
     def get_file_obj(self, bucket_name, file_name):
         """Gets the meta information for a file within a bucket
 
@@ -229,11 +577,12 @@ class Storage(object):
             dict -- GCS-like Object resource
         """
 
-        try:
-            return self.objects[bucket_name][file_name]
-        except KeyError:
+        file_obj = self._meta.get_object(bucket_name, file_name)
+        if file_obj is None:
             raise NotFound
+        return file_obj
 
+    @_synchronized
     def get_file(self, bucket_name, file_name):
         """Get the raw data of a file within a bucket
 
@@ -248,14 +597,30 @@ class Storage(object):
             bytes -- Raw content of the file
         """
 
-        try:
-            bucket_dir = self._fs.opendir(bucket_name)
-            return bucket_dir.open(file_name, mode="rb").read()
-        except (FileExpected, ResourceNotFound) as e:
-            logger.error("Resource not found:")
-            logger.error(e)
-            raise NotFound
+        return self._blobs.read(bucket_name, file_name, self._meta.get_blob_id(bucket_name, file_name))
+
+    @_synchronized
+    def open_file(self, bucket_name, file_name):
+        """Open a file within a bucket for reading, along with its meta information
+
+        The content is not loaded in memory: the returned file is meant to be streamed, and
+        must be closed by the caller.
 
+        Arguments:
+            bucket_name {str} -- Name of the bucket
+            file_name {str} -- File name
+
+        Raises:
+            NotFound: Raised when the object doesn't exist
+
+        Returns:
+            tuple -- (GCS-like Object resource, readable binary file)
+        """
+
+        file_obj = self.get_file_obj(bucket_name, file_name)
+        return file_obj, self._blobs.open(bucket_name, file_name, self._meta.get_blob_id(bucket_name, file_name))
+
+    @_synchronized
     def delete_bucket(self, bucket_name):
         """Delete a bucket's meta and file
 
@@ -266,66 +631,125 @@ class Storage(object):
             NotFound: If the bucket doesn't exist
             Conflict: If the bucket is not empty or there are pending uploads
         """
-        bucket_meta = self.buckets.get(bucket_name)
-        if bucket_meta is None:
+        if self._meta.get_bucket(bucket_name) is None:
             raise NotFound("Bucket with name '{}' does not exist".format(bucket_name))
 
-        bucket_objects = self.objects.get(bucket_name, {})
-
-        if len(bucket_objects.keys()) != 0:
+        if self._meta.has_objects(bucket_name):
             raise Conflict("Bucket '{}' is not empty".format(bucket_name))
 
-        resumable_ids = [
-            file_id
-            for (file_id, file_obj) in self.resumable.items()
-            if file_obj.get('bucket') == bucket_name
-        ]
-
-        if len(resumable_ids) != 0:
+        if self._meta.has_resumable(bucket_name):
             raise Conflict("Bucket '{}' has pending upload sessions".format(bucket_name))
 
-        del self.buckets[bucket_name]
+        self._commit({"op": "delete_bucket", "name": bucket_name})
+        self._blobs.delete_bucket(bucket_name)
 
-        self._delete_dir(bucket_name)
-        self._write_config_to_file()
+    @_synchronized
+    def delete_file(self, bucket_name, file_name, preconditions=None):
+        """Delete a file and its meta
 
-    def delete_file(self, bucket_name, file_name):
-        try:
-            self.objects[bucket_name][file_name]
-        except KeyError:
+        Arguments:
+            bucket_name {str} -- Name of the bucket
+            file_name {str} -- File name
+
+        Keyword Arguments:
+            preconditions {dict} -- Preconditions on the object (default: {None})
+
+        Raises:
+            NotFound: Raised when the object doesn't exist
+            PreconditionFailed: If a precondition doesn't hold
+        """
+
+        file_obj = self._meta.get_object(bucket_name, file_name)
+        if file_obj is None:
             raise NotFound("Object with name '{}' does not exist in bucket '{}'".format(bucket_name, file_name))
+        check_preconditions(file_obj, preconditions)
 
-        del self.objects[bucket_name][file_name]
+        blob_id = self._meta.get_blob_id(bucket_name, file_name)
+        self._commit({"op": "delete_object", "bucket": bucket_name, "name": file_name})
+        if blob_id is None:
+            self._blobs.delete(bucket_name, file_name)
+        else:
+            self._release_blob(bucket_name, file_name, blob_id)
 
-        self._delete_file(bucket_name, file_name)
-        self._write_config_to_file()
+    def _snapshot_dir(self, name):
+        if not _SNAPSHOT_NAME_RE.fullmatch(name):
+            raise ValueError("Invalid snapshot name '{}'".format(name))
+        return os.path.join(self._data_dir, SNAPSHOTS_DIR, name)
 
-    def _delete_file(self, bucket_name, file_name):
-        try:
-            with self._fs.opendir(bucket_name) as bucket_dir:
-                bucket_dir.remove(file_name)
-        except ResourceNotFound:
-            logger.info("No file to remove '{}/{}'".format(bucket_name, file_name))
+    @_synchronized
+    def snapshot(self, name):
+        """Saves the current state of the storage under a name, replacing any snapshot with that name
 
-    def _delete_dir(self, path, force=True):
-        try:
-            remover = self._fs.removetree if force else self._fs.removedir
-            remover(path)
-        except ResourceNotFound:
-            logger.info("No folder to remove '{}'".format(path))
+        In memory, the metadata, name indexes and (immutable) contents of each bucket are shared
+        with the snapshot until changed, so saving and restoring it only cost O(buckets). On disk,
+        the files are hard linked into the snapshot directory, along with the metadata. Either
+        way, the cost doesn't depend on the size of the contents.
 
-    def wipe(self, keep_buckets=False):
-        existing_buckets = self.buckets
-        self.buckets = {}
-        self.objects = {}
-        self.resumable = {}
+        Arguments:
+            name {str} -- Name of the snapshot, made of letters, digits, "-", "_" and "."
+
+        Raises:
+            ValueError: If the name is invalid
+        """
 
+        snapshot_dir = self._snapshot_dir(name)
+        if self._use_memory_fs:
+            self._snapshots[name] = (self._meta.copy_state(), self._blobs.snapshot())
+            return
+
+        # Metadata files are written in place, they are saved by the metadata store rather
+        # than linked
+        tmp_dir = os.path.join(self._data_dir, SNAPSHOTS_DIR, ".tmp-{}".format(uuid.uuid4().hex))
         try:
-            self._fs.remove('.meta')
-            for path in self._fs.listdir('.'):
-                self._fs.removetree(path)
-        except ResourceNotFound as e:
-            logger.warning(e)
+            self._meta.save(tmp_dir)
+            self._blobs.snapshot(tmp_dir, exclude=self._meta.files + (LOCK_FILE,))
+            if os.path.exists(snapshot_dir):
+                shutil.rmtree(snapshot_dir)
+            os.rename(tmp_dir, snapshot_dir)
+        except Exception:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            raise
+
+    @_synchronized
+    def restore(self, name):
+        """Brings the storage back to the state saved by `snapshot`
+
+        The snapshot is kept, so it can be restored again.
+
+        Arguments:
+            name {str} -- Name of the snapshot
+
+        Raises:
+            ValueError: If the name is invalid
+            NotFound: If there is no snapshot with that name
+        """
+
+        snapshot_dir = self._snapshot_dir(name)
+        if self._use_memory_fs:
+            try:
+                state, blobs = self._snapshots[name]
+            except KeyError:
+                raise NotFound("Snapshot '{}' does not exist".format(name))
+
+            self._meta.set_state(state)
+            self._blobs.restore(blobs)
+            self._finished_uploads.clear()
+            return
+
+        if not os.path.isdir(snapshot_dir):
+            raise NotFound("Snapshot '{}' does not exist".format(name))
+
+        self._meta.wipe()
+        self._blobs.restore(snapshot_dir, exclude=self._meta.files + (LOCK_FILE,))
+        self._meta.restore(snapshot_dir)
+        self._finished_uploads.clear()
+
+    @_synchronized
+    def wipe(self, keep_buckets=False):
+        existing_buckets = self._meta.get_buckets()
+        self._meta.wipe()
+        self._finished_uploads.clear()
+        self._blobs.wipe(exclude=self._meta.files + (LOCK_FILE,))
 
         if keep_buckets:
             for k, v in existing_buckets.items():
@@ -0,0 +1,39 @@
+import base64
+import hashlib
+from unittest import TestCase as BaseTestCase
+from unittest import mock
+
+from gcloud_storage_emulator import checksums
+
+
+class ChecksumsTests(BaseTestCase):
+
+    def _checksums(self, *chunks):
+        result = checksums.Checksums()
+        for chunk in chunks:
+            result.update(chunk)
+        return result.to_dict()
+
+    def test_crc32c_update(self):
+        # Check value of the CRC-32C specification
+        self.assertEqual(checksums.crc32c_update(0, b"123456789"), 0xE3069283)
+        self.assertEqual(checksums.crc32c_update(checksums.crc32c_update(0, b"1234"), b"56789"), 0xE3069283)
+        self.assertEqual(checksums.crc32c_update(0, b""), 0)
+
+    def test_checksums(self):
+        expected = {
+            "md5Hash": base64.b64encode(hashlib.md5(b"123456789").digest()).decode("ascii"),
+            "crc32c": base64.b64encode(bytes.fromhex("E3069283")).decode("ascii"),
+        }
+        self.assertEqual(self._checksums(b"123456789"), expected)
+        self.assertEqual(self._checksums(b"1234", memoryview(b"56789")), expected)
+
+        with mock.patch.object(checksums, "_USE_C_EXTENSION", False):
+            self.assertEqual(self._checksums(b"1234", memoryview(b"56789")), expected)
+
+    def test_goog_hash_header(self):
+        self.assertEqual(
+            checksums.goog_hash_header({"md5Hash": "md5", "crc32c": "crc", "size": "1"}),
+            "crc32c=crc,md5=md5",
+        )
+        self.assertIsNone(checksums.goog_hash_header({"size": "1"}))
@@ -0,0 +1,64 @@
+import gzip
+import os
+from io import BytesIO
+from unittest import TestCase as BaseTestCase
+
+from gcloud_storage_emulator import compression
+
+
+class CompressionTests(BaseTestCase):
+
+    def test_accepts_gzip(self):
+        self.assertTrue(compression.accepts_gzip("gzip, deflate"))
+        self.assertTrue(compression.accepts_gzip("GZIP;q=0.5"))
+        self.assertTrue(compression.accepts_gzip("*"))
+        self.assertTrue(compression.accepts_gzip("*;q=0, gzip"))
+        self.assertFalse(compression.accepts_gzip(None))
+        self.assertFalse(compression.accepts_gzip("identity"))
+        self.assertFalse(compression.accepts_gzip("gzip;q=0"))
+        self.assertFalse(compression.accepts_gzip("gzip;q=0, *"))
+
+    def test_compress(self):
+        data = b"items" * 1000
+        self.assertEqual(gzip.decompress(compression.compress(data)), data)
+        # Identical bodies get identical compressed forms
+        self.assertEqual(compression.compress(data), compression.compress(data))
+
+    def test_cache(self):
+        cache = compression.CompressionCache(max_size=100)
+        first = b"a" * 1000
+        self.assertEqual(gzip.decompress(cache.compress(first)), first)
+        self.assertIs(cache.compress(first), cache.compress(first))
+        self.assertEqual((cache.hits, cache.misses), (2, 1))
+
+        # Least recently used entries are evicted once the cache is full
+        for i in range(20):
+            cache.compress(os.urandom(4) * 10)
+        cache.compress(first)
+        self.assertEqual(cache.misses, 22)
+
+    def test_gunzip_stream(self):
+        data = os.urandom(100000) + b"a" * 300000
+        # Concatenated members are read one after the other
+        stream = compression.GunzipStream(BytesIO(gzip.compress(data) + gzip.compress(b"end")))
+        chunks = list(iter(lambda: stream.read(7000), b""))
+        self.assertEqual(b"".join(chunks), data + b"end")
+        self.assertTrue(all(len(chunk) <= 7000 for chunk in chunks))
+
+    def test_is_gzip(self):
+        compressed = gzip.compress(os.urandom(100000))
+        self.assertTrue(compression.is_gzip(BytesIO(compressed)))
+        self.assertTrue(compression.is_gzip(BytesIO(compressed + gzip.compress(b"end"))))
+
+        self.assertFalse(compression.is_gzip(BytesIO(b"")))
+        self.assertFalse(compression.is_gzip(BytesIO(b"not gzip")))
+        # Truncated, corrupt, or followed by something else
+        self.assertFalse(compression.is_gzip(BytesIO(compressed[:-100])))
+        self.assertFalse(compression.is_gzip(BytesIO(compressed[:-4] + b"\0\0\0\0")))
+        self.assertFalse(compression.is_gzip(BytesIO(compressed + b"trailing")))
+
+    def test_gunzip_stream_closes_the_file(self):
+        file = BytesIO(gzip.compress(b"content"))
+        with compression.GunzipStream(file) as stream:
+            self.assertEqual(stream.read(), b"content")
+        self.assertTrue(file.closed)
@@ -0,0 +1,82 @@
+import base64
+from io import BytesIO
+from unittest import TestCase as BaseTestCase
+
+from gcloud_storage_emulator.multipart import MultipartError, MultipartReader, get_boundary
+
+
+def _make_body(boundary, parts, preamble=b""):
+    body = preamble
+    for headers, content in parts:
+        body += b"--" + boundary + b"\r\n" + headers + b"\r\n\r\n" + content + b"\r\n"
+    return body + b"--" + boundary + b"--"
+
+
+def _read_parts(body, boundary, chunk_size, read_size=-1):
+    reader = MultipartReader(BytesIO(body), boundary, chunk_size=chunk_size)
+    parts = []
+    part = reader.next_part()
+    while part is not None:
+        chunks = []
+        while True:
+            chunk = part.read(read_size)
+            chunks.append(chunk)
+            if not chunk or read_size < 0:
+                break
+        parts.append((part.get_content_type(), b"".join(chunks)))
+        part = reader.next_part()
+    return parts
+
+
+class MultipartReaderTests(BaseTestCase):
+
+    def test_get_boundary(self):
+        self.assertEqual(get_boundary('multipart/related; boundary="==abc=="'), "==abc==")
+        self.assertEqual(get_boundary("multipart/related; boundary=abc"), "abc")
+        with self.assertRaises(MultipartError):
+            get_boundary("multipart/related")
+
+    def test_read_parts(self):
+        # The content contains things looking like the delimiter, which may be split across reads
+        content = b"\r\n--bound\r\n--boun" * 1000
+        body = _make_body(b"boundary", [
+            (b"Content-Type: application/json; charset=UTF-8", b'{"name": "file.txt"}'),
+            (b"Content-Type: text/plain", content),
+        ], preamble=b"This is the preamble\r\n")
+
+        for chunk_size in (1, 7, 64, 4096, 1024 * 1024):
+            for read_size in (-1, 1, 1000):
+                self.assertEqual(_read_parts(body, "boundary", chunk_size, read_size), [
+                    ("application/json", b'{"name": "file.txt"}'),
+                    ("text/plain", content),
+                ])
+
+    def test_empty_part(self):
+        body = _make_body(b"boundary", [(b"Content-Type: text/plain", b"")])
+        self.assertEqual(_read_parts(body, "boundary", 16), [("text/plain", b"")])
+
+    def test_unread_parts_are_skipped(self):
+        body = _make_body(b"boundary", [
+            (b"Content-Type: text/plain", b"first"),
+            (b"Content-Type: image/png", b"second"),
+        ])
+        reader = MultipartReader(BytesIO(body), "boundary")
+        reader.next_part()
+        part = reader.next_part()
+        self.assertEqual(part.read(), b"second")
+        self.assertIsNone(reader.next_part())
+
+    def test_base64_part(self):
+        content = bytes(range(256)) * 10
+        body = _make_body(b"boundary", [
+            (b"Content-Type: image/png\r\nContent-Transfer-Encoding: base64", base64.encodebytes(content)),
+        ])
+        for read_size in (-1, 3, 1000):
+            self.assertEqual(_read_parts(body, "boundary", 10, read_size), [("image/png", content)])
+
+    def test_truncated_body(self):
+        body = b"--boundary\r\nContent-Type: text/plain\r\n\r\nno closing delimiter"
+        reader = MultipartReader(BytesIO(body), "boundary")
+        part = reader.next_part()
+        with self.assertRaises(MultipartError):
+            part.read()
@@ -0,0 +1,46 @@
+from unittest import TestCase as BaseTestCase
+
+from gcloud_storage_emulator import preconditions
+from gcloud_storage_emulator.exceptions import PreconditionFailed
+
+
+class PreconditionsTests(BaseTestCase):
+
+    def test_make_etag(self):
+        # Etag given by GCS to an object of generation 1579864483743854
+        self.assertEqual(preconditions.make_etag(1579864483743854, 1), "CO6Q4+qNnOcCEAE=")
+        self.assertNotEqual(preconditions.make_etag(1579864483743854, 2), "CO6Q4+qNnOcCEAE=")
+
+    def test_from_query(self):
+        self.assertEqual(
+            preconditions.from_query({"ifGenerationMatch": ["0"], "ifMetagenerationNotMatch": ["3"], "other": ["1"]}),
+            {"ifGenerationMatch": 0, "ifMetagenerationNotMatch": 3},
+        )
+        with self.assertRaises(ValueError):
+            preconditions.from_query({"ifGenerationMatch": ["latest"]})
+
+    def test_check(self):
+        file_obj = {"generation": "42", "metageneration": "1"}
+        preconditions.check(file_obj, {})
+        preconditions.check(file_obj, {"ifGenerationMatch": 42, "ifMetagenerationNotMatch": 2})
+        preconditions.check(None, {"ifGenerationMatch": 0, "ifMetagenerationNotMatch": 1})
+
+        for parameter, value in (
+            ("ifGenerationMatch", 0),
+            ("ifGenerationNotMatch", 42),
+            ("ifMetagenerationMatch", 2),
+            ("ifMetagenerationNotMatch", 1),
+        ):
+            with self.assertRaises(PreconditionFailed) as context:
+                preconditions.check(file_obj, {parameter: value})
+            self.assertEqual(context.exception.parameter, parameter)
+
+        with self.assertRaises(PreconditionFailed):
+            preconditions.check(None, {"ifGenerationMatch": 42})
+
+    def test_matches_etag(self):
+        self.assertTrue(preconditions.matches_etag('"CAE="', "CAE="))
+        self.assertTrue(preconditions.matches_etag('"other", W/"CAE="', "CAE="))
+        self.assertTrue(preconditions.matches_etag("*", "CAE="))
+        self.assertFalse(preconditions.matches_etag('"other"', "CAE="))
+        self.assertFalse(preconditions.matches_etag(None, "CAE="))
@@ -1,13 +1,31 @@
+import base64
+import email.parser
+import gzip
+import hashlib
+import http.client
+import json
+import marshal
 import os
+import shutil
+import socket
+import threading
+import time
+import tracemalloc
+from functools import partial
 from io import BytesIO
 from unittest import TestCase as BaseTestCase
+from unittest import mock
+from urllib.parse import urlparse
 
 import fs
 import requests
 from google.api_core.exceptions import Conflict, NotFound
 
-from gcloud_storage_emulator.server import create_server
-from gcloud_storage_emulator.settings import STORAGE_BASE, STORAGE_DIR
+from gcloud_storage_emulator import bench, timing
+from gcloud_storage_emulator.metadata import BACKENDS
+from gcloud_storage_emulator.server import RequestHandler, Response, ThreadPoolHTTPServer, create_server
+from gcloud_storage_emulator.settings import SNAPSHOTS_DIR, STORAGE_BASE, STORAGE_DIR
+from gcloud_storage_emulator.storage import LOCK_FILE, Storage
 
 
 def _get_storage_client(http):
@@ -38,7 +56,7 @@ class ServerBaseCase(BaseTestCase):
     def setUp(self):
         self._session = requests.Session()
         self._client = _get_storage_client(self._session)
-        ObjectsTests._server.wipe()
+        self._server.wipe()
 
 
 class BucketsTests(BaseTestCase):
@@ -71,6 +89,16 @@ class BucketsTests(BaseTestCase):
         all_bucket_names = [b.name for b in self._client.list_buckets()]
         self.assertIn(bucket.name, all_bucket_names)
 
+    def test_bucket_list_paginated(self):
+        names = ["bucket_{}".format(i) for i in range(3)]
+        for name in names:
+            self._client.create_bucket(name)
+
+        buckets = self._client.list_buckets(page_size=2)
+        pages = [[bucket.name for bucket in page] for page in buckets.pages]
+
+        self.assertEqual(pages, [names[0:2], names[2:3]])
+
     def test_bucket_get_existing(self):
         bucket = self._client.create_bucket("bucket_name")
         fetched_bucket = self._client.get_bucket("bucket_name")
@@ -186,6 +214,49 @@ class ObjectsTests(ServerBaseCase):
             expected_content = file.read()
             self.assertEqual(read_content, expected_content)
 
+    def test_upload_chunked_resumable(self):
+        content = os.urandom(1024 * 1024 + 17)
+        bucket = self._client.create_bucket("testbucket")
+        # Small chunks, so the upload is split into several requests
+        blob = bucket.blob("chunked.bin", chunk_size=256 * 1024)
+        blob.upload_from_file(BytesIO(content), checksum=None)
+
+        with fs.open_fs(os.path.join(STORAGE_BASE, STORAGE_DIR)) as pwd:
+            self.assertEqual(pwd.readbytes("testbucket/chunked.bin"), content)
+        blob.reload()
+        self.assertEqual(blob.size, len(content))
+
+    def test_upload_multipart_by_url(self):
+        content = os.urandom(3 * 1024 * 1024) + b"\r\n--bound"
+        self._client.create_bucket("testbucket")
+        body = (
+            b"--boundary\r\nContent-Type: application/json; charset=UTF-8\r\n\r\n"
+            b'{"name": "multipart.bin"}\r\n'
+            b"--boundary\r\nContent-Type: application/octet-stream\r\n\r\n"
+            + content
+            + b"\r\n--boundary--\r\n"
+        )
+
+        response = requests.post(
+            os.environ["STORAGE_EMULATOR_HOST"] + "/upload/storage/v1/b/testbucket/o?uploadType=multipart",
+            data=body,
+            headers={"Content-Type": 'multipart/related; boundary="boundary"'},
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["size"], str(len(content)))
+
+        with fs.open_fs(os.path.join(STORAGE_BASE, STORAGE_DIR)) as pwd:
+            self.assertEqual(pwd.readbytes("testbucket/multipart.bin"), content)
+
+    def test_upload_malformed_multipart_by_url(self):
+        self._client.create_bucket("testbucket")
+        response = requests.post(
+            os.environ["STORAGE_EMULATOR_HOST"] + "/upload/storage/v1/b/testbucket/o?uploadType=multipart",
+            data=b"--boundary\r\nContent-Type: text/plain\r\n\r\ntruncated",
+            headers={"Content-Type": 'multipart/related; boundary="boundary"'},
+        )
+        self.assertEqual(response.status_code, 400)
+
     def test_upload_from_bin_file_cr_lf(self):
         content = b'\r\rheeeeei\r\n'
         test_binary = BytesIO(content)
@@ -274,6 +345,32 @@ class ObjectsTests(ServerBaseCase):
         with open(test_text, "rb") as file:
             self.assertEqual(fetched_file.getvalue(), file.read())
 
+    def test_download_range(self):
+        content = b"The quick brown fox jumps over the lazy dog\n"
+        bucket = self._client.create_bucket("testbucket")
+        blob = bucket.blob("iexist")
+        blob.upload_from_string(content)
+
+        self.assertEqual(blob.download_as_bytes(start=4, end=8), content[4:9])
+        self.assertEqual(blob.download_as_bytes(start=40), content[40:])
+
+    def test_download_chunked_reader(self):
+        content = os.urandom(1024 * 1024 + 3)
+        bucket = self._client.create_bucket("testbucket")
+        blob = bucket.blob("iexist")
+        blob.upload_from_string(content)
+
+        blob = bucket.get_blob("iexist")
+        with blob.open("rb", chunk_size=256 * 1024) as reader:
+            chunks = []
+            while True:
+                chunk = reader.read(100 * 1024)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+
+        self.assertEqual(b"".join(chunks), content)
+
     def test_delete_object(self):
         bucket = self._client.create_bucket("bucket_name")
         blob = bucket.blob("canttouchme.txt")
@@ -286,6 +383,18 @@ class ObjectsTests(ServerBaseCase):
             self.assertIsNone(bucket.get_blob("cantouchme.txt"))
             self.assertFalse(pwd.exists("bucket_name/canttouchme.txt"))
 
+    def test_batch_delete_objects(self):
+        bucket = self._client.create_bucket("bucket_name")
+        blobs = [bucket.blob("file{}.txt".format(i)) for i in range(20)]
+        for blob in blobs:
+            blob.upload_from_string("File content")
+
+        with self._client.batch():
+            for blob in blobs:
+                blob.delete()
+
+        self.assertEqual(list(bucket.list_blobs()), [])
+
     def test_create_within_directory(self):
         bucket = self._client.create_bucket("bucket_name")
         blob = bucket.blob("this/is/a/nested/file.txt")
@@ -369,9 +478,58 @@ class ObjectsTests(ServerBaseCase):
         blob_4 = bucket.blob("b/c.txt")
         blob_4.upload_from_string("text")
 
-        blobs = self._client.list_blobs(bucket, prefix='a', delimiter='/')
+        blobs = self._client.list_blobs(bucket, prefix='a/', delimiter='/')
 
         self._assert_blob_list(blobs, [blob_1, blob_2])
+        self.assertEqual(blobs.prefixes, {"a/b/"})
+
+    def test_list_blobs_with_delimiter_only(self):
+        bucket = self._client.create_bucket("bucket_name")
+
+        blob_1 = bucket.blob("a/b.txt")
+        blob_1.upload_from_string("text")
+
+        blob_2 = bucket.blob("b/c.txt")
+        blob_2.upload_from_string("text")
+
+        blob_3 = bucket.blob("c.txt")
+        blob_3.upload_from_string("text")
+
+        blobs = self._client.list_blobs(bucket, delimiter='/')
+
+        self._assert_blob_list(blobs, [blob_3])
+        self.assertEqual(blobs.prefixes, {"a/", "b/"})
+
+    def test_list_blobs_with_prefix_not_ending_with_delimiter(self):
+        bucket = self._client.create_bucket("bucket_name")
+
+        blob_1 = bucket.blob("a/b.txt")
+        blob_1.upload_from_string("text")
+
+        blob_2 = bucket.blob("ab.txt")
+        blob_2.upload_from_string("text")
+
+        blobs = self._client.list_blobs(bucket, prefix='a', delimiter='/')
+
+        self._assert_blob_list(blobs, [blob_2])
+        self.assertEqual(blobs.prefixes, {"a/"})
+
+    def test_list_blobs_paginated(self):
+        bucket = self._client.create_bucket("bucket_name")
+        names = ["{}.txt".format(i) for i in range(5)]
+        for name in names:
+            bucket.blob(name).upload_from_string("text")
+
+        blobs = self._client.list_blobs(bucket, page_size=2)
+        pages = [[blob.name for blob in page] for page in blobs.pages]
+
+        self.assertEqual(pages, [names[0:2], names[2:4], names[4:5]])
+
+    def test_list_blobs_invalid_page_token(self):
+        self._client.create_bucket("bucket_name")
+        url = os.environ["STORAGE_EMULATOR_HOST"] + "/storage/v1/b/bucket_name/o?pageToken=%25%25"
+        response = requests.get(url)
+        self.assertEqual(response.status_code, 400)
 
     def test_bucket_copy_existing(self):
         bucket = self._client.create_bucket("bucket_name")
@@ -411,6 +569,73 @@ class HttpEndpointsTest(ServerBaseCase):
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response.content, content.encode('utf-8'))
 
+    def test_unknown_route(self):
+        response = requests.get(self._url("/storage/v1/unknown"))
+        self.assertEqual(response.status_code, 404)
+
+    def test_method_not_allowed(self):
+        response = requests.put(self._url("/storage/v1/b"))
+        self.assertEqual(response.status_code, 405)
+        self.assertEqual(response.headers["Allow"], "GET, POST")
+
+        response = requests.delete(self._url("/anotherbucket/something.txt"))
+        self.assertEqual(response.status_code, 405)
+        self.assertEqual(response.headers["Allow"], "GET")
+
+    def _batch(self, parts):
+        body = "".join(
+            "--boundary\r\nContent-Type: application/http\r\nContent-ID: <{}>\r\n\r\n{}\r\n".format(i, part)
+            for i, part in enumerate(parts)
+        ) + "--boundary--\r\n"
+        return requests.post(
+            self._url("/batch/storage/v1"),
+            data=body.encode("utf-8"),
+            headers={"Content-Type": "multipart/mixed; boundary=boundary"},
+        )
+
+    def test_batch(self):
+        self._client.create_bucket("anotherbucket")
+        response = self._batch([
+            "GET /storage/v1/b/anotherbucket HTTP/1.1\r\n",
+            "GET /storage/v1/b/missing HTTP/1.1\r\n",
+            "POST /storage/v1/b HTTP/1.1\r\nContent-Type: application/json\r\n\r\n{\"name\": \"newbucket\"}",
+        ])
+        self.assertEqual(response.status_code, 200)
+
+        message = email.parser.BytesParser().parsebytes(
+            b"Content-Type: " + response.headers["Content-Type"].encode("ascii") + b"\r\n\r\n" + response.content
+        )
+        parts = message.get_payload()
+        self.assertEqual([part["Content-ID"] for part in parts], ["<response-0>", "<response-1>", "<response-2>"])
+        status_lines = [part.get_payload().split("\r\n", 1)[0] for part in parts]
+        self.assertEqual(status_lines, ["HTTP/1.1 200 OK", "HTTP/1.1 404 Not Found", "HTTP/1.1 200 OK"])
+        self.assertIn('"name": "anotherbucket"', parts[0].get_payload())
+        self.assertIsNotNone(self._client.get_bucket("newbucket"))
+
+    def test_batch_too_many_requests(self):
+        response = self._batch(["GET /storage/v1/b HTTP/1.1\r\n"] * 101)
+        self.assertEqual(response.status_code, 400)
+
+    def test_batch_not_multipart(self):
+        response = requests.post(self._url("/batch/storage/v1"), json={})
+        self.assertEqual(response.status_code, 400)
+
+    def test_download_checksums(self):
+        content = b"123456789"
+        bucket = self._client.create_bucket("anotherbucket")
+        blob = bucket.blob("something.txt")
+        blob.upload_from_string(content)
+        self.assertEqual(blob.crc32c, "4waSgw==")
+        self.assertEqual(blob.md5_hash, "JfnnlDI7RTiF9RgfG2JNCw==")
+
+        response = requests.get(self._url("/anotherbucket/something.txt"))
+        self.assertEqual(response.headers["x-goog-hash"], "crc32c=4waSgw==,md5=JfnnlDI7RTiF9RgfG2JNCw==")
+
+        copied_blob = bucket.copy_blob(blob, bucket, "copied.txt")
+        self.assertEqual(copied_blob.crc32c, "4waSgw==")
+        self.assertEqual(copied_blob.md5_hash, "JfnnlDI7RTiF9RgfG2JNCw==")
+        self.assertEqual(copied_blob.download_as_bytes(checksum="md5"), content)
+
     def test_download_file_within_folder(self):
         """ Cloud Storage allows folders within buckets, so the download URL should allow for this.
         """
@@ -424,6 +649,268 @@ class HttpEndpointsTest(ServerBaseCase):
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response.content, content.encode('utf-8'))
 
+    def test_slow_client_does_not_block_other_requests(self):
+        """ A request still being uploaded should not prevent other requests from being served """
+        with socket.create_connection(("localhost", 9023)) as slow_client:
+            slow_client.sendall(
+                b"POST /upload/storage/v1/b/bucket/o?uploadType=multipart HTTP/1.1\r\n"
+                b"Content-Type: multipart/related; boundary=xyz\r\n"
+                b"Content-Length: 1000\r\n\r\n"
+            )
+            response = requests.get(self._url("/"), timeout=5)
+            self.assertEqual(response.status_code, 200)
+
+    def test_stalled_client_times_out(self):
+        """ A client stalling in the middle of its body doesn't hold the only worker forever """
+        httpd = ThreadPoolHTTPServer(
+            ("localhost", 0),
+            partial(RequestHandler, Storage(use_memory_fs=True)),
+            workers=1,
+            request_timeout=0.5,
+        )
+        thread = threading.Thread(target=httpd.serve_forever)
+        thread.start()
+        try:
+            host, port = httpd.server_address
+            with socket.create_connection((host, port)) as stalled_client:
+                stalled_client.sendall(
+                    b"POST /upload/storage/v1/b/bucket/o?uploadType=multipart HTTP/1.1\r\n"
+                    b"Content-Type: multipart/related; boundary=xyz\r\n"
+                    b"Content-Length: 1000\r\n\r\n--xyz"
+                )
+                # Served once the stalled request has timed out
+                response = requests.get("http://{}:{}/".format(host, port), timeout=5)
+                self.assertEqual(response.status_code, 200)
+
+                # The stalled connection is closed, after an error response if any
+                stalled_client.settimeout(5)
+                while stalled_client.recv(4096):
+                    pass
+        finally:
+            httpd.shutdown()
+            httpd.server_close()
+            thread.join()
+
+    def test_download_large_file_by_url(self):
+        """ Objects bigger than a single stream chunk are downloaded in full """
+        content = os.urandom(3 * 1024 * 1024 + 17)
+        bucket = self._client.create_bucket("anotherbucket")
+        blob = bucket.blob("large.bin")
+        blob.upload_from_string(content)
+
+        response = requests.get(self._url("/anotherbucket/large.bin"))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content, content)
+
+    def test_download_range_by_url(self):
+        content = b"0123456789"
+        bucket = self._client.create_bucket("anotherbucket")
+        bucket.blob("digits.txt").upload_from_string(content)
+        url = self._url("/anotherbucket/digits.txt")
+
+        for range_header, expected_range, expected_content in (
+            ("bytes=2-5", "bytes 2-5/10", b"2345"),
+            ("bytes=7-", "bytes 7-9/10", b"789"),
+            ("bytes=-3", "bytes 7-9/10", b"789"),
+            ("bytes=8-100", "bytes 8-9/10", b"89"),
+        ):
+            response = requests.get(url, headers={"Range": range_header})
+            self.assertEqual(response.status_code, 206)
+            self.assertEqual(response.headers["Content-Range"], expected_range)
+            self.assertEqual(response.content, expected_content)
+
+    def test_download_range_not_satisfiable(self):
+        bucket = self._client.create_bucket("anotherbucket")
+        bucket.blob("digits.txt").upload_from_string(b"0123456789")
+
+        response = requests.get(self._url("/anotherbucket/digits.txt"), headers={"Range": "bytes=10-"})
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response.headers["Content-Range"], "bytes */10")
+
+    def test_download_invalid_range_is_ignored(self):
+        bucket = self._client.create_bucket("anotherbucket")
+        bucket.blob("digits.txt").upload_from_string(b"0123456789")
+
+        response = requests.get(self._url("/anotherbucket/digits.txt"), headers={"Range": "bytes=5-2"})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content, b"0123456789")
+
+    def test_download_nonexistent_by_url(self):
+        self._client.create_bucket("anotherbucket")
+        response = requests.get(self._url("/anotherbucket/idonotexist"))
+        self.assertEqual(response.status_code, 404)
+
+    def test_metrics(self):
+        content = b"Here is some content"
+        bucket = self._client.create_bucket("metricsbucket")
+        bucket.blob("something.txt").upload_from_string(content)
+        requests.get(self._url("/unknown"))
+
+        response = requests.get(self._url("/metrics"))
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.headers["Content-Type"].startswith("text/plain; version=0.0.4"))
+        samples = dict(line.rsplit(" ", 1) for line in response.text.splitlines() if not line.startswith("#"))
+
+        upload_labels = 'route="/upload/storage/v1/b/{bucket_name}/o",method="POST"'
+        self.assertGreaterEqual(int(samples['gcs_emulator_requests_total{' + upload_labels + ',status="200"}']), 1)
+        self.assertGreaterEqual(int(samples['gcs_emulator_request_bytes_total{' + upload_labels + '}']), len(content))
+        self.assertGreaterEqual(
+            int(samples['gcs_emulator_request_duration_seconds_bucket{' + upload_labels + ',le="+Inf"}']), 1
+        )
+        self.assertGreaterEqual(
+            int(samples['gcs_emulator_requests_total{route="unmatched",method="GET",status="404"}']), 1
+        )
+        # The request for the metrics themselves
+        self.assertEqual(samples["gcs_emulator_requests_in_flight"], "1")
+        self.assertEqual(samples["gcs_emulator_buckets"], "1")
+        self.assertEqual(samples["gcs_emulator_objects"], "1")
+        self.assertEqual(samples["gcs_emulator_object_bytes"], str(len(content)))
+        self.assertEqual(samples["gcs_emulator_resumable_uploads"], "0")
+        for stage in timing.STAGES:
+            self.assertGreater(float(samples['gcs_emulator_request_stage_seconds_total{stage="' + stage + '"}']), 0)
+
+    def _get_raw(self, path, headers=None):
+        connection = http.client.HTTPConnection("localhost", 9023)
+        try:
+            connection.request("GET", path, headers=headers or {})
+            response = connection.getresponse()
+            return response, response.read()
+        finally:
+            connection.close()
+
+    def test_json_responses_are_compressed(self):
+        bucket = self._client.create_bucket("compressed")
+        for i in range(10):
+            bucket.blob("file_{}.txt".format(i)).upload_from_string("content")
+        path = "/storage/v1/b/compressed/o"
+
+        response, body = self._get_raw(path, {"Accept-Encoding": "gzip"})
+        self.assertEqual(response.getheader("Content-Encoding"), "gzip")
+        self.assertEqual(response.getheader("Vary"), "Accept-Encoding")
+        self.assertEqual(int(response.getheader("Content-Length")), len(body))
+        listing = json.loads(gzip.decompress(body))
+        self.assertEqual(len(listing["items"]), 10)
+
+        response, body = self._get_raw(path)
+        self.assertIsNone(response.getheader("Content-Encoding"))
+        self.assertEqual(json.loads(body), listing)
+        self.assertEqual(len(list(self._client.list_blobs("compressed"))), 10)
+
+    def test_gzip_object_transcoding(self):
+        content = b"Some repeated content " * 100
+        bucket = self._client.create_bucket("transcoded")
+        blob = bucket.blob("file.txt")
+        blob.content_encoding = "gzip"
+        blob.upload_from_string(gzip.compress(content), content_type="text/plain")
+        self.assertEqual(bucket.get_blob("file.txt").content_encoding, "gzip")
+        path = "/download/storage/v1/b/transcoded/o/file.txt?alt=media"
+
+        # Clients which don't accept gzip get the content decompressed
+        response, body = self._get_raw(path)
+        self.assertEqual(body, content)
+        self.assertIsNone(response.getheader("Content-Encoding"))
+        self.assertEqual(response.getheader("x-goog-stored-content-encoding"), "gzip")
+
+        response, body = self._get_raw(path, {"Accept-Encoding": "gzip"})
+        self.assertEqual(response.getheader("Content-Encoding"), "gzip")
+        self.assertEqual(gzip.decompress(body), content)
+
+        self.assertEqual(blob.download_as_bytes(), content)
+
+    def test_invalid_gzip_object_is_sent_as_stored(self):
+        stored = gzip.compress(b"Some repeated content " * 100) + b"trailing garbage"
+        bucket = self._client.create_bucket("transcoded")
+        blob = bucket.blob("file.txt")
+        blob.content_encoding = "gzip"
+        blob.upload_from_string(stored)
+
+        response, body = self._get_raw("/download/storage/v1/b/transcoded/o/file.txt?alt=media")
+        self.assertEqual(response.status, 200)
+        self.assertEqual(response.getheader("Content-Encoding"), "gzip")
+        self.assertEqual(response.getheader("Content-Length"), str(len(stored)))
+        self.assertEqual(body, stored)
+
+    def test_gzip_object_without_transform(self):
+        content = b"Some repeated content " * 100
+        bucket = self._client.create_bucket("transcoded")
+        blob = bucket.blob("file.txt")
+        blob.content_encoding = "gzip"
+        blob.cache_control = "no-transform"
+        blob.upload_from_string(gzip.compress(content))
+
+        response, body = self._get_raw("/transcoded/file.txt")
+        self.assertEqual(response.getheader("Content-Encoding"), "gzip")
+        self.assertEqual(gzip.decompress(body), content)
+
+    def test_etag_revalidation(self):
+        bucket = self._client.create_bucket("revalidated")
+        bucket.blob("file.txt").upload_from_string("content")
+        path = "/download/storage/v1/b/revalidated/o/file.txt?alt=media"
+
+        response, body = self._get_raw(path)
+        etag = response.getheader("ETag")
+        self.assertEqual(etag, '"{}"'.format(bucket.get_blob("file.txt").etag))
+
+        connection = http.client.HTTPConnection("localhost", 9023)
+        try:
+            for revalidated_path in (path, "/storage/v1/b/revalidated/o/file.txt"):
+                connection.request("GET", revalidated_path, headers={"If-None-Match": etag})
+                response = connection.getresponse()
+                self.assertEqual(response.status, 304)
+                self.assertEqual(response.getheader("ETag"), etag)
+                self.assertIsNone(response.getheader("Content-Length"))
+                self.assertEqual(response.read(), b"")
+        finally:
+            connection.close()
+
+        # Every write of an object gives it a new etag
+        bucket.blob("file.txt").upload_from_string("content")
+        response, body = self._get_raw(path, {"If-None-Match": etag})
+        self.assertEqual((response.status, body), (200, b"content"))
+
+    def test_generation_preconditions(self):
+        from google.api_core.exceptions import PreconditionFailed
+
+        bucket = self._client.create_bucket("conditional")
+        blob = bucket.blob("file.txt")
+        blob.upload_from_string("first", if_generation_match=0)
+        with self.assertRaises(PreconditionFailed):
+            blob.upload_from_string("second", if_generation_match=0)
+
+        generation = bucket.get_blob("file.txt").generation
+        blob.upload_from_string("second", if_generation_match=generation)
+        self.assertEqual(blob.download_as_bytes(), b"second")
+        with self.assertRaises(PreconditionFailed):
+            blob.download_as_bytes(if_generation_match=generation)
+        with self.assertRaises(PreconditionFailed):
+            blob.delete(if_generation_match=generation)
+
+        new_generation = bucket.get_blob("file.txt").generation
+        self.assertNotEqual(new_generation, generation)
+        response, _ = self._get_raw(
+            "/storage/v1/b/conditional/o/file.txt?ifGenerationNotMatch={}".format(new_generation)
+        )
+        self.assertEqual(response.status, 304)
+        response, _ = self._get_raw("/storage/v1/b/conditional/o/file.txt?ifGenerationMatch=soon")
+        self.assertEqual(response.status, 400)
+
+        blob.delete(if_generation_match=new_generation)
+        self.assertIsNone(bucket.get_blob("file.txt"))
+
+    def test_resumable_upload_preconditions(self):
+        from google.api_core.exceptions import PreconditionFailed
+
+        bucket = self._client.create_bucket("conditional")
+        bucket.blob("file.txt").upload_from_string("first")
+        blob = bucket.blob("file.txt", chunk_size=256 * 1024)
+        with self.assertRaises(PreconditionFailed):
+            blob.upload_from_string(b"x" * (512 * 1024), if_generation_match=0)
+        self.assertEqual(bucket.blob("file.txt").download_as_bytes(), b"first")
+
+    def test_debug_endpoints_are_disabled(self):
+        self.assertEqual(requests.get(self._url("/_debug/profile?seconds=0")).status_code, 404)
+        self.assertEqual(requests.get(self._url("/_debug/heap")).status_code, 404)
+
     def test_wipe(self):
         """ It should wipe the data """
         storage_path = os.path.join(STORAGE_BASE, STORAGE_DIR)
@@ -435,7 +922,8 @@ class HttpEndpointsTest(ServerBaseCase):
         url = self._url("/wipe")
         response = requests.get(url)
         self.assertEqual(response.status_code, 200)
-        self.assertTrue(len(os.listdir(storage_path)) == 0)
+        # The lock of the multi-process servers is kept, the other processes hold locks on it
+        self.assertEqual([path for path in os.listdir(storage_path) if path != LOCK_FILE], [])
 
     def test_wipe_keep_buckets(self):
         """It should wipe the data but keep the root buckets"""
@@ -454,3 +942,491 @@ class HttpEndpointsTest(ServerBaseCase):
         self.assertEqual(fetched_bucket.name, bucket.name)
         with self.assertRaises(NotFound):
             fetched_bucket.blob(blob_path).download_as_text()
+
+    def test_snapshot_restore(self):
+        self.addCleanup(shutil.rmtree, os.path.join(STORAGE_BASE, SNAPSHOTS_DIR), ignore_errors=True)
+        bucket = self._client.create_bucket("anotherbucket")
+        bucket.blob("seeded.txt").upload_from_string("seeded")
+        response = requests.get(self._url("/_snapshot?name=seeded"))
+        self.assertEqual(response.status_code, 200)
+
+        bucket.blob("seeded.txt").delete()
+        bucket.blob("added.txt").upload_from_string("added")
+        response = requests.get(self._url("/_restore?name=seeded"))
+        self.assertEqual(response.status_code, 200)
+
+        self.assertEqual([blob.name for blob in bucket.list_blobs()], ["seeded.txt"])
+        self.assertEqual(bucket.blob("seeded.txt").download_as_text(), "seeded")
+
+    def test_restore_invalid_snapshot(self):
+        self.assertEqual(requests.get(self._url("/_restore?name=unknown")).status_code, 404)
+        self.assertEqual(requests.get(self._url("/_restore")).status_code, 400)
+        self.assertEqual(requests.get(self._url("/_snapshot?name=../up")).status_code, 400)
+
+    def _create_upload_session(self, name):
+        self._client.create_bucket("testbucket")
+        response = requests.post(
+            self._url("/upload/storage/v1/b/testbucket/o?uploadType=resumable"),
+            json={"name": name},
+        )
+        self.assertEqual(response.status_code, 200)
+        return response.headers["Location"]
+
+    def test_resumable_upload_status(self):
+        content = os.urandom(1024)
+        session_url = self._create_upload_session("resumable.bin")
+
+        response = requests.put(session_url, headers={"Content-Range": "bytes */*"})
+        self.assertEqual(response.status_code, 308)
+        self.assertNotIn("Range", response.headers)
+
+        response = requests.put(session_url, data=content[:600], headers={"Content-Range": "bytes 0-599/*"})
+        self.assertEqual(response.status_code, 308)
+        self.assertEqual(response.headers["Range"], "bytes=0-599")
+
+        response = requests.put(session_url, headers={"Content-Range": "bytes */1024"})
+        self.assertEqual(response.status_code, 308)
+        self.assertEqual(response.headers["Range"], "bytes=0-599")
+
+        # Bytes received already are skipped when the client resends them
+        response = requests.put(session_url, data=content[500:], headers={"Content-Range": "bytes 500-1023/1024"})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["size"], "1024")
+        created = response.json()
+
+        response = requests.get(self._url("/testbucket/resumable.bin"))
+        self.assertEqual(response.content, content)
+
+        # The session is over, a client which lost the last response gets the object it created
+        response = requests.put(session_url, headers={"Content-Range": "bytes */1024"})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), created)
+
+    def test_resumable_upload_final_empty_chunk(self):
+        session_url = self._create_upload_session("resumable.bin")
+        response = requests.put(session_url, data=b"a" * 100, headers={"Content-Range": "bytes 0-99/*"})
+        self.assertEqual(response.status_code, 308)
+
+        response = requests.put(session_url, headers={"Content-Range": "bytes */100"})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["size"], "100")
+
+    def test_resumable_upload_invalid_chunks(self):
+        session_url = self._create_upload_session("resumable.bin")
+
+        response = requests.put(session_url, data=b"a" * 100, headers={"Content-Range": "bytes 100-199/*"})
+        self.assertEqual(response.status_code, 400)
+        response = requests.put(session_url, data=b"a" * 100, headers={"Content-Range": "bytes 0-99"})
+        self.assertEqual(response.status_code, 400)
+
+        response = requests.put(
+            self._url("/upload/storage/v1/b/testbucket/o?uploadType=resumable&upload_id=unknown"),
+            headers={"Content-Range": "bytes */*"},
+        )
+        self.assertEqual(response.status_code, 404)
+
+    def test_resumable_upload_chunk_of_the_wrong_size(self):
+        content = os.urandom(300)
+        session_url = self._create_upload_session("resumable.bin")
+        response = requests.put(session_url, data=content[:100], headers={"Content-Range": "bytes 0-99/*"})
+        self.assertEqual(response.status_code, 308)
+
+        # Shorter and longer than their Content-Range, nothing of them is kept
+        for chunk in (content[100:150], content[100:250]):
+            response = requests.put(session_url, data=chunk, headers={"Content-Range": "bytes 100-199/*"})
+            self.assertEqual(response.status_code, 400)
+
+            response = requests.put(session_url, headers={"Content-Range": "bytes */*"})
+            self.assertEqual(response.status_code, 308)
+            self.assertEqual(response.headers["Range"], "bytes=0-99")
+
+        response = requests.put(session_url, data=content[100:], headers={"Content-Range": "bytes 100-299/300"})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["md5Hash"], base64.b64encode(hashlib.md5(content).digest()).decode())
+        self.assertEqual(requests.get(self._url("/testbucket/resumable.bin")).content, content)
+
+
+class MultiProcessTests(BaseTestCase):
+    """ Tests for a server running several processes over the on-disk storage """
+
+    @classmethod
+    def setUpClass(cls):
+        cls._server = create_server("localhost", 9023, in_memory=False, processes=2)
+        cls._server.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls._server.stop()
+
+    def setUp(self):
+        MultiProcessTests._server.wipe()
+
+    def _url(self, path):
+        return "http://localhost:9023" + path
+
+    def test_processes_share_the_storage(self):
+        # Without a session, every request comes on a new connection, accepted by any process
+        client = _get_storage_client(requests)
+        bucket = client.create_bucket("bucket_name")
+        for i in range(10):
+            bucket.blob("file_{}.txt".format(i)).upload_from_string("content {}".format(i))
+
+        for _ in range(4):
+            self.assertEqual(len(list(client.list_blobs("bucket_name"))), 10)
+        for i in range(10):
+            self.assertEqual(requests.get(self._url("/bucket_name/file_{}.txt".format(i))).text, "content {}".format(i))
+
+        bucket.blob("file_0.txt").delete()
+        for _ in range(4):
+            self.assertEqual(requests.get(self._url("/bucket_name/file_0.txt")).status_code, 404)
+
+    def test_in_memory_storage_is_rejected(self):
+        with self.assertRaises(ValueError):
+            create_server("localhost", 9023, in_memory=True, processes=2)
+
+
+class KeepAliveTests(BaseTestCase):
+    """ Tests for persistent connections, with a server having a single worker """
+
+    @classmethod
+    def setUpClass(cls):
+        cls._server = create_server("localhost", 9024, in_memory=True, workers=1)
+        cls._server.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls._server.stop()
+
+    def setUp(self):
+        KeepAliveTests._server.wipe()
+
+    def _request(self, connection, method, path, body=None, headers=None):
+        connection.request(method, path, body=body, headers=headers or {})
+        response = connection.getresponse()
+        return response, response.read()
+
+    def test_connection_is_reused(self):
+        connection = http.client.HTTPConnection("localhost", 9024)
+        self._request(connection, "GET", "/")
+        sock = connection.sock
+
+        response, body = self._request(connection, "GET", "/")
+        self.assertEqual(body, b"OK")
+        self.assertEqual(response.headers["Content-Length"], "2")
+        self.assertIs(connection.sock, sock)
+
+        response, body = self._request(connection, "OPTIONS", "/")
+        self.assertEqual((response.status, body), (200, b"ok"))
+        self.assertIs(connection.sock, sock)
+        connection.close()
+
+    def test_idle_connections_dont_hold_workers(self):
+        connections = [http.client.HTTPConnection("localhost", 9024, timeout=5) for _ in range(3)]
+        for connection in connections:
+            response, body = self._request(connection, "GET", "/")
+            self.assertEqual(body, b"OK")
+        for connection in reversed(connections):
+            response, body = self._request(connection, "GET", "/")
+            self.assertEqual(body, b"OK")
+            connection.close()
+
+    def test_unread_body_is_skipped(self):
+        connection = http.client.HTTPConnection("localhost", 9024)
+        response, _ = self._request(connection, "PUT", "/storage/v1/b", body=b"x" * 1000)
+        self.assertEqual(response.status, 405)
+        response, body = self._request(connection, "GET", "/")
+        self.assertEqual(body, b"OK")
+        connection.close()
+
+    def test_chunked_request_body(self):
+        connection = http.client.HTTPConnection("localhost", 9024)
+        self._request(connection, "POST", "/storage/v1/b", body=b'{"name": "bucket"}', headers={
+            "Content-Type": "application/json",
+        })
+
+        content = os.urandom(100 * 1024)
+        response, body = self._request(
+            connection, "POST", "/upload/storage/v1/b/bucket/o?uploadType=resumable", b'{"name": "file.bin"}',
+            headers={"Content-Type": "application/json"},
+        )
+        self.assertEqual(response.status, 200)
+        location = urlparse(response.headers["Location"])
+
+        response, body = self._request(
+            connection, "PUT", "{}?{}".format(location.path, location.query),
+            (chunk for chunk in (content[:1000], content[1000:50000], content[50000:])),
+            # Without a length, the body is sent with chunked transfer encoding
+            headers={"Content-Type": "application/octet-stream"},
+        )
+        self.assertEqual(response.status, 200)
+        self.assertEqual(json.loads(body)["size"], str(len(content)))
+
+        response, body = self._request(connection, "GET", "/bucket/file.bin")
+        self.assertEqual(body, content)
+        connection.close()
+
+
+class ResponseTests(BaseTestCase):
+
+    def _make_handler(self, request_version="HTTP/1.1"):
+        handler = mock.Mock(request_version=request_version, close_connection=False, wfile=BytesIO())
+        return handler
+
+    def test_stream_of_unknown_length_is_chunked(self):
+        read_fd, write_fd = os.pipe()
+        with open(write_fd, "wb") as pipe:
+            pipe.write(b"some content")
+
+        handler = self._make_handler()
+        response = Response(handler)
+        response.write_stream(open(read_fd, "rb"))
+        response.close()
+
+        handler.send_header.assert_any_call("Transfer-Encoding", "chunked")
+        self.assertEqual(handler.wfile.getvalue(), b"c\r\nsome content\r\n0\r\n\r\n")
+
+    def test_stream_length(self):
+        handler = self._make_handler()
+        response = Response(handler)
+        stream = BytesIO(b"some content")
+        stream.seek(5)
+        response.write_stream(stream)
+        response.close()
+
+        handler.send_header.assert_any_call("Content-Length", "7")
+        self.assertEqual(handler.wfile.getvalue(), b"content")
+
+
+class InMemoryHttpEndpointsTest(BaseTestCase):
+    """ Tests for the HTTP endpoints, with the in-memory storage """
+
+    @classmethod
+    def setUpClass(cls):
+        cls._server = create_server("localhost", 9023, in_memory=True)
+        cls._server.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls._server.stop()
+
+    def setUp(self):
+        self._session = requests.Session()
+        self._client = _get_storage_client(self._session)
+        InMemoryHttpEndpointsTest._server.wipe()
+
+    def _url(self, path):
+        return os.environ["STORAGE_EMULATOR_HOST"] + path
+
+    def test_snapshot_restore(self):
+        bucket = self._client.create_bucket("anotherbucket")
+        bucket.blob("seeded.txt").upload_from_string("seeded")
+        self._server.snapshot("seeded")
+
+        bucket.blob("seeded.txt").upload_from_string("changed")
+        self._server.restore("seeded")
+        self.assertEqual(bucket.blob("seeded.txt").download_as_text(), "seeded")
+
+    def test_download_large_file(self):
+        content = os.urandom(3 * 1024 * 1024 + 17)
+        bucket = self._client.create_bucket("anotherbucket")
+        blob = bucket.blob("large.bin")
+        blob.upload_from_string(content)
+
+        self.assertEqual(blob.download_as_bytes(), content)
+
+        response = requests.get(self._url("/anotherbucket/large.bin"))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content, content)
+
+    def test_download_range(self):
+        content = os.urandom(1024 * 1024)
+        bucket = self._client.create_bucket("anotherbucket")
+        blob = bucket.blob("large.bin")
+        blob.upload_from_string(content)
+
+        self.assertEqual(blob.download_as_bytes(start=1000, end=500999), content[1000:501000])
+
+    def test_upload_chunked_resumable(self):
+        content = os.urandom(1024 * 1024 + 17)
+        bucket = self._client.create_bucket("anotherbucket")
+        blob = bucket.blob("chunked.bin", chunk_size=256 * 1024)
+        blob.upload_from_file(BytesIO(content), checksum=None)
+
+        response = requests.get(self._url("/anotherbucket/chunked.bin"))
+        self.assertEqual(response.content, content)
+
+
+class DebugEndpointsTests(BaseTestCase):
+    """ Tests for the profiling endpoints of a server started with debug_endpoints """
+
+    @classmethod
+    def setUpClass(cls):
+        cls._server = create_server("localhost", 9025, in_memory=True, debug_endpoints=True)
+        cls._server.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls._server.stop()
+
+    def setUp(self):
+        DebugEndpointsTests._server.wipe()
+
+    def tearDown(self):
+        tracemalloc.stop()
+
+    def _url(self, path):
+        return "http://localhost:9025" + path
+
+    def _in_background(self, path):
+        responses = []
+        thread = threading.Thread(target=lambda: responses.append(requests.get(self._url(path))))
+        thread.start()
+        # Leaves the request the time to be picked up by a worker
+        time.sleep(0.2)
+        return thread, responses
+
+    def test_profile(self):
+        thread, responses = self._in_background("/_debug/profile?seconds=1")
+        requests.post(self._url("/storage/v1/b"), json={"name": "profiled"})
+        thread.join()
+
+        response = responses[0]
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("function calls", response.text)
+        self.assertIn("(insert)", response.text)
+
+    def test_profile_as_pstats(self):
+        thread, responses = self._in_background("/_debug/profile?seconds=1&format=pstats")
+        requests.get(self._url("/storage/v1/b"))
+        thread.join()
+
+        stats = marshal.loads(responses[0].content)
+        self.assertIn("ls", {function for _, _, function in stats})
+
+    def test_profile_in_progress(self):
+        # Only one debug request lasting a while holds a worker at a time
+        thread, _ = self._in_background("/_debug/profile?seconds=1")
+        for path in (
+            "/_debug/profile?seconds=0",
+            "/_debug/profile?seconds=0&mode=sample",
+            "/_debug/heap?seconds=0.1",
+        ):
+            self.assertEqual(requests.get(self._url(path)).status_code, 409, path)
+        self.assertEqual(requests.get(self._url("/_debug/heap?limit=1")).status_code, 200)
+        thread.join()
+
+    def test_sample_stacks(self):
+        requests.post(self._url("/storage/v1/b"), json={"name": "sampled"})
+        # A stalled upload keeps a worker busy while the stacks are sampled
+        with socket.create_connection(("localhost", 9025)) as stalled_client:
+            stalled_client.sendall(
+                b"POST /upload/storage/v1/b/sampled/o?uploadType=media&name=file.txt HTTP/1.1\r\n"
+                b"Content-Type: text/plain\r\n"
+                b"Content-Length: 1000\r\n\r\n"
+            )
+            time.sleep(0.2)
+            response = requests.get(self._url("/_debug/profile?seconds=0.5&mode=sample"))
+
+        self.assertEqual(response.status_code, 200)
+        stacks = dict(line.rsplit(" ", 1) for line in response.text.splitlines())
+        self.assertTrue(stacks)
+        self.assertTrue(any("do_POST (server.py" in stack for stack in stacks), stacks)
+
+    def test_invalid_parameters(self):
+        for path in (
+            "/_debug/profile?seconds=soon",
+            "/_debug/profile?seconds=-1",
+            "/_debug/profile?mode=other",
+            "/_debug/profile?format=other",
+            "/_debug/heap?limit=0",
+        ):
+            self.assertEqual(requests.get(self._url(path)).status_code, 400, path)
+
+    def test_heap(self):
+        response = requests.get(self._url("/_debug/heap?limit=5"))
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(tracemalloc.is_tracing())
+
+        response = requests.get(self._url("/_debug/heap?limit=5&seconds=0.2"))
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("Top 5 growths", response.text)
+
+        requests.get(self._url("/_debug/heap?stop=1"))
+        self.assertFalse(tracemalloc.is_tracing())
+
+
+class SlowRequestLogTests(BaseTestCase):
+    """ Tests for the slow log, with a server logging every request as slow """
+
+    @classmethod
+    def setUpClass(cls):
+        cls._server = create_server("localhost", 9026, in_memory=True, slow_request_threshold=0)
+        cls._server.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls._server.stop()
+
+    def test_slow_requests_are_logged_with_their_stages(self):
+        with self.assertLogs(timing.slow_logger, "WARNING") as logs:
+            response = requests.post("http://localhost:9026/storage/v1/b", json={"name": "slow"})
+            self.assertEqual(response.status_code, 200)
+            # The request is logged once its response is sent
+            time.sleep(0.1)
+
+        self.assertEqual(len(logs.records), 1)
+        message = logs.records[0].getMessage()
+        self.assertTrue(message.startswith("Slow request POST /storage/v1/b 200 took "), message)
+        for stage in timing.STAGES + (timing.OTHER,):
+            self.assertRegex(message, r" {}=\d+\.\d{{3}}ms".format(stage))
+
+    def test_fast_requests_are_not_logged(self):
+        with mock.patch.object(self._server._api._httpd, "slow_request_threshold", 60):
+            with mock.patch.object(timing.slow_logger, "warning") as warning:
+                requests.get("http://localhost:9026/")
+                time.sleep(0.1)
+        warning.assert_not_called()
+
+
+class BenchTests(BaseTestCase):
+    def test_run_benchmark(self):
+        with mock.patch.object(bench, "SEED_OBJECTS", 20):
+            results = bench.run_benchmark(
+                in_memory=True, concurrency=2, requests=5, large_size=300 * 1024, routing_dispatches=10,
+                startup_objects=20,
+            )
+
+        self.assertEqual(results["settings"]["requests"], 5)
+        self.assertEqual(list(results["workloads"]), list(bench.WORKLOADS))
+        routing = results["workloads"].pop("routing")
+        self.assertEqual(list(routing), [group for group, _, _ in bench.ROUTING_PATHS])
+        self.assertEqual(results["workloads"].pop("startup")["objects"], 20)
+        for workload, result in results["workloads"].items():
+            self.assertEqual((result["operations"], result["errors"]), (5, 0), workload)
+            latencies = result["latency_ms"]
+            self.assertLessEqual(latencies["p50"], latencies["p95"])
+            self.assertLessEqual(latencies["p95"], latencies["p99"])
+        self.assertGreater(results["workloads"]["resumable_upload"]["mb_per_sec"], 0)
+
+    def test_routing_workload(self):
+        results = bench.run_routing(dispatches=50)
+
+        self.assertEqual(list(results), [group for group, _, _ in bench.ROUTING_PATHS])
+        for group, result in results.items():
+            self.assertEqual(result["operations"], 50, group)
+            latencies = result["latency_us"]
+            self.assertLessEqual(latencies["p50"], latencies["p99"])
+            self.assertGreater(result["lookup_us"], 0)
+
+    def test_startup_workload(self):
+        for backend in BACKENDS:
+            result = bench.run_startup(objects=50, metadata_backend=backend, repeats=3)
+
+            self.assertEqual((result["objects"], result["metadata"], result["repeats"]), (50, backend, 3))
+            for measure in ("open_ms", "first_request_ms", "first_listing_ms"):
+                self.assertLessEqual(result[measure]["min"], result[measure]["p50"], measure)
+            self.assertLessEqual(result["open_ms"]["min"], result["first_listing_ms"]["min"])
+
+    def test_unknown_workload(self):
+        with self.assertRaises(ValueError):
+            bench.run_benchmark(workloads=["unknown"], in_memory=True)
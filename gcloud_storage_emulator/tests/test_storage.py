@@ -1,16 +1,40 @@
 import json
 import os
+import shutil
+import tempfile
+import threading
+from io import BytesIO
 from unittest import TestCase as BaseTestCase
+from unittest import mock
 
-from gcloud_storage_emulator.exceptions import NotFound
+from gcloud_storage_emulator import journal
+from gcloud_storage_emulator.exceptions import Conflict, NotFound, PreconditionFailed
 from gcloud_storage_emulator.settings import STORAGE_BASE, STORAGE_DIR
-from gcloud_storage_emulator.storage import Storage
+from gcloud_storage_emulator.storage import LOCK_FILE, Storage
 
 
 def _get_meta_path():
     return os.path.join(os.getcwd(), STORAGE_BASE, STORAGE_DIR, ".meta")
 
 
+def _get_journal_path():
+    return os.path.join(os.getcwd(), STORAGE_BASE, STORAGE_DIR, ".journal")
+
+
+def _read_meta():
+    """Loads the persisted metadata (snapshot and journal) as a restarted emulator would"""
+    return _read_meta_from(STORAGE_BASE)
+
+
+def _read_meta_from(data_dir):
+    storage = Storage(data_dir=data_dir)
+    return {
+        "buckets": storage.buckets,
+        "objects": storage.objects,
+        "resumable": storage.resumable,
+    }
+
+
 class StorageOSFSTests(BaseTestCase):
     def setUp(self):
         self.storage = Storage()
@@ -65,10 +89,159 @@ class StorageOSFSTests(BaseTestCase):
         bucket_obj = {"key": "val"}
         self.storage.create_bucket("a_bucket", bucket_obj)
 
-        meta_path = _get_meta_path()
-        with open(meta_path, "r") as file:
-            meta = json.load(file)
-            self.assertEqual(meta["buckets"]["a_bucket"], bucket_obj)
+        meta = _read_meta()
+        self.assertEqual(meta["buckets"]["a_bucket"], bucket_obj)
+
+    def test_create_bucket_conflict(self):
+        self.storage.create_bucket("a_bucket", {"key": "val"})
+        with self.assertRaises(Conflict):
+            self.storage.create_bucket("a_bucket", {"key": "other"})
+        self.assertEqual(self.storage.get_bucket("a_bucket"), {"key": "val"})
+
+    def test_concurrent_create_file(self):
+        def upload(thread_id):
+            for i in range(20):
+                file_name = "{}/{}.txt".format(thread_id, i)
+                self.storage.create_file("a_bucket_name", file_name, b"content", {"name": file_name})
+
+        threads = [threading.Thread(target=upload, args=(thread_id,)) for thread_id in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        meta = _read_meta()
+        self.assertEqual(len(meta["objects"]["a_bucket_name"]), 8 * 20)
+
+    def test_mutations_are_appended_to_the_journal(self):
+        self.storage.create_bucket("a_bucket", {"key": "val"})
+        self.storage.create_file("a_bucket", "file_name.txt", b"content", {"key": "val"})
+        self.storage.delete_file("a_bucket", "file_name.txt")
+
+        self.assertFalse(os.path.isfile(_get_meta_path()))
+        with open(_get_journal_path(), "r") as file:
+            records = [json.loads(line) for line in file]
+        self.assertEqual(
+            [record["op"] for record in records],
+            ["put_bucket", "put_object", "delete_object"]
+        )
+
+    def test_stats(self):
+        self.storage.create_bucket("a_bucket", {"key": "val"})
+        self.storage.create_file("a_bucket", "file_1.txt", b"content", {"key": "val"})
+        self.storage.create_file("a_bucket", "file_2.txt", b"other content", {"key": "val"})
+        self.storage.create_file("a_bucket", "file_1.txt", b"new content", {"key": "val"})
+        self.storage.create_resumable_upload("a_bucket", "upload.txt", {"bucket": "a_bucket", "name": "upload.txt"})
+        stats = {"buckets": 1, "objects": 2, "bytes": 24, "resumable": 1}
+        self.assertEqual(self.storage.stats(), stats)
+        self.assertEqual(Storage().stats(), stats)
+
+        self.storage.delete_file("a_bucket", "file_2.txt")
+        self.assertEqual(self.storage.stats(), {"buckets": 1, "objects": 1, "bytes": 11, "resumable": 1})
+        self.storage.wipe()
+        self.assertEqual(self.storage.stats(), {"buckets": 0, "objects": 0, "bytes": 0, "resumable": 0})
+
+    def test_journal_is_compacted(self):
+        self.storage.create_bucket("a_bucket", {"key": "val"})
+        for i in range(journal.COMPACTION_MIN_RECORDS):
+            self.storage.create_file("a_bucket", "{}.txt".format(i), b"content", {"name": str(i)})
+
+        with open(_get_meta_path(), "r") as file:
+            header = json.loads(file.readline())
+            self.assertEqual(header["buckets"], {"a_bucket": {"key": "val"}})
+            segment = json.loads(file.readline())
+            self.assertEqual(len(segment["objects"]), journal.COMPACTION_MIN_RECORDS)
+        self.assertEqual(os.path.getsize(_get_journal_path()), 0)
+
+        self.storage.delete_file("a_bucket", "0.txt")
+        meta = _read_meta()
+        self.assertEqual(len(meta["objects"]["a_bucket"]), journal.COMPACTION_MIN_RECORDS - 1)
+
+    def test_truncated_journal_record_is_ignored(self):
+        self.storage.create_bucket("a_bucket", {"key": "val"})
+        with open(_get_journal_path(), "a") as file:
+            file.write('{"op": "put_bucket", "na')
+
+        storage = Storage()
+        self.assertEqual(storage.buckets, {"a_bucket": {"key": "val"}})
+
+        storage.create_bucket("b_bucket", {"key": "val"})
+        meta = _read_meta()
+        self.assertEqual(sorted(meta["buckets"]), ["a_bucket", "b_bucket"])
+
+    def test_get_file_list_with_prefix_and_delimiter(self):
+        self.storage.create_bucket("a_bucket", {})
+        for file_name in ("a/1.txt", "a/b/2.txt", "a/b/3.txt", "a/c/4.txt", "a0.txt", "b.txt"):
+            self.storage.create_file("a_bucket", file_name, b"content", {"name": file_name})
+
+        files, prefixes, _ = self.storage.get_file_list("a_bucket", "a")
+        self.assertEqual(
+            [file_obj["name"] for file_obj in files],
+            ["a/1.txt", "a/b/2.txt", "a/b/3.txt", "a/c/4.txt", "a0.txt"]
+        )
+        self.assertEqual(prefixes, [])
+
+        files, prefixes, _ = self.storage.get_file_list("a_bucket", "a/", "/")
+        self.assertEqual([file_obj["name"] for file_obj in files], ["a/1.txt"])
+        self.assertEqual(prefixes, ["a/b/", "a/c/"])
+
+        files, prefixes, _ = self.storage.get_file_list("a_bucket", None, "/")
+        self.assertEqual([file_obj["name"] for file_obj in files], ["a0.txt", "b.txt"])
+        self.assertEqual(prefixes, ["a/"])
+
+    def test_get_file_list_paginated(self):
+        self.storage.create_bucket("a_bucket", {})
+        for file_name in ("a/1.txt", "a/2.txt", "b/3.txt", "c.txt", "d.txt"):
+            self.storage.create_file("a_bucket", file_name, b"content", {"name": file_name})
+
+        pages = []
+        page_token = None
+        while True:
+            files, prefixes, page_token = self.storage.get_file_list("a_bucket", None, "/", 2, page_token)
+            pages.append(([file_obj["name"] for file_obj in files], prefixes))
+            if not page_token:
+                break
+
+        self.assertEqual(pages, [
+            ([], ["a/", "b/"]),
+            (["c.txt", "d.txt"], []),
+        ])
+
+    def test_get_file_list_page_token_is_stable(self):
+        self.storage.create_bucket("a_bucket", {})
+        for file_name in ("a.txt", "b.txt", "d.txt"):
+            self.storage.create_file("a_bucket", file_name, b"content", {"name": file_name})
+
+        files, _, page_token = self.storage.get_file_list("a_bucket", max_results=2)
+        self.assertEqual([file_obj["name"] for file_obj in files], ["a.txt", "b.txt"])
+
+        self.storage.delete_file("a_bucket", "b.txt")
+        self.storage.create_file("a_bucket", "c.txt", b"content", {"name": "c.txt"})
+
+        files, _, page_token = self.storage.get_file_list("a_bucket", max_results=2, page_token=page_token)
+        self.assertEqual([file_obj["name"] for file_obj in files], ["c.txt", "d.txt"])
+        self.assertIsNone(page_token)
+
+    def test_get_bucket_list_paginated(self):
+        for bucket_name in ("c_bucket", "a_bucket", "b_bucket"):
+            self.storage.create_bucket(bucket_name, {"name": bucket_name})
+
+        bucket_list, page_token = self.storage.get_bucket_list(max_results=2)
+        self.assertEqual([bucket["name"] for bucket in bucket_list], ["a_bucket", "b_bucket"])
+
+        bucket_list, page_token = self.storage.get_bucket_list(max_results=2, page_token=page_token)
+        self.assertEqual([bucket["name"] for bucket in bucket_list], ["c_bucket"])
+        self.assertIsNone(page_token)
+
+    def test_get_file_list_after_delete_and_reload(self):
+        self.storage.create_bucket("a_bucket", {})
+        for file_name in ("c.txt", "a.txt", "b.txt"):
+            self.storage.create_file("a_bucket", file_name, b"content", {"name": file_name})
+        self.storage.delete_file("a_bucket", "b.txt")
+
+        for storage in (self.storage, Storage()):
+            files, _, _ = storage.get_file_list("a_bucket")
+            self.assertEqual([file_obj["name"] for file_obj in files], ["a.txt", "c.txt"])
 
     def test_create_file_stores_content(self):
         test_file = os.path.join(os.getcwd(), STORAGE_BASE, STORAGE_DIR, "a_bucket_name", "file_name.txt")
@@ -84,18 +257,14 @@ class StorageOSFSTests(BaseTestCase):
         content = "Łukas is a great developer".encode("utf8")
         file_obj = {"key": "val"}
         self.storage.create_file("a_bucket_name", "file_name.txt", content, file_obj)
-        meta_path = _get_meta_path()
-        with open(meta_path, "r") as file:
-            meta = json.load(file)
-            self.assertEqual(meta["objects"]["a_bucket_name"]["file_name.txt"], file_obj)
+        meta = _read_meta()
+        self.assertEqual(meta["objects"]["a_bucket_name"]["file_name.txt"], file_obj)
 
     def test_create_resumable_upload_stores_meta(self):
         file_obj = {"key": "val"}
         file_id = self.storage.create_resumable_upload("a_bucket_name", "file_name.png", file_obj)
-        meta_path = _get_meta_path()
-        with open(meta_path, "r") as file:
-            meta = json.load(file)
-            self.assertEqual(meta["resumable"][file_id], file_obj)
+        meta = _read_meta()
+        self.assertEqual(meta["resumable"][file_id], file_obj)
 
     def test_file_ids_dont_clash(self):
         file_obj = {"key": "val"}
@@ -114,23 +283,153 @@ class StorageOSFSTests(BaseTestCase):
             read_content = file.read()
             self.assertEqual(read_content, content)
 
-        with open(_get_meta_path(), "r") as file:
-            meta = json.load(file)
-            self.assertEqual(meta["objects"]["a_bucket_name"]["file_name.png"], file_obj)
-            self.assertEqual(meta["resumable"], {})
+        meta = _read_meta()
+        self.assertEqual(meta["objects"]["a_bucket_name"]["file_name.png"], file_obj)
+        self.assertEqual(meta["resumable"], {})
 
         self.assertEqual(file_obj["size"], str(len(content)))
 
+    def test_resumable_upload_in_chunks(self):
+        file_obj = {"bucket": "a_bucket_name", "name": "file_name.png"}
+        file_id = self.storage.create_resumable_upload("a_bucket_name", "file_name.png", file_obj)
+        self.assertEqual(self.storage.get_resumable_upload(file_id), (file_obj, 0))
+
+        self.assertEqual(self.storage.append_to_resumable_upload(file_id, b"first "), 6)
+
+        # The chunks received so far survive a restart
+        storage = Storage()
+        self.assertEqual(storage.get_resumable_upload(file_id), (file_obj, 6))
+        self.assertEqual(storage.append_to_resumable_upload(file_id, BytesIO(b"second")), 12)
+
+        storage.finish_resumable_upload(file_id)
+        self.assertEqual(storage.get_file("a_bucket_name", "file_name.png"), b"first second")
+        self.assertEqual(storage.get_file_obj("a_bucket_name", "file_name.png")["size"], "12")
+        with self.assertRaises(NotFound):
+            storage.get_resumable_upload(file_id)
+        with self.assertRaises(NotFound):
+            storage.append_to_resumable_upload(file_id, b"more")
+
+    def test_resumable_upload_chunk_of_the_wrong_size(self):
+        file_obj = {"bucket": "a_bucket_name", "name": "file_name.png"}
+        file_id = self.storage.create_resumable_upload("a_bucket_name", "file_name.png", file_obj)
+        self.assertEqual(self.storage.append_to_resumable_upload(file_id, b"first ", size=6), 6)
+        for chunk in (b"sec", b"second!"):
+            with self.assertRaises(ValueError):
+                self.storage.append_to_resumable_upload(file_id, BytesIO(chunk), size=6)
+            self.assertEqual(self.storage.get_resumable_upload(file_id), (file_obj, 6))
+
+        self.assertEqual(self.storage.append_to_resumable_upload(file_id, b"second", size=6), 12)
+        finished_obj = self.storage.finish_resumable_upload(file_id)
+        self.assertEqual(self.storage.get_file("a_bucket_name", "file_name.png"), b"first second")
+        self.assertEqual(finished_obj["md5Hash"], "IFlkDALFoWp5VkrAuca6vQ==")
+        self.assertEqual(self.storage.get_finished_resumable_upload(file_id), finished_obj)
+
+    def test_copy_file(self):
+        content = os.urandom(1024 * 1024 + 17)
+        self.storage.create_file("a_bucket", "source.bin", content, {"key": "val"})
+        dest_obj = {"key": "dest"}
+        self.storage.copy_file("a_bucket", "source.bin", "other_bucket", "dest.bin", dest_obj)
+
+        self.assertEqual(self.storage.get_file("other_bucket", "dest.bin"), content)
+        self.assertEqual(dest_obj["size"], str(len(content)))
+
+        # The copy doesn't change with its source
+        self.storage.create_file("a_bucket", "source.bin", b"new content", {"key": "val"})
+        self.assertEqual(self.storage.get_file("other_bucket", "dest.bin"), content)
+        self.assertEqual(_read_meta()["objects"]["other_bucket"]["dest.bin"], dest_obj)
+
+        with self.assertRaises(NotFound):
+            self.storage.copy_file("a_bucket", "missing.bin", "a_bucket", "dest.bin", {})
+
+    def test_preconditions(self):
+        file_obj = {"generation": "1", "metageneration": "1"}
+        self.storage.create_file("a_bucket", "file.txt", b"first", file_obj, preconditions={"ifGenerationMatch": 0})
+        with self.assertRaises(PreconditionFailed):
+            self.storage.create_file("a_bucket", "file.txt", b"second", {}, preconditions={"ifGenerationMatch": 0})
+        with self.assertRaises(PreconditionFailed):
+            self.storage.copy_file("a_bucket", "file.txt", "a_bucket", "file.txt", {}, {"ifGenerationMatch": 2})
+        with self.assertRaises(PreconditionFailed):
+            self.storage.delete_file("a_bucket", "file.txt", preconditions={"ifMetagenerationNotMatch": 1})
+        self.assertEqual(self.storage.get_file("a_bucket", "file.txt"), b"first")
+
+        generation = int(file_obj["generation"])
+        self.storage.create_file("a_bucket", "file.txt", b"second", {"generation": "2", "metageneration": "1"},
+                                 preconditions={"ifGenerationMatch": generation, "ifMetagenerationMatch": 1})
+        self.assertEqual(self.storage.get_file("a_bucket", "file.txt"), b"second")
+        self.storage.delete_file("a_bucket", "file.txt", preconditions={"ifGenerationNotMatch": generation})
+        with self.assertRaises(NotFound):
+            self.storage.get_file_obj("a_bucket", "file.txt")
+
+    def test_resumable_upload_precondition_failure_ends_the_session(self):
+        self.storage.create_file("a_bucket", "file.txt", b"first", {"generation": "1", "metageneration": "1"})
+        file_obj = {"bucket": "a_bucket", "name": "file.txt"}
+        file_id = self.storage.create_resumable_upload("a_bucket", "file.txt", file_obj)
+        with self.assertRaises(PreconditionFailed):
+            self.storage.create_file_for_resumable_upload(file_id, b"second", preconditions={"ifGenerationMatch": 0})
+
+        self.assertEqual(self.storage.get_file("a_bucket", "file.txt"), b"first")
+        with self.assertRaises(NotFound):
+            self.storage.get_resumable_upload(file_id)
+        self.assertEqual(_read_meta()["resumable"], {})
+
+    def test_resumable_upload_gets_its_generation_when_finished(self):
+        file_obj = {"bucket": "a_bucket", "name": "file.txt", "generation": "1", "metageneration": "1",
+                    "mediaLink": "http://localhost/download/storage/v1/b/a_bucket/o/file.txt?generation=1&alt=media"}
+        file_id = self.storage.create_resumable_upload("a_bucket", "file.txt", file_obj)
+
+        # Written while the session is open
+        written_obj = {"generation": "1", "metageneration": "1"}
+        self.storage.create_file("a_bucket", "file.txt", b"meanwhile", written_obj)
+
+        finished_obj = self.storage.create_file_for_resumable_upload(file_id, b"finished")
+        generation = int(finished_obj["generation"])
+        self.assertGreater(generation, int(written_obj["generation"]))
+        self.assertNotEqual(finished_obj["etag"], written_obj["etag"])
+        self.assertEqual(finished_obj["id"], "a_bucket/file.txt/{}".format(generation))
+        self.assertIn("?generation={}&".format(generation), finished_obj["mediaLink"])
+        self.assertEqual(self.storage.get_file_obj("a_bucket", "file.txt"), finished_obj)
+
+        with self.assertRaises(PreconditionFailed):
+            self.storage.delete_file("a_bucket", "file.txt", preconditions={"ifGenerationMatch": 1})
+        self.storage.delete_file("a_bucket", "file.txt", preconditions={"ifGenerationMatch": generation})
+
+    def test_open_file(self):
+        content = "Łukas is a great developer".encode("utf8")
+        self.storage.create_file("a_bucket_name", "file_name.txt", content, {"key": "val"})
+
+        file_obj, file = self.storage.open_file("a_bucket_name", "file_name.txt")
+        with file:
+            self.assertEqual(file_obj, {
+                "key": "val",
+                "size": str(len(content)),
+                "md5Hash": "01GtsrqRjcUutI4KrtIhhw==",
+                "crc32c": "Tdldjw==",
+            })
+            self.assertIsInstance(file.fileno(), int)
+            self.assertEqual(file.read(), content)
+
+    def test_open_file_survives_overwrite(self):
+        self.storage.create_file("a_bucket_name", "file_name.txt", b"old content", {"key": "val"})
+
+        _, file = self.storage.open_file("a_bucket_name", "file_name.txt")
+        with file:
+            self.storage.create_file("a_bucket_name", "file_name.txt", b"new content", {"key": "val"})
+            self.assertEqual(file.read(), b"old content")
+
+        self.assertEqual(self.storage.get_file("a_bucket_name", "file_name.txt"), b"new content")
+
+    def test_open_file_not_found(self):
+        with self.assertRaises(NotFound):
+            self.storage.open_file("a_bucket", "a_file")
+
     def test_delete_bucket_stores_meta(self):
         bucket_obj = {"key": "val"}
         self.storage.create_bucket("a_bucket", bucket_obj)
 
         self.storage.delete_bucket("a_bucket")
 
-        meta_path = _get_meta_path()
-        with open(meta_path, "r") as file:
-            meta = json.load(file)
-            self.assertIsNone(meta["buckets"].get('a_bucket'))
+        meta = _read_meta()
+        self.assertIsNone(meta["buckets"].get('a_bucket'))
 
     def test_wipe(self):
         bucket_a_obj = {"key_a": "val_a"}
@@ -140,6 +439,7 @@ class StorageOSFSTests(BaseTestCase):
         self.storage.wipe()
         meta_path = _get_meta_path()
         self.assertFalse(os.path.isfile(meta_path))
+        self.assertFalse(os.path.isfile(_get_journal_path()))
 
     def test_wipe_keep_buckets(self):
         bucket_a_obj = {"key_a": "val_a"}
@@ -147,11 +447,603 @@ class StorageOSFSTests(BaseTestCase):
         self.storage.create_bucket("bucket_a", bucket_a_obj)
         self.storage.create_bucket("bucket_b", bucket_b_obj)
         self.storage.wipe(keep_buckets=True)
-        meta_path = _get_meta_path()
 
-        with open(meta_path, "r") as file:
-            meta = json.load(file)
-            self.assertEqual(meta["buckets"]["bucket_a"], bucket_a_obj)
-            self.assertEqual(meta["buckets"]["bucket_b"], bucket_b_obj)
-            self.assertEqual(meta["objects"], {})
-            self.assertEqual(meta["resumable"], {})
+        meta = _read_meta()
+        self.assertEqual(meta["buckets"]["bucket_a"], bucket_a_obj)
+        self.assertEqual(meta["buckets"]["bucket_b"], bucket_b_obj)
+        self.assertEqual(meta["objects"], {})
+        self.assertEqual(meta["resumable"], {})
+
+
+class StorageDedupTests(BaseTestCase):
+    def setUp(self):
+        self._data_dir = tempfile.mkdtemp()
+        self.storage = Storage(data_dir=self._data_dir, dedup=True)
+
+    def tearDown(self):
+        shutil.rmtree(self._data_dir)
+
+    def _list_blobs(self):
+        blobs_dir = os.path.join(self._data_dir, STORAGE_DIR, ".blobs")
+        return sorted(
+            name
+            for _, _, names in os.walk(blobs_dir)
+            for name in names
+        )
+
+    def test_identical_contents_are_stored_once(self):
+        for i in range(10):
+            self.storage.create_file("a_bucket", "file_{}.txt".format(i), b"content", {"key": "val"})
+        self.storage.create_file("a_bucket", "other.txt", BytesIO(b"other content"), {"key": "val"})
+
+        self.assertEqual(len(self._list_blobs()), 2)
+        self.assertEqual(self.storage.get_file("a_bucket", "file_3.txt"), b"content")
+        with self.storage.open_file("a_bucket", "other.txt")[1] as file:
+            self.assertEqual(file.read(), b"other content")
+        self.assertFalse(os.path.exists(os.path.join(self._data_dir, STORAGE_DIR, "a_bucket")))
+
+    def test_unreferenced_blobs_are_deleted(self):
+        self.storage.create_file("a_bucket", "file_1.txt", b"content", {"key": "val"})
+        self.storage.create_file("a_bucket", "file_2.txt", b"content", {"key": "val"})
+
+        self.storage.delete_file("a_bucket", "file_1.txt")
+        self.assertEqual(len(self._list_blobs()), 1)
+        self.assertEqual(self.storage.get_file("a_bucket", "file_2.txt"), b"content")
+
+        # Overwriting an object releases its previous content
+        self.storage.create_file("a_bucket", "file_2.txt", b"new content", {"key": "val"})
+        self.assertEqual(len(self._list_blobs()), 1)
+        self.assertEqual(self.storage.get_file("a_bucket", "file_2.txt"), b"new content")
+
+        self.storage.delete_file("a_bucket", "file_2.txt")
+        self.assertEqual(self._list_blobs(), [])
+
+    def test_copy_file_shares_blob(self):
+        self.storage.create_file("a_bucket", "source.txt", b"content", {"key": "val"})
+        self.storage.copy_file("a_bucket", "source.txt", "a_bucket", "dest.txt", {"key": "dest"})
+        self.assertEqual(len(self._list_blobs()), 1)
+
+        self.storage.delete_file("a_bucket", "source.txt")
+        self.assertEqual(self.storage.get_file("a_bucket", "dest.txt"), b"content")
+        self.storage.delete_file("a_bucket", "dest.txt")
+        self.assertEqual(self._list_blobs(), [])
+
+    def test_references_survive_restart(self):
+        self.storage.create_file("a_bucket", "file_1.txt", b"content", {"key": "val"})
+        file_id = self.storage.create_resumable_upload("a_bucket", "file_2.txt", {
+            "bucket": "a_bucket",
+            "name": "file_2.txt",
+        })
+        self.storage.create_file_for_resumable_upload(file_id, b"content")
+        self.assertEqual(len(self._list_blobs()), 1)
+
+        storage = Storage(data_dir=self._data_dir, dedup=True)
+        storage.delete_file("a_bucket", "file_1.txt")
+        self.assertEqual(storage.get_file("a_bucket", "file_2.txt"), b"content")
+        storage.delete_file("a_bucket", "file_2.txt")
+        self.assertEqual(self._list_blobs(), [])
+
+    def test_dedup_can_be_turned_off(self):
+        self.storage.create_file("a_bucket", "file_1.txt", b"content", {"key": "val"})
+
+        storage = Storage(data_dir=self._data_dir)
+        storage.create_file("a_bucket", "file_2.txt", b"content", {"key": "val"})
+        self.assertEqual(storage.get_file("a_bucket", "file_1.txt"), b"content")
+        self.assertEqual(storage.get_file("a_bucket", "file_2.txt"), b"content")
+
+    def test_wipe(self):
+        self.storage.create_file("a_bucket", "file_1.txt", b"content", {"key": "val"})
+        self.storage.wipe()
+        self.assertEqual(self._list_blobs(), [])
+
+        self.storage.create_file("a_bucket", "file_1.txt", b"content", {"key": "val"})
+        self.assertEqual(self.storage.get_file("a_bucket", "file_1.txt"), b"content")
+
+
+class StorageMemoryTests(BaseTestCase):
+    def setUp(self):
+        self._data_dir = tempfile.mkdtemp()
+        self.storage = Storage(use_memory_fs=True, data_dir=self._data_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self._data_dir)
+
+    def test_nothing_is_written_to_disk(self):
+        self.storage.create_bucket("a_bucket", {"key": "val"})
+        self.storage.create_file("a_bucket", "file_name.txt", b"content", {"key": "val"})
+        file_id = self.storage.create_resumable_upload("a_bucket", "file_name.png", {
+            "bucket": "a_bucket",
+            "name": "file_name.png",
+        })
+        self.storage.create_file_for_resumable_upload(file_id, b"other content")
+
+        self.assertEqual(os.listdir(self._data_dir), [])
+
+    def test_get_file_is_not_copied(self):
+        content = "Łukas is a great developer".encode("utf8")
+        self.storage.create_bucket("a_bucket", {"key": "val"})
+        self.storage.create_file("a_bucket", "file_name.txt", content, {"key": "val"})
+
+        self.assertIs(self.storage.get_file("a_bucket", "file_name.txt"), content)
+        self.assertEqual(
+            self.storage.get_file_obj("a_bucket", "file_name.txt"),
+            {"key": "val", "size": str(len(content)), "md5Hash": "01GtsrqRjcUutI4KrtIhhw==", "crc32c": "Tdldjw=="}
+        )
+
+    def test_open_file_reads_without_copying(self):
+        content = b"0123456789"
+        self.storage.create_bucket("a_bucket", {"key": "val"})
+        self.storage.create_file("a_bucket", "file_name.txt", content, {"key": "val"})
+
+        _, file = self.storage.open_file("a_bucket", "file_name.txt")
+        with file:
+            file.seek(2)
+            chunk = file.read(5)
+            self.assertIsInstance(chunk, memoryview)
+            self.assertIs(chunk.obj, content)
+            self.assertEqual(chunk, b"23456")
+            self.assertEqual(file.read(), b"789")
+
+    def test_delete_file(self):
+        self.storage.create_bucket("a_bucket", {"key": "val"})
+        self.storage.create_file("a_bucket", "file_name.txt", b"content", {"key": "val"})
+        self.storage.delete_file("a_bucket", "file_name.txt")
+
+        with self.assertRaises(NotFound):
+            self.storage.get_file("a_bucket", "file_name.txt")
+
+    def test_instances_do_not_share_data(self):
+        self.storage.create_bucket("a_bucket", {"key": "val"})
+        other_storage = Storage(use_memory_fs=True, data_dir=self._data_dir)
+        self.assertIsNone(other_storage.get_bucket("a_bucket"))
+
+    def test_wipe_keep_buckets(self):
+        self.storage.create_bucket("a_bucket", {"key": "val"})
+        self.storage.create_file("a_bucket", "file_name.txt", b"content", {"key": "val"})
+        self.storage.wipe(keep_buckets=True)
+
+        self.assertEqual(self.storage.get_bucket("a_bucket"), {"key": "val"})
+        with self.assertRaises(NotFound):
+            self.storage.get_file("a_bucket", "file_name.txt")
+
+    def test_resumable_upload_in_chunks(self):
+        file_obj = {"bucket": "a_bucket", "name": "file_name.png"}
+        file_id = self.storage.create_resumable_upload("a_bucket", "file_name.png", file_obj)
+        self.storage.append_to_resumable_upload(file_id, b"first ")
+        self.assertEqual(self.storage.append_to_resumable_upload(file_id, BytesIO(b"second")), 12)
+        self.assertEqual(self.storage.get_resumable_upload(file_id), (file_obj, 12))
+
+        self.storage.finish_resumable_upload(file_id)
+        self.assertEqual(self.storage.get_file("a_bucket", "file_name.png"), b"first second")
+        self.assertEqual(os.listdir(self._data_dir), [])
+
+    def test_copy_file_shares_content(self):
+        content = os.urandom(1024)
+        self.storage.create_file("a_bucket", "source.bin", content, {"key": "val"})
+        self.storage.copy_file("a_bucket", "source.bin", "a_bucket", "dest.bin", {"key": "dest"})
+
+        self.assertIs(self.storage.get_file("a_bucket", "dest.bin"), self.storage.get_file("a_bucket", "source.bin"))
+        self.assertEqual(self.storage.get_file_obj("a_bucket", "dest.bin")["size"], "1024")
+
+
+class StorageSnapshotTests(BaseTestCase):
+    def setUp(self):
+        self._data_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self._data_dir)
+
+    def _check_snapshot_restore(self, storage):
+        storage.create_bucket("a_bucket", {"key": "val"})
+        storage.create_file("a_bucket", "kept.txt", b"kept", {"key": "val"})
+        storage.create_file("a_bucket", "overwritten.txt", b"original", {"key": "val"})
+        file_obj = {"bucket": "a_bucket", "name": "upload.txt"}
+        file_id = storage.create_resumable_upload("a_bucket", "upload.txt", file_obj)
+        storage.append_to_resumable_upload(file_id, b"first ")
+        storage.snapshot("baseline")
+
+        storage.create_file("a_bucket", "overwritten.txt", b"changed", {"key": "val"})
+        storage.create_file("a_bucket", "added.txt", b"added", {"key": "val"})
+        storage.delete_file("a_bucket", "kept.txt")
+        storage.create_file_for_resumable_upload(file_id, b"second")
+        storage.create_bucket("other_bucket", {"key": "val"})
+
+        for _ in range(2):
+            storage.restore("baseline")
+            self.assertEqual(storage.get_file("a_bucket", "kept.txt"), b"kept")
+            self.assertEqual(storage.get_file("a_bucket", "overwritten.txt"), b"original")
+            with self.assertRaises(NotFound):
+                storage.get_file("a_bucket", "added.txt")
+            self.assertIsNone(storage.get_bucket("other_bucket"))
+            self.assertEqual([obj["size"] for obj in storage.get_file_list("a_bucket")[0]], ["4", "8"])
+            self.assertEqual(storage.get_resumable_upload(file_id), ({"bucket": "a_bucket", "name": "upload.txt"}, 6))
+
+            storage.create_file_for_resumable_upload(file_id, b"other")
+            self.assertEqual(storage.get_file("a_bucket", "upload.txt"), b"first other")
+
+    def test_snapshot_restore(self):
+        self._check_snapshot_restore(Storage(data_dir=self._data_dir))
+
+    def test_snapshot_restore_dedup(self):
+        self._check_snapshot_restore(Storage(data_dir=self._data_dir, dedup=True))
+
+    def test_snapshot_restore_in_memory(self):
+        self._check_snapshot_restore(Storage(use_memory_fs=True, data_dir=self._data_dir))
+        self.assertEqual(os.listdir(self._data_dir), [])
+
+    def test_restore_in_memory_shares_the_buckets(self):
+        storage = Storage(use_memory_fs=True, data_dir=self._data_dir)
+        storage.create_bucket("a_bucket", {"key": "val"})
+        storage.create_bucket("other_bucket", {"key": "val"})
+        for i in range(100):
+            name = "file_{:03d}.txt".format(i)
+            storage.create_file("a_bucket", name, b"content", {"name": name})
+        storage.create_file("other_bucket", "file.txt", b"other", {"key": "val"})
+        storage.snapshot("baseline")
+
+        # Neither the objects nor their index are copied
+        with mock.patch("gcloud_storage_emulator.metadata.SortedNames") as sorted_names:
+            with mock.patch("gcloud_storage_emulator.index.SortedNames.copy", autospec=True) as copy:
+                storage.restore("baseline")
+        sorted_names.assert_not_called()
+        self.assertEqual(copy.call_count, 1)  # The index of the bucket names
+
+        # A bucket is copied when changed, from the restored state or from the snapshot
+        storage.create_file("a_bucket", "file_100.txt", b"added", {"name": "file_100.txt"})
+        storage.delete_file("a_bucket", "file_000.txt")
+        self.assertEqual(len(storage.get_file_list("a_bucket")[0]), 100)
+        self.assertEqual(storage.get_file_list("a_bucket", max_results=1)[0][0]["name"], "file_001.txt")
+        self.assertEqual(storage.stats()["objects"], 101)
+
+        storage.restore("baseline")
+        self.assertEqual(len(storage.get_file_list("a_bucket")[0]), 100)
+        self.assertEqual(storage.get_file_list("a_bucket", max_results=1)[0][0]["name"], "file_000.txt")
+        self.assertEqual(storage.get_file("a_bucket", "file_000.txt"), b"content")
+        with self.assertRaises(NotFound):
+            storage.get_file("a_bucket", "file_100.txt")
+        self.assertEqual(storage.get_file("other_bucket", "file.txt"), b"other")
+        self.assertEqual(storage.stats()["objects"], 101)
+
+    def test_snapshot_survives_restart_and_wipe(self):
+        storage = Storage(data_dir=self._data_dir)
+        storage.create_file("a_bucket", "file.txt", b"content", {"key": "val"})
+        storage.snapshot("baseline")
+        storage.wipe()
+
+        storage = Storage(data_dir=self._data_dir)
+        storage.restore("baseline")
+        self.assertEqual(storage.get_file("a_bucket", "file.txt"), b"content")
+
+        # Restored files are linked, not copied
+        snapshot_path = os.path.join(self._data_dir, ".cloudstorage-snapshots", "baseline", "a_bucket", "file.txt")
+        self.assertEqual(os.stat(snapshot_path).st_nlink, 2)
+
+    def test_restore_unknown_snapshot(self):
+        for storage in (Storage(data_dir=self._data_dir), Storage(use_memory_fs=True, data_dir=self._data_dir)):
+            with self.assertRaises(NotFound):
+                storage.restore("unknown")
+
+    def test_invalid_snapshot_name(self):
+        storage = Storage(data_dir=self._data_dir)
+        for name in ("../escape", ".hidden", ""):
+            with self.assertRaises(ValueError):
+                storage.snapshot(name)
+
+
+class StorageSharedTests(BaseTestCase):
+    """Storage instances sharing a data directory, as the processes of a multi-process server do"""
+
+    def setUp(self):
+        self._data_dir = tempfile.mkdtemp()
+        self.storage = Storage(data_dir=self._data_dir, shared=True)
+        self.other_storage = Storage(data_dir=self._data_dir, shared=True)
+
+    def tearDown(self):
+        shutil.rmtree(self._data_dir)
+
+    def test_changes_are_seen_by_other_instances(self):
+        self.storage.create_bucket("a_bucket", {"key": "val"})
+        self.storage.create_file("a_bucket", "file_1.txt", b"content", {"key": "val"})
+        self.assertEqual(self.other_storage.get_bucket("a_bucket"), {"key": "val"})
+        self.assertEqual(self.other_storage.get_file("a_bucket", "file_1.txt"), b"content")
+
+        self.other_storage.create_file("a_bucket", "file_2.txt", b"other content", {"key": "val"})
+        self.other_storage.delete_file("a_bucket", "file_1.txt")
+        files, _, _ = self.storage.get_file_list("a_bucket")
+        self.assertEqual([file_obj["size"] for file_obj in files], ["13"])
+        with self.assertRaises(NotFound):
+            self.storage.get_file_obj("a_bucket", "file_1.txt")
+
+    def test_compaction_by_other_instance(self):
+        self.storage.create_bucket("a_bucket", {"key": "val"})
+        with mock.patch.object(journal, "COMPACTION_MIN_RECORDS", 2):
+            for i in range(5):
+                self.other_storage.create_file("a_bucket", "file_{}.txt".format(i), b"content", {"key": "val"})
+        self.storage.create_file("a_bucket", "file_5.txt", b"content", {"key": "val"})
+
+        self.assertEqual(len(self.storage.get_file_list("a_bucket")[0]), 6)
+        self.assertEqual(len(self.other_storage.get_file_list("a_bucket")[0]), 6)
+        self.assertEqual(len(_read_meta_from(self._data_dir)["objects"]["a_bucket"]), 6)
+
+    def test_wipe_by_other_instance(self):
+        self.storage.create_bucket("a_bucket", {"key": "val"})
+        self.other_storage.wipe()
+        self.assertIsNone(self.storage.get_bucket("a_bucket"))
+
+        self.storage.create_bucket("b_bucket", {"key": "val"})
+        self.assertEqual(self.other_storage.get_bucket("b_bucket"), {"key": "val"})
+
+    def test_lock_file_is_kept_in_the_storage_directory(self):
+        lock_path = os.path.join(self._data_dir, STORAGE_DIR, LOCK_FILE)
+        self.assertEqual(os.listdir(self._data_dir), [STORAGE_DIR])
+        self.assertTrue(os.path.exists(lock_path))
+
+        self.storage.create_file("a_bucket", "file_1.txt", b"content", {"key": "val"})
+        self.storage.snapshot("seeded")
+        self.storage.wipe()
+        self.assertTrue(os.path.exists(lock_path))
+        self.other_storage.restore("seeded")
+        self.assertTrue(os.path.exists(lock_path))
+        self.assertEqual(self.storage.get_file("a_bucket", "file_1.txt"), b"content")
+
+    def test_dedup_references_are_shared(self):
+        storage = Storage(data_dir=self._data_dir, dedup=True, shared=True)
+        other_storage = Storage(data_dir=self._data_dir, dedup=True, shared=True)
+        storage.create_file("a_bucket", "file_1.txt", b"content", {"key": "val"})
+        other_storage.create_file("a_bucket", "file_2.txt", b"content", {"key": "val"})
+
+        storage.delete_file("a_bucket", "file_1.txt")
+        self.assertEqual(other_storage.get_file("a_bucket", "file_2.txt"), b"content")
+        other_storage.delete_file("a_bucket", "file_2.txt")
+        self.assertEqual(os.listdir(os.path.join(self._data_dir, STORAGE_DIR, ".blobs", "ed")), [])
+
+    def test_memory_storage_cannot_be_shared(self):
+        with self.assertRaises(ValueError):
+            Storage(use_memory_fs=True, data_dir=self._data_dir, shared=True)
+
+
+class StorageLazyLoadingTests(BaseTestCase):
+    """Objects are only read from the snapshot when their bucket is first used"""
+
+    def setUp(self):
+        self._data_dir = tempfile.mkdtemp()
+        storage = Storage(data_dir=self._data_dir, dedup=True)
+        for bucket_name in ("a_bucket", "b_bucket"):
+            storage.create_bucket(bucket_name, {"name": bucket_name})
+            for i in range(3):
+                storage.create_file(bucket_name, "file_{}.txt".format(i), b"content", {"name": str(i)})
+        storage._meta.compact()
+
+    def tearDown(self):
+        shutil.rmtree(self._data_dir)
+
+    def test_objects_are_read_on_demand(self):
+        with mock.patch.object(journal.Journal, "read_segment", autospec=True,
+                               side_effect=journal.Journal.read_segment) as read_segment:
+            storage = Storage(data_dir=self._data_dir, dedup=True)
+            self.assertEqual(len(storage.get_bucket_list()[0]), 2)
+            self.assertEqual(storage.get_bucket("a_bucket"), {"name": "a_bucket"})
+            read_segment.assert_not_called()
+
+            self.assertEqual(len(storage.get_file_list("a_bucket")[0]), 3)
+            self.assertEqual(storage.get_file("a_bucket", "file_1.txt"), b"content")
+            self.assertEqual([call[0][1] for call in read_segment.call_args_list], ["a_bucket"])
+
+    def test_journaled_changes_to_unloaded_buckets(self):
+        storage = Storage(data_dir=self._data_dir, dedup=True)
+        storage.create_file("a_bucket", "file_3.txt", b"content", {"name": "3"})
+        storage.delete_file("a_bucket", "file_0.txt")
+
+        storage = Storage(data_dir=self._data_dir, dedup=True)
+        storage.create_file("b_bucket", "file_3.txt", b"content", {"name": "3"})
+        # The unloaded bucket is copied over to the new snapshot, with its journaled changes
+        storage._meta.compact()
+
+        storage = Storage(data_dir=self._data_dir, dedup=True)
+        files, _, _ = storage.get_file_list("a_bucket")
+        self.assertEqual([file_obj["name"] for file_obj in files], ["1", "2", "3"])
+        files, _, _ = storage.get_file_list("b_bucket")
+        self.assertEqual([file_obj["name"] for file_obj in files], ["0", "1", "2", "3"])
+
+    def test_stats_of_unloaded_buckets(self):
+        with mock.patch.object(journal.Journal, "read_segment", autospec=True,
+                               side_effect=journal.Journal.read_segment) as read_segment:
+            storage = Storage(data_dir=self._data_dir, dedup=True)
+            self.assertEqual(storage.stats(), {"buckets": 2, "objects": 6, "bytes": 42, "resumable": 0})
+            read_segment.assert_not_called()
+
+            storage.create_file("a_bucket", "file_3.txt", b"content", {"name": "3"})
+            storage.delete_file("b_bucket", "file_0.txt")
+
+        storage = Storage(data_dir=self._data_dir, dedup=True)
+        self.assertEqual(storage.stats(), {"buckets": 2, "objects": 6, "bytes": 42, "resumable": 0})
+        storage.delete_file("a_bucket", "file_0.txt")
+        self.assertEqual(storage.stats(), {"buckets": 2, "objects": 5, "bytes": 35, "resumable": 0})
+
+    def test_blobs_referenced_by_unloaded_buckets_are_kept(self):
+        storage = Storage(data_dir=self._data_dir, dedup=True)
+        for i in range(3):
+            storage.delete_file("a_bucket", "file_{}.txt".format(i))
+
+        storage = Storage(data_dir=self._data_dir, dedup=True)
+        self.assertEqual(storage.get_file("b_bucket", "file_0.txt"), b"content")
+
+    def test_unloaded_bucket_with_objects_is_not_deleted(self):
+        storage = Storage(data_dir=self._data_dir, dedup=True)
+        storage.create_bucket("c_bucket", {"name": "c_bucket"})
+        with self.assertRaises(Conflict):
+            storage.delete_bucket("a_bucket")
+
+    def test_previous_snapshot_format_is_loaded(self):
+        meta_path = os.path.join(self._data_dir, STORAGE_DIR, ".meta")
+        with open(meta_path, "w") as file:
+            json.dump({
+                "buckets": {"a_bucket": {"name": "a_bucket"}},
+                "objects": {"a_bucket": {"file.txt": {"name": "file.txt"}}},
+            }, file)
+        os.remove(os.path.join(self._data_dir, STORAGE_DIR, ".journal"))
+
+        storage = Storage(data_dir=self._data_dir)
+        self.assertEqual(storage.get_file_obj("a_bucket", "file.txt"), {"name": "file.txt"})
+        storage._meta.compact()
+        storage = Storage(data_dir=self._data_dir)
+        self.assertEqual(storage.get_file_obj("a_bucket", "file.txt"), {"name": "file.txt"})
+
+
+class StorageSQLiteTests(BaseTestCase):
+    def setUp(self):
+        self._data_dir = tempfile.mkdtemp()
+        self.storage = Storage(data_dir=self._data_dir, metadata_backend="sqlite")
+
+    def tearDown(self):
+        shutil.rmtree(self._data_dir)
+
+    def _list_all(self, storage, bucket_name, **kwargs):
+        pages = []
+        page_token = None
+        while True:
+            files, prefixes, page_token = storage.get_file_list(bucket_name, page_token=page_token, **kwargs)
+            pages.append(([file_obj["name"] for file_obj in files], prefixes))
+            if page_token is None:
+                return pages
+
+    def test_persisted_across_restarts(self):
+        self.storage.create_bucket("a_bucket", {"key": "val"})
+        self.storage.create_file("a_bucket", "file.txt", b"content", {"name": "file.txt"})
+        file_id = self.storage.create_resumable_upload("a_bucket", "upload.txt", {"name": "upload.txt"})
+        self.assertTrue(os.path.exists(os.path.join(self._data_dir, STORAGE_DIR, ".metadata.db")))
+        self.assertFalse(os.path.exists(os.path.join(self._data_dir, STORAGE_DIR, ".journal")))
+
+        storage = Storage(data_dir=self._data_dir, metadata_backend="sqlite")
+        self.assertEqual(storage.get_bucket("a_bucket"), {"key": "val"})
+        self.assertEqual(storage.get_file_obj("a_bucket", "file.txt")["size"], "7")
+        self.assertEqual(storage.get_file("a_bucket", "file.txt"), b"content")
+        self.assertEqual(storage.get_resumable_upload(file_id), ({"name": "upload.txt"}, 0))
+
+        storage.delete_file("a_bucket", "file.txt")
+        with self.assertRaises(NotFound):
+            self.storage.get_file_obj("a_bucket", "file.txt")
+
+    def test_listings_match_json_backend(self):
+        # Deduplicated, so that "b" and "b/" aren't both files of the tree
+        storage = Storage(data_dir=self._data_dir, dedup=True, metadata_backend="sqlite")
+        json_storage = Storage(use_memory_fs=True, data_dir=self._data_dir)
+        names = [
+            "a.txt", "a/b.txt", "a/b/c.txt", "a/b/d.txt", "a/c.txt", "ab/c.txt", "b", "b/", "b//c", "c/d/e", "z.txt",
+        ]
+        for each_storage in (storage, json_storage):
+            for bucket_name in ("a_bucket", "a_bucket_2", "b_bucket"):
+                each_storage.create_bucket(bucket_name, {"name": bucket_name})
+            for name in names:
+                each_storage.create_file("a_bucket", name, b"content", {"name": name})
+            each_storage.create_file("a_bucket_2", "other.txt", b"content", {"name": "other.txt"})
+
+        for kwargs in (
+            {},
+            {"prefix": "a"},
+            {"prefix": "a/"},
+            {"delimiter": "/"},
+            {"prefix": "a/", "delimiter": "/"},
+            {"prefix": "b", "delimiter": "/"},
+            {"delimiter": "/", "max_results": 2},
+            {"prefix": "a", "max_results": 1},
+            {"delimiter": "b", "max_results": 3},
+        ):
+            self.assertEqual(
+                self._list_all(storage, "a_bucket", **kwargs),
+                self._list_all(json_storage, "a_bucket", **kwargs),
+                kwargs,
+            )
+
+        for kwargs in ({}, {"prefix": "a_"}, {"max_results": 1}):
+            self.assertEqual(
+                storage.get_bucket_list(**kwargs),
+                json_storage.get_bucket_list(**kwargs),
+                kwargs,
+            )
+
+    def test_stats(self):
+        self.storage.create_bucket("a_bucket", {"key": "val"})
+        self.storage.create_file("a_bucket", "file_1.txt", b"content", {"key": "val"})
+        self.storage.create_file("a_bucket", "file_2.txt", b"other content", {"key": "val"})
+        self.storage.create_file("a_bucket", "file_1.txt", b"new content", {"key": "val"})
+        self.storage.create_resumable_upload("a_bucket", "upload.txt", {"bucket": "a_bucket", "name": "upload.txt"})
+        stats = {"buckets": 1, "objects": 2, "bytes": 24, "resumable": 1}
+        self.assertEqual(self.storage.stats(), stats)
+        self.assertEqual(Storage(data_dir=self._data_dir, metadata_backend="sqlite").stats(), stats)
+
+        self.storage.snapshot("baseline")
+        self.storage.wipe()
+        self.assertEqual(self.storage.stats(), {"buckets": 0, "objects": 0, "bytes": 0, "resumable": 0})
+        self.storage.restore("baseline")
+        self.assertEqual(self.storage.stats(), stats)
+
+    def test_delete_bucket(self):
+        self.storage.create_bucket("a_bucket", {"key": "val"})
+        self.storage.create_file("a_bucket", "file.txt", b"content", {"key": "val"})
+        with self.assertRaises(Conflict):
+            self.storage.delete_bucket("a_bucket")
+
+        self.storage.delete_file("a_bucket", "file.txt")
+        file_id = self.storage.create_resumable_upload("a_bucket", "upload.txt", {
+            "bucket": "a_bucket",
+            "name": "upload.txt",
+        })
+        with self.assertRaises(Conflict):
+            self.storage.delete_bucket("a_bucket")
+
+        self.storage.create_file_for_resumable_upload(file_id, b"content")
+        self.storage.delete_file("a_bucket", "upload.txt")
+        self.storage.delete_bucket("a_bucket")
+        self.assertIsNone(self.storage.get_bucket("a_bucket"))
+
+    def test_dedup_references(self):
+        storage = Storage(data_dir=self._data_dir, dedup=True, metadata_backend="sqlite")
+        storage.create_file("a_bucket", "file_1.txt", b"content", {"key": "val"})
+        storage.copy_file("a_bucket", "file_1.txt", "a_bucket", "file_2.txt", {"key": "val"})
+
+        storage.delete_file("a_bucket", "file_1.txt")
+        self.assertEqual(storage.get_file("a_bucket", "file_2.txt"), b"content")
+        storage.delete_file("a_bucket", "file_2.txt")
+        self.assertEqual(os.listdir(os.path.join(self._data_dir, STORAGE_DIR, ".blobs", "ed")), [])
+
+    def test_wipe(self):
+        self.storage.create_bucket("a_bucket", {"key": "val"})
+        self.storage.create_file("a_bucket", "file.txt", b"content", {"key": "val"})
+        self.storage.wipe(keep_buckets=True)
+
+        self.assertEqual(self.storage.get_bucket("a_bucket"), {"key": "val"})
+        self.assertEqual(self.storage.get_file_list("a_bucket"), ([], [], None))
+        files = os.listdir(os.path.join(self._data_dir, STORAGE_DIR))
+        self.assertEqual([name for name in files if not name.startswith(".metadata.db")], [])
+
+    def test_snapshot_restore(self):
+        StorageSnapshotTests._check_snapshot_restore(self, self.storage)
+
+    def test_shared_instances(self):
+        storage = Storage(data_dir=self._data_dir, shared=True, metadata_backend="sqlite")
+        other_storage = Storage(data_dir=self._data_dir, shared=True, metadata_backend="sqlite")
+        storage.create_bucket("a_bucket", {"key": "val"})
+        other_storage.create_file("a_bucket", "file.txt", b"content", {"key": "val"})
+        self.assertEqual(storage.get_file("a_bucket", "file.txt"), b"content")
+
+        other_storage.wipe()
+        self.assertIsNone(storage.get_bucket("a_bucket"))
+
+    def test_journal_is_imported(self):
+        data_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, data_dir)
+        storage = Storage(data_dir=data_dir)
+        storage.create_bucket("a_bucket", {"key": "val"})
+        storage.create_file("a_bucket", "file.txt", b"content", {"key": "val"})
+
+        storage = Storage(data_dir=data_dir, metadata_backend="sqlite")
+        self.assertEqual(storage.get_bucket("a_bucket"), {"key": "val"})
+        self.assertEqual(storage.get_file("a_bucket", "file.txt"), b"content")
+        self.assertFalse(os.path.exists(os.path.join(data_dir, STORAGE_DIR, ".journal")))
+
+    def test_invalid_backend(self):
+        with self.assertRaises(ValueError):
+            Storage(data_dir=self._data_dir, metadata_backend="unknown")
+        with self.assertRaises(ValueError):
+            Storage(use_memory_fs=True, data_dir=self._data_dir, metadata_backend="sqlite")
@@ -0,0 +1,95 @@
+import logging
+import time
+
+# Stages of a request, in the order they happen
+ROUTE = "route"  # Parsing the URL and finding its route
+READ = "read"  # Reading and parsing the body, when the handler asks for its data
+STORAGE = "storage"  # Calls to the storage, including the object contents they stream in
+SERIALIZE = "serialize"  # Encoding JSON responses
+WRITE = "write"  # Sending the response, including the object contents streamed out
+STAGES = (ROUTE, READ, STORAGE, SERIALIZE, WRITE)
+
+# Time left out of the stages, e.g. the rest of the handler
+OTHER = "other"
+
+# Seconds after which a request is logged as slow
+DEFAULT_SLOW_REQUEST_THRESHOLD = 1.0
+
+# Logger of the slow requests, to send them apart from the rest of the log
+slow_logger = logging.getLogger("gcloud_storage_emulator.slow_requests")
+
+
+class RequestTimer(object):
+    """Time spent by a request in each stage
+
+    Arguments:
+        start {float} -- The `time.perf_counter()` at which the request started
+    """
+
+    __slots__ = ("start", "stages")
+
+    def __init__(self, start):
+        self.start = start
+        self.stages = dict.fromkeys(STAGES, 0.0)
+
+    def add(self, stage, since):
+        """Adds the time elapsed since a `time.perf_counter()` to a stage"""
+
+        self.stages[stage] += time.perf_counter() - since
+
+    def breakdown(self, duration):
+        """Returns the time spent in each stage, as "stage=1.234ms" pairs
+
+        Arguments:
+            duration {float} -- Total duration of the request, the part out of the stages is
+                                reported as "other"
+        """
+
+        stages = list(self.stages.items())
+        stages.append((OTHER, max(duration - sum(self.stages.values()), 0.0)))
+        return " ".join("{}={:.3f}ms".format(stage, seconds * 1000) for stage, seconds in stages)
+
+
+class TimedStorage(object):
+    """Stands in for the storage given to a handler, timing its calls as the storage stage"""
+
+    __slots__ = ("_storage", "_timer")
+
+    def __init__(self, storage, timer):
+        self._storage = storage
+        self._timer = timer
+
+    def __getattr__(self, name):
+        attribute = getattr(self._storage, name)
+        if not callable(attribute):
+            return attribute
+
+        timer = self._timer
+
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return attribute(*args, **kwargs)
+            finally:
+                timer.add(STORAGE, start)
+
+        return timed
+
+
+def log_if_slow(timer, threshold, method, path, status):
+    """Logs the request to the slow log, with its breakdown, if it took longer than the threshold
+
+    Arguments:
+        timer {RequestTimer} -- The timer of the request, which just ended
+        threshold {float} -- Seconds after which the request is slow, None to log none
+        method {str} -- The HTTP method of the request
+        path {str} -- The path of the request
+        status {int} -- The status code of the response
+    """
+
+    duration = time.perf_counter() - timer.start
+    if threshold is None or duration < threshold:
+        return
+    slow_logger.warning("Slow request {} {} {} took {:.3f}ms: {}".format(
+        method, path, status, duration * 1000, timer.breakdown(duration)
+    ))